@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+'''
+Headless benchmarks of the daze hot paths
+
+    python benchmarks/run.py [--sizes 1000,10000,100000] [--repeat 3]
+                             [--output results.json]
+                             [--compare baseline.json] [--threshold 0.2]
+
+Every benchmark runs in a fresh process, offscreen (QT_QPA_PLATFORM) and
+with HOME pointing at a scratch directory holding a synthetic library and
+its daze state, so the real daze data is never touched:
+
+- first_paint: from the start of daze to the first paint of the window, and
+  to the playlist being paged in and warmed up (ready)
+- load_daze_<rows>: building the playlist tab and paging in a playlist
+- save_state_<rows>: saving a single playlist change, and a batch of them,
+  through the state service
+- probe: reading the metadata of a track with mutagen
+- trim: lossless trim of an mp3 file, and re-encoding trim when ffmpeg is
+  available
+
+Results are written as JSON. Given a previous run with --compare, every
+benchmark slower by more than --threshold is flagged as a regression, and
+the exit status is 1 if there is any
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+DAZE_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, DAZE_DIR)
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.2
+# playlist changes saved by the save_state benchmarks
+MUTATIONS = 200
+# tracks probed by the probe benchmark
+PROBED_TRACKS = 500
+# duration in seconds of the track trimmed by the trim benchmark
+TRIMMED_SECONDS = 600
+# seconds a child process gets before it is considered hung
+CHILD_TIMEOUT = 600
+
+
+def _library(home, size):
+    '''
+    Write a library of size tracks and its daze state in a scratch HOME,
+    once
+    '''
+    from synthetic import write_library, write_state
+    directory = os.path.join(home, 'Downloads')
+    tracks = write_library(directory, size)
+    if not os.path.exists(os.path.expanduser('~/.daze_data.db')):
+        write_state(directory, tracks)
+    return directory, tracks
+
+
+def _run_event_loop(app, done, timeout=CHILD_TIMEOUT):
+    '''
+    Process events until done() is true
+    '''
+    deadline = time.perf_counter() + timeout
+    while not done():
+        if time.perf_counter() > deadline:
+            raise RuntimeError('Timed out')
+        app.processEvents()
+        time.sleep(0.001)
+
+
+def child_prepare(args):
+    _library(os.environ['HOME'], args.size)
+    return {}
+
+
+def child_first_paint(args):
+    # the library was prepared by child_prepare, its setup isn't timed
+    from daze.utils import startup
+    startup.enable(['--profile-startup'])
+    from daze import main_window
+    from PyQt5.QtWidgets import QApplication
+    startup.mark('import daze.main_window')
+
+    app = QApplication([])
+    window = main_window.MainWindow(app)
+    window.show()
+    ready = []
+    window.playlist_widget.started.connect(lambda: ready.append(True))
+    _run_event_loop(app, lambda: ready)
+
+    offsets = {label: end for label, _, end in startup.steps()}
+    return {'first_paint': offsets['first paint'],
+            'ready': offsets['started']}
+
+
+def child_load_daze(args):
+    from PyQt5.QtWidgets import QApplication
+    from daze.playlist_tab import PlaylistTab
+    from daze.utils.state_service import StateService
+
+    _library(os.environ['HOME'], args.size)
+    app = QApplication([])
+    start = time.perf_counter()
+    state = StateService()
+    state.load()
+    tab = PlaylistTab(state)
+    constructed = time.perf_counter()
+    tab.load_playlist_page()
+    _run_event_loop(app, lambda: tab.playlist_model.rowCount() >= args.size)
+    paged_in = time.perf_counter()
+    return {'construct': constructed - start,
+            'page_in': paged_in - constructed,
+            'total': paged_in - start}
+
+
+def child_save_state(args):
+    from daze.utils.state_service import StateService
+
+    _, tracks = _library(os.environ['HOME'], args.size)
+    state = StateService()
+    state.load()
+    for _ in state.iter_playlist():
+        pass
+
+    start = time.perf_counter()
+    for index, (name, path) in enumerate(tracks[:MUTATIONS]):
+        state.set_playlist_item(name, {'filename': path, 'mutation': index})
+        state.flush()
+    single = (time.perf_counter() - start) / MUTATIONS
+
+    start = time.perf_counter()
+    for index, (name, path) in enumerate(tracks[:MUTATIONS]):
+        state.set_playlist_item(name, {'filename': path, 'batch': index})
+    state.flush()
+    batched = (time.perf_counter() - start) / MUTATIONS
+
+    start = time.perf_counter()
+    name, path = tracks[0]
+    state.rename_playlist_item(name, name + ' renamed', {'filename': path})
+    state.flush()
+    renamed = time.perf_counter() - start
+    # as it was for the next run
+    state.rename_playlist_item(name + ' renamed', name, {'filename': path})
+    state.close()
+    return {'per_mutation': single,
+            'per_batched_mutation': batched,
+            'rename': renamed}
+
+
+def child_probe(args):
+    from daze.utils.metadata_cache import probe
+
+    _, tracks = _library(os.environ['HOME'], min(args.size, PROBED_TRACKS))
+    start = time.perf_counter()
+    for _, path in tracks:
+        probe(path)
+    return {'per_track': (time.perf_counter() - start) / len(tracks)}
+
+
+def child_trim(args):
+    from synthetic import write_track
+    from daze.utils import mp3_trim, stream_edit, transcode
+
+    path = os.path.join(os.environ['HOME'], 'long.mp3')
+    write_track(path, TRIMMED_SECONDS)
+    dest = os.path.join(os.environ['HOME'], 'trimmed.mp3')
+    start_point, end_point = TRIMMED_SECONDS / 4.0, TRIMMED_SECONDS * 3 / 4.0
+
+    start = time.perf_counter()
+    mp3_trim.trim(path, start_point, end_point, dest)
+    results = {'lossless': time.perf_counter() - start}
+
+    if shutil.which(transcode.FFMPEG):
+        start = time.perf_counter()
+        stream_edit.trim(path, start_point, end_point, dest, bitrate=128000,
+                         sample_rate=44100, channels=1)
+        results['reencode'] = time.perf_counter() - start
+    return results
+
+
+CHILDREN = {'prepare': child_prepare,
+            'first_paint': child_first_paint,
+            'load_daze': child_load_daze,
+            'save_state': child_save_state,
+            'probe': child_probe,
+            'trim': child_trim}
+
+
+def run_child(name, size, home):
+    '''
+    Run a benchmark in a fresh process
+
+    @return: dictionary of metric -> seconds
+    '''
+    env = dict(os.environ, HOME=home, QT_QPA_PLATFORM='offscreen')
+    output = subprocess.run([sys.executable, os.path.realpath(__file__),
+                             '--child', name, '--size', str(size)],
+                            env=env,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            timeout=CHILD_TIMEOUT,
+                            check=True).stdout
+    # the result is the last line, daze may print before it
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmark(name, size, repeat, scratch):
+    '''
+    Run a benchmark repeat times, the library and state are written before
+    the first run, in a process of their own, and reused by every run
+
+    @return: dictionary of metric -> {'seconds': median, 'runs': [...]}
+    '''
+    home = os.path.join(scratch, '{}_{}'.format(name, size))
+    os.makedirs(home, exist_ok=True)
+    run_child('prepare', size, home)
+    runs = [run_child(name, size, home) for _ in range(repeat)]
+    return {metric: {'seconds': statistics.median(run[metric] for run in runs),
+                     'runs': [run[metric] for run in runs]}
+            for metric in runs[0]}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=DAZE_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run_all(sizes, repeat):
+    '''
+    Run every benchmark
+
+    @return: dictionary of benchmark -> metric -> result, and information
+             about the run under 'meta'
+    '''
+    plan = [('first_paint', min(sizes))]
+    plan += [('load_daze', size) for size in sizes]
+    plan += [('save_state', size) for size in sizes]
+    plan += [('probe', PROBED_TRACKS), ('trim', 0)]
+
+    results = {'meta': {'date': datetime.datetime.now().isoformat(),
+                        'revision': git_revision(),
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'sizes': list(sizes),
+                        'repeat': repeat},
+               'benchmarks': {}}
+    scratch = tempfile.mkdtemp(prefix='daze-benchmarks-')
+    try:
+        for name, size in plan:
+            key = name if name in ('first_paint', 'probe', 'trim') else \
+                '{}_{}'.format(name, size)
+            print('Running {}...'.format(key), file=sys.stderr)
+            try:
+                results['benchmarks'][key] = run_benchmark(name, size, repeat, scratch)
+            except (subprocess.SubprocessError, ValueError) as e:
+                print('Unable to run {}'.format(key), file=sys.stderr)
+                print(getattr(e, 'stderr', None) or e, file=sys.stderr)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+def compare(baseline, results, threshold):
+    '''
+    Compare two runs metric by metric
+
+    @return: list of (benchmark, metric, baseline seconds, seconds, ratio,
+             regressed) tuples
+    '''
+    rows = []
+    for benchmark, metrics in sorted(results['benchmarks'].items()):
+        for metric, result in sorted(metrics.items()):
+            before = baseline['benchmarks'].get(benchmark, {}).get(metric)
+            if not before or not before['seconds']:
+                continue
+            ratio = result['seconds'] / before['seconds']
+            rows.append((benchmark, metric, before['seconds'], result['seconds'],
+                         ratio, ratio > 1 + threshold))
+    return rows
+
+
+def print_results(results):
+    for benchmark, metrics in sorted(results['benchmarks'].items()):
+        for metric, result in sorted(metrics.items()):
+            print('{:<24} {:<22} {:>12.3f} ms'.format(benchmark, metric,
+                                                      result['seconds'] * 1000))
+
+
+def print_comparison(rows):
+    for benchmark, metric, before, after, ratio, regressed in rows:
+        print('{:<24} {:<22} {:>12.3f} ms -> {:>12.3f} ms  {:>6.2f}x{}'.format(
+            benchmark, metric, before * 1000, after * 1000, ratio,
+            '  REGRESSION' if regressed else ''))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the daze hot paths')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated playlist sizes')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='runs of every benchmark, the median is kept')
+    parser.add_argument('--output', help='file the JSON results are written to')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='slowdown ratio over which a benchmark regressed')
+    parser.add_argument('--child', choices=sorted(CHILDREN), help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, default=0, help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    if args.child:
+        result = CHILDREN[args.child](args)
+        print(json.dumps(result))
+        sys.stdout.flush()
+        # don't wait on the background threads of daze
+        os._exit(0)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    results = run_all(sizes, max(1, args.repeat))
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            rows = compare(json.load(handle), results, args.threshold)
+        print()
+        print_comparison(rows)
+        if any(row[-1] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
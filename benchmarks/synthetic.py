@@ -0,0 +1,98 @@
+'''
+Synthetic daze libraries for the benchmarks
+
+Tracks are silent MPEG-1 layer III streams written frame by frame, no
+encoder needed. The tracks of a library share their data through hard links
+(copies where linking is unavailable), so libraries of 100k tracks cost little
+more than their directory entries
+'''
+import os
+
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3NoHeaderError
+
+from daze.utils import daze_state
+
+
+# MPEG-1 layer III, no CRC, 128 kbit/s, 44100 Hz, no padding, mono
+FRAME_HEADER = b'\xff\xfb\x90\xc0'
+FRAME_SIZE = 144 * 128000 // 44100
+SAMPLES_PER_FRAME = 1152
+SAMPLE_RATE = 44100
+
+
+def silent_mp3(seconds):
+    '''
+    Return the bytes of a silent mp3 stream, the side information and main
+    data of every frame left zero
+
+    @param seconds: duration of the stream
+    '''
+    frames = max(1, int(round(seconds * SAMPLE_RATE / SAMPLES_PER_FRAME)))
+    frame = FRAME_HEADER + bytes(FRAME_SIZE - len(FRAME_HEADER))
+    return frame * frames
+
+
+def write_track(path, seconds, title=None):
+    '''
+    Write a silent mp3 file, tagged with a title and artist
+
+    @param path: path of the file
+    @param seconds: duration of the audio
+    @param title: title tag, the file name if None
+    '''
+    with open(path, 'wb') as handle:
+        handle.write(silent_mp3(seconds))
+    try:
+        tags = EasyID3(path)
+    except ID3NoHeaderError:
+        tags = EasyID3()
+    tags['title'] = title or os.path.splitext(os.path.basename(path))[0]
+    tags['artist'] = 'daze benchmarks'
+    tags.save(path)
+
+
+def track_name(index):
+    return 'Track {:06d}'.format(index)
+
+
+def write_library(directory, count, seconds=1):
+    '''
+    Fill a directory with silent tracks, those already there are kept
+
+    @param directory: path of the library directory, created if needed
+    @param count: number of tracks
+    @param seconds: duration of every track
+    @return: list of (name, path) pairs of the tracks
+    '''
+    os.makedirs(directory, exist_ok=True)
+    template = os.path.join(directory, '.template.mp3')
+    if not os.path.exists(template):
+        write_track(template, seconds, 'Silence')
+
+    tracks = []
+    for index in range(count):
+        name = track_name(index)
+        path = os.path.join(directory, '{}.mp3'.format(name))
+        if not os.path.exists(path):
+            try:
+                os.link(template, path)
+            except OSError:
+                with open(template, 'rb') as source, open(path, 'wb') as dest:
+                    dest.write(source.read())
+        tracks.append((name, path))
+    return tracks
+
+
+def write_state(directory, tracks):
+    '''
+    Store a playlist of the tracks of a library in the daze state of the
+    current HOME
+
+    @param directory: path of the library directory
+    @param tracks: list of (name, path) pairs
+    '''
+    daze_state.save_state({'Preferences': {'directory_path': directory,
+                                           'mode': 'night'}})
+    daze_state.save_playlist_items((name, {'filename': path})
+                                   for name, path in tracks)
@@ -0,0 +1,412 @@
+'''
+Headless daze commands
+
+    daze import [--dest DIR] [--file FILE] [--jobs N] [URL ...]
+    daze trim [--start SECONDS] [--end SECONDS] [--reencode] [--jobs N] FILE ...
+    daze scan [--jobs N] [DIRECTORY]
+    daze export [--quality KBPS] [--jobs N] DEST [NAME ...]
+
+They share daze state with the GUI but never import PyQt5: downloads reuse
+YoutubeDLUtility, and files are converted, trimmed and probed on a process
+pool of --jobs workers. Changes are committed to daze state in batches
+'''
+import argparse
+import concurrent.futures
+import os
+import shutil
+import sys
+
+from .errors import DazeStateException, DazeTranscodeException, DazeTrimException
+from .utils import daze_state
+
+
+COMMANDS = ('import', 'trim', 'scan', 'export')
+# playlist items saved per transaction
+BATCH_SIZE = 100
+PLAYLIST_FILE = 'daze.m3u'
+
+
+def is_command(args):
+    '''
+    Whether command line arguments run a headless command rather than the
+    GUI
+    '''
+    return bool(args) and args[0] in COMMANDS
+
+
+def _preferences():
+    try:
+        return daze_state.load_state(playlist=False).get('Preferences', {})
+    except DazeStateException:
+        return {}
+
+
+def _default_directory():
+    return _preferences().get('directory_path') or os.path.expanduser('~/Downloads')
+
+
+def _playlist():
+    return [item for page in daze_state.iter_playlist() for item in page]
+
+
+class _Batch(object):
+    '''
+    Playlist changes committed to daze state BATCH_SIZE at a time
+    '''
+    def __init__(self):
+        self.saved = []
+        self.removed = []
+
+    def save(self, name, metadata):
+        self.saved.append((name, metadata))
+        self._commit_if_full()
+
+    def remove(self, name):
+        self.removed.append(name)
+        self._commit_if_full()
+
+    def _commit_if_full(self):
+        if len(self.saved) + len(self.removed) >= BATCH_SIZE:
+            self.commit()
+
+    def commit(self):
+        if self.saved or self.removed:
+            daze_state.apply_changes(removed=self.removed, saved=self.saved)
+        self.saved = []
+        self.removed = []
+
+
+def _download(link, dest_dir, ie_key, verbose):
+    '''
+    Download the audio of a link, run on a thread
+
+    @return: YoutubeDLUtility
+    '''
+    from .utils.youtube_dl import YoutubeDLUtility
+    item = YoutubeDLUtility(link, dest_dir, ie_key,
+                            log=None if verbose else (lambda line: None))
+    item.download()
+    return item
+
+
+def import_links(args):
+    '''
+    Download, convert and add links to the playlist, playlists expanded into
+    their entries. Links of videos already in the playlist are skipped
+    '''
+    from .utils import transcode
+    from .utils.youtube_dl import source_id
+
+    links = list(args.links)
+    if args.file:
+        with (sys.stdin if args.file == '-' else open(args.file)) as handle:
+            links.extend(line.strip() for line in handle)
+    links = [link for link in links if link and not link.startswith('#')]
+    dest_dir = args.dest or _default_directory()
+    os.makedirs(dest_dir, exist_ok=True)
+    policy = transcode.format_policy(_preferences())
+
+    batch = _Batch()
+    failed = 0
+    seen = set()
+    # future -> link, downloads on threads and conversions on processes
+    downloads = {}
+    conversions = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as downloader, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as converter:
+        def submit(link, ie_key=None, source=None):
+            source = source or source_id(link)
+            key = source or link
+            if key in seen:
+                return
+            seen.add(key)
+            if source is not None:
+                name = daze_state.find_source(*source)
+                if name is not None:
+                    print('{} is already in the playlist: {}'.format(link, name))
+                    return
+            downloads[downloader.submit(_download, link, dest_dir, ie_key,
+                                        args.verbose)] = link
+
+        for link in links:
+            submit(link)
+
+        while downloads or conversions:
+            done, _ = concurrent.futures.wait(list(downloads) + list(conversions),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    link = downloads.pop(future)
+                    try:
+                        item = future.result()
+                    except Exception as e:
+                        failed += 1
+                        print('Unable to download {}: {}'.format(link, e))
+                        continue
+                    if item.entries is not None:
+                        print('Importing {} entries of {}'.format(len(item.entries),
+                                                                 item.title))
+                        for entry in item.entries:
+                            source = ((entry['ie_key'], entry['video_id'])
+                                      if entry['ie_key'] and entry['video_id'] else None)
+                            submit(entry['url'], entry['ie_key'], source)
+                        continue
+                    conversion = converter.submit(transcode.convert,
+                                                  item.download_filename,
+                                                  policy)
+                    conversions[conversion] = item
+                else:
+                    item = conversions.pop(future)
+                    try:
+                        item.filename = future.result()
+                    except DazeTranscodeException as e:
+                        failed += 1
+                        print(e)
+                        continue
+                    batch.save(item.name, item.metadata)
+                    print('Imported {}'.format(item.name))
+    batch.commit()
+    return 1 if failed else 0
+
+
+def _trim_file(path, start, end, reencode):
+    '''
+    Trim a file in place, run on a process
+
+    @param end: end of the kept audio in seconds, from the end of the file
+                if negative, the end of the file if None
+    @return: error message, None if it was trimmed
+    '''
+    from .utils import mp3_trim, stream_edit
+    from .utils.metadata_cache import probe
+
+    try:
+        metadata = probe(path)
+    except Exception as e:
+        return 'Unable to read {}: {}'.format(path, e)
+    if end is None:
+        end = metadata.duration
+    elif end < 0:
+        end = metadata.duration + end
+    if not 0 <= start < end:
+        return 'Nothing left of {} between {} s and {} s'.format(path, start, end)
+
+    if not reencode and path.lower().endswith('.mp3'):
+        try:
+            mp3_trim.trim(path, start, end)
+            return None
+        except DazeTrimException:
+            # not a plain MPEG stream, re-encoded below
+            pass
+    try:
+        stream_edit.trim(path, start, end,
+                         bitrate=metadata.bitrate,
+                         sample_rate=metadata.sample_rate or stream_edit.DEFAULT_SAMPLE_RATE,
+                         channels=metadata.channels or stream_edit.DEFAULT_CHANNELS)
+    except DazeTrimException as e:
+        return 'Unable to trim {}: {}'.format(path, e)
+    return None
+
+
+def trim(args):
+    '''
+    Trim files in place, losslessly when they are mp3 files
+    '''
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(_trim_file, path, args.start, args.end,
+                                   args.reencode): path
+                   for path in args.files}
+        for future in concurrent.futures.as_completed(futures):
+            error = future.result()
+            if error is None:
+                print('Trimmed {}'.format(futures[future]))
+            else:
+                failed += 1
+                print(error)
+    return 1 if failed else 0
+
+
+def _probe(path):
+    '''
+    Read the metadata of a file, run on a process
+
+    @return: (path, size, mtime, metadata dictionary), None if it can't be
+             read
+    '''
+    from .utils.metadata_cache import probe
+    try:
+        stat = os.stat(path)
+        metadata = probe(path)
+    except Exception:
+        return None
+    return path, stat.st_size, stat.st_mtime, metadata._asdict()
+
+
+def scan(args):
+    '''
+    Sync the playlist with the audio files of a directory, and fill the
+    metadata cache of the new and changed files
+    '''
+    from .utils.library_scanner import scan as scan_directory, track_name
+
+    directory = os.path.abspath(args.directory or _default_directory())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        snapshot = scan_directory(directory, executor)
+
+    playlist = _playlist()
+    names = {name for name, _ in playlist}
+    known = {metadata.get('filename') for _, metadata in playlist}
+    batch = _Batch()
+    removed = 0
+    for name, metadata in playlist:
+        path = metadata.get('filename') or ''
+        if os.path.dirname(os.path.abspath(path)) == directory and path not in snapshot:
+            batch.remove(name)
+            removed += 1
+    added = 0
+    for path in sorted(snapshot):
+        name = track_name(path)
+        if path not in known and name not in names:
+            batch.save(name, {'filename': path})
+            names.add(name)
+            added += 1
+    batch.commit()
+
+    cached = daze_state.load_audio_metadata()
+    stale = [path for path, key in snapshot.items()
+             if tuple(cached.get(path, (None, None))[:2]) != key]
+    entries = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for entry in executor.map(_probe, stale, chunksize=16):
+            if entry is not None:
+                entries.append(entry)
+            if len(entries) >= BATCH_SIZE:
+                daze_state.save_audio_metadata(entries)
+                entries = []
+    daze_state.save_audio_metadata(entries)
+
+    print('{}: {} added, {} removed, {} probed'.format(directory, added, removed,
+                                                       len(stale)))
+    return 0
+
+
+def _export_track(path, dest, quality):
+    '''
+    Copy a track, or encode it to mp3 at a quality, run on a process
+
+    @param quality: bitrate in kbit/s, mp3 tracks are copied and the others
+                    encoded at no more than their own bitrate if None
+    @return: error message, None if it was exported
+    '''
+    from .utils import transcode
+    try:
+        if quality is None and path.lower().endswith('.mp3'):
+            shutil.copy2(path, dest)
+        elif quality is None:
+            _, bitrate = transcode.probe_audio(path)
+            transcode.encode(path, dest,
+                             transcode.target_quality(transcode.PREFERRED_QUALITY, bitrate))
+        else:
+            transcode.encode(path, dest, quality)
+    except (OSError, DazeTranscodeException) as e:
+        return 'Unable to export {}: {}'.format(path, e)
+    return None
+
+
+def export(args):
+    '''
+    Export playlist items as mp3 files to a directory, along with an m3u
+    playlist of them
+    '''
+    os.makedirs(args.dest, exist_ok=True)
+    playlist = _playlist()
+    if args.names:
+        wanted = set(args.names)
+        playlist = [(name, metadata) for name, metadata in playlist if name in wanted]
+
+    failed = 0
+    exported = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = []
+        for name, metadata in playlist:
+            file_name = '{}.mp3'.format(name)
+            futures.append((file_name,
+                            executor.submit(_export_track,
+                                            metadata.get('filename'),
+                                            os.path.join(args.dest, file_name),
+                                            args.quality)))
+        for file_name, future in futures:
+            error = future.result()
+            if error is None:
+                exported.append(file_name)
+            else:
+                failed += 1
+                print(error)
+
+    with open(os.path.join(args.dest, PLAYLIST_FILE), 'w') as handle:
+        handle.write('#EXTM3U\n')
+        handle.writelines('{}\n'.format(file_name) for file_name in exported)
+    print('Exported {} tracks to {}'.format(len(exported), args.dest))
+    return 1 if failed else 0
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog='daze',
+                                     description='Headless daze commands, run '
+                                                 'daze without any to start '
+                                                 'the GUI')
+    jobs = argparse.ArgumentParser(add_help=False)
+    jobs.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                      help='parallel workers, one per core by default')
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('import', parents=[jobs],
+                                  help='download links into the playlist')
+    command.add_argument('links', nargs='*', metavar='URL')
+    command.add_argument('--file', '-f', help='file of links, one per line, - for stdin')
+    command.add_argument('--dest', help='directory of the downloaded files, '
+                                        'the daze directory by default')
+    command.add_argument('--verbose', '-v', action='store_true',
+                         help='print the youtube-dl log')
+    command.set_defaults(run=import_links)
+
+    command = commands.add_parser('trim', parents=[jobs],
+                                  help='trim audio files in place')
+    command.add_argument('files', nargs='+', metavar='FILE')
+    command.add_argument('--start', type=float, default=0.0,
+                         help='start of the kept audio in seconds')
+    command.add_argument('--end', type=float,
+                         help='end of the kept audio in seconds, negative to '
+                              'count from the end of the file')
+    command.add_argument('--reencode', action='store_true',
+                         help='re-encode mp3 files rather than cutting frames')
+    command.set_defaults(run=trim)
+
+    command = commands.add_parser('scan', parents=[jobs],
+                                  help='sync the playlist with a directory')
+    command.add_argument('directory', nargs='?',
+                         help='the daze directory by default')
+    command.set_defaults(run=scan)
+
+    command = commands.add_parser('export', parents=[jobs],
+                                  help='export playlist items as mp3 files')
+    command.add_argument('dest', help='destination directory')
+    command.add_argument('names', nargs='*', metavar='NAME',
+                         help='playlist items to export, all by default')
+    command.add_argument('--quality', help='re-encode every track at this '
+                                           'bitrate in kbit/s')
+    command.set_defaults(run=export)
+    return parser.parse_args(args)
+
+
+def main(args):
+    '''
+    Run a headless command
+
+    @param args: command line arguments, without the program name
+    @return: exit status
+    '''
+    args = parse_args(args)
+    args.jobs = max(1, args.jobs)
+    return args.run(args)
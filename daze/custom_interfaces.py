@@ -1,37 +1,389 @@
 '''
 Custom intefaces
 '''
+import array
+import bisect
+import datetime
+import math
 import os
+import sys
 
-from PyQt5.QtWidgets import QListView, QAbstractItemView
-from PyQt5.QtGui import QStandardItemModel
-from PyQt5.QtCore import QVariant, pyqtSignal, QModelIndex, Qt
+from PyQt5.QtWidgets import QListView, QAbstractItemView, QStyledItemDelegate, QStyle
+from PyQt5.QtGui import QPalette
+from PyQt5.QtCore import (QAbstractListModel,
+                          QAbstractProxyModel,
+                          QVariant,
+                          pyqtSignal,
+                          QModelIndex,
+                          Qt)
 
 
-class QNonStandardItemModel(QStandardItemModel):
+DURATION_ROLE = Qt.UserRole + 1
+PENDING_ROLE = Qt.UserRole + 2
+
+
+class PlaylistModel(QAbstractListModel):
     '''
-    Subclass QStandardItemModel to intercept the changing text of an item to
-    represent the change made in daze_data
+    List model of the playlist. Names, paths and durations are kept in
+    compact parallel columns (interned strings, a double array) rather than
+    one QStandardItem per track, and rows are inserted in bulk.
+
+    Changing the text of an item is intercepted to represent the change made
+    in daze_data. Rows with a job id are placeholders of in-flight downloads
     '''
     itemBeforeAndAfterChanged = pyqtSignal(QModelIndex,
                                            int,
                                            QVariant,
                                            QVariant)
 
+    def __init__(self, icon, parent=None):
+        '''
+        @param icon: icon shown next to every playlist item
+        @param parent: parent QObject
+        '''
+        super().__init__(parent)
+        self.icon = icon
+        self._names = []
+        self._paths = []
+        self._durations = array.array('d')
+        self._jobs = array.array('q')
+        # name/path -> row of track rows, job id -> row of placeholder rows,
+        # rebuilt lazily after removals
+        self._name_rows = {}
+        self._path_rows = {}
+        self._job_rows = {}
+        self._rows_stale = False
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return QVariant()
+        row = index.row()
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self._names[row]
+        if role == Qt.DecorationRole:
+            return self.icon
+        if role == DURATION_ROLE:
+            duration = self._durations[row]
+            return None if math.isnan(duration) else duration
+        if role == PENDING_ROLE:
+            return self._jobs[row] != 0
+        return QVariant()
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if self._jobs[index.row()] == 0:
+            flags |= Qt.ItemIsEditable | Qt.ItemIsDragEnabled
+        return flags
+
     def setData(self,
                 index_qmodel_index,
                 after_value,
                 role=Qt.EditRole):
 
+        if not index_qmodel_index.isValid() or role != Qt.EditRole:
+            return False
+
         before_value = self.data(index_qmodel_index, role)
         self.itemBeforeAndAfterChanged.emit(index_qmodel_index,
                                             role,
                                             before_value,
                                             after_value)
-        return QStandardItemModel.setData(self,
-                                          index_qmodel_index,
-                                          after_value,
-                                          role)
+        row = index_qmodel_index.row()
+        self._names[row] = sys.intern(after_value)
+        if not self._rows_stale:
+            self._name_rows.pop(before_value, None)
+            self._name_rows[self._names[row]] = row
+        self.dataChanged.emit(index_qmodel_index, index_qmodel_index, [role])
+        return True
+
+    def append_tracks(self, tracks):
+        '''
+        Append tracks with a single row insertion
+
+        @param tracks: list of (name, path) pairs
+        '''
+        if not tracks:
+            return
+        first = len(self._names)
+        self.beginInsertRows(QModelIndex(), first, first + len(tracks) - 1)
+        for row, (name, path) in enumerate(tracks, first):
+            name = sys.intern(name)
+            path = sys.intern(path)
+            self._names.append(name)
+            self._paths.append(path)
+            if not self._rows_stale:
+                self._name_rows[name] = row
+                self._path_rows[path] = row
+        self._durations.extend([math.nan] * len(tracks))
+        self._jobs.extend([0] * len(tracks))
+        self.endInsertRows()
+
+    def append_placeholder(self, job_id, text):
+        '''
+        Append the placeholder row of an in-flight download
+
+        @param job_id: id of the download job
+        @param text: text shown in the row
+        '''
+        row = len(self._names)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._names.append(text)
+        self._paths.append('')
+        self._durations.append(math.nan)
+        self._jobs.append(job_id)
+        if not self._rows_stale:
+            self._job_rows[job_id] = row
+        self.endInsertRows()
+
+    def set_placeholder_text(self, job_id, text):
+        row = self.row_of_job(job_id)
+        if row is not None:
+            self._names[row] = text
+            changed = self.index(row)
+            self.dataChanged.emit(changed, changed, [Qt.DisplayRole])
+
+    def remove_placeholder(self, job_id):
+        row = self.row_of_job(job_id)
+        if row is not None:
+            self.remove_row(row)
+
+    def remove_row(self, row):
+        self.remove_rows([row])
+
+    def remove_rows(self, rows):
+        '''
+        Remove rows, compacting the columns once: a single row removal if
+        the rows are contiguous, a model reset otherwise
+
+        @param rows: iterable of rows
+        '''
+        rows = sorted(set(rows))
+        if not rows:
+            return
+        first, last = rows[0], rows[-1]
+        if last - first + 1 == len(rows):
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self._names[first:last + 1]
+            del self._paths[first:last + 1]
+            del self._durations[first:last + 1]
+            del self._jobs[first:last + 1]
+            self._rows_stale = True
+            self.endRemoveRows()
+            return
+
+        removed = set(rows)
+        kept = [row for row in range(len(self._names)) if row not in removed]
+        self.beginResetModel()
+        self._names = [self._names[row] for row in kept]
+        self._paths = [self._paths[row] for row in kept]
+        self._durations = array.array('d', (self._durations[row] for row in kept))
+        self._jobs = array.array('q', (self._jobs[row] for row in kept))
+        self._rows_stale = True
+        self.endResetModel()
+
+    def row_of_job(self, job_id):
+        '''
+        Return the row of the placeholder of a download job, None if none
+        '''
+        self._refresh_rows()
+        return self._job_rows.get(job_id)
+
+    def row_of_name(self, name):
+        '''
+        Return the row of a track, None if it is not in the playlist
+        '''
+        self._refresh_rows()
+        return self._name_rows.get(name)
+
+    def path(self, row):
+        return self._paths[row]
+
+    def job_id(self, row):
+        '''
+        Return the id of the download job of a placeholder row, 0 for a track
+        '''
+        return self._jobs[row]
+
+    def name_of_path(self, path):
+        '''
+        Return the name of the track of a path, None if it is not in the
+        playlist
+        '''
+        self._refresh_rows()
+        row = self._path_rows.get(path)
+        if row is not None:
+            return self._names[row]
+
+    def set_path(self, row, path):
+        path = sys.intern(path)
+        if not self._rows_stale:
+            self._path_rows.pop(self._paths[row], None)
+            self._path_rows[path] = row
+        self._paths[row] = path
+
+    def set_track(self, row, name, path):
+        '''
+        Rename a track without reporting it as an edit, the file was renamed
+        outside of daze
+        '''
+        self.set_path(row, path)
+        if not self._rows_stale:
+            self._name_rows.pop(self._names[row], None)
+            self._name_rows[name] = row
+        self._names[row] = sys.intern(name)
+        changed = self.index(row)
+        self.dataChanged.emit(changed, changed, [Qt.DisplayRole])
+
+    def set_durations(self, durations):
+        '''
+        Set the durations of tracks
+
+        @param durations: dictionary of path -> duration in seconds
+        '''
+        self._refresh_rows()
+        rows = []
+        for path, duration in durations.items():
+            row = self._path_rows.get(path)
+            if row is not None and duration is not None:
+                self._durations[row] = duration
+                rows.append(row)
+        if rows:
+            self.dataChanged.emit(self.index(min(rows)),
+                                  self.index(max(rows)),
+                                  [DURATION_ROLE])
+
+    def _refresh_rows(self):
+        if not self._rows_stale:
+            return
+        self._name_rows = {}
+        self._path_rows = {}
+        self._job_rows = {}
+        for row, (name, path, job_id) in enumerate(zip(self._names,
+                                                       self._paths,
+                                                       self._jobs)):
+            if job_id == 0:
+                self._name_rows[name] = row
+                self._path_rows[path] = row
+            else:
+                self._job_rows[job_id] = row
+        self._rows_stale = False
+
+
+class PlaylistFilterModel(QAbstractProxyModel):
+    '''
+    Proxy showing only the playlist rows of a set of names. Unlike
+    QSortFilterProxyModel it never visits the rows that don't match, the
+    shown source rows are looked up from the names directly
+    '''
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # sorted source rows shown, None when not filtering
+        self._rows = None
+        self._names = None
+
+    def setSourceModel(self, model):
+        super().setSourceModel(model)
+        model.rowsAboutToBeInserted.connect(self._rows_about_to_be_inserted)
+        model.rowsInserted.connect(self._rows_inserted)
+        model.rowsAboutToBeRemoved.connect(self._rows_about_to_be_removed)
+        model.rowsRemoved.connect(self._rows_removed)
+        model.dataChanged.connect(self._data_changed)
+        model.modelReset.connect(self._refilter)
+
+    def set_filter(self, names):
+        '''
+        Show only the tracks with the given names
+
+        @param names: set of playlist item names, None to show every row
+        '''
+        self._names = names
+        self._refilter()
+
+    def is_filtering(self):
+        return self._names is not None
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid() or self.sourceModel() is None:
+            return 0
+        if self._rows is None:
+            return self.sourceModel().rowCount()
+        return len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 1
+
+    def index(self, row, column=0, parent=QModelIndex()):
+        if parent.isValid() or column != 0 or not 0 <= row < self.rowCount():
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index):
+        return QModelIndex()
+
+    def mapToSource(self, proxy_index):
+        if not proxy_index.isValid() or self.sourceModel() is None:
+            return QModelIndex()
+        row = proxy_index.row()
+        if self._rows is not None:
+            row = self._rows[row]
+        return self.sourceModel().index(row)
+
+    def mapFromSource(self, source_index):
+        if not source_index.isValid():
+            return QModelIndex()
+        row = source_index.row()
+        if self._rows is not None:
+            position = bisect.bisect_left(self._rows, row)
+            if position == len(self._rows) or self._rows[position] != row:
+                return QModelIndex()
+            row = position
+        return self.index(row)
+
+    def _refilter(self):
+        self.beginResetModel()
+        if self._names is None:
+            self._rows = None
+        else:
+            rows = (self.sourceModel().row_of_name(name) for name in self._names)
+            self._rows = sorted(row for row in rows if row is not None)
+        self.endResetModel()
+
+    def _rows_about_to_be_inserted(self, parent, first, last):
+        if self._rows is None:
+            self.beginInsertRows(QModelIndex(), first, last)
+
+    def _rows_inserted(self, parent, first, last):
+        if self._rows is None:
+            self.endInsertRows()
+        else:
+            self._refilter()
+
+    def _rows_about_to_be_removed(self, parent, first, last):
+        if self._rows is None:
+            self.beginRemoveRows(QModelIndex(), first, last)
+
+    def _rows_removed(self, parent, first, last):
+        if self._rows is None:
+            self.endRemoveRows()
+        else:
+            self._refilter()
+
+    def _data_changed(self, top_left, bottom_right, roles=()):
+        if self._rows is None:
+            self.dataChanged.emit(self.mapFromSource(top_left),
+                                  self.mapFromSource(bottom_right),
+                                  roles)
+        elif self._rows:
+            self.dataChanged.emit(self.index(0),
+                                  self.index(len(self._rows) - 1),
+                                  roles)
 
 
 class NonStandardQListView(QListView):
@@ -67,3 +419,25 @@ class NonStandardQListView(QListView):
         else:
             e.ignore()
 
+
+class DurationDelegate(QStyledItemDelegate):
+    '''
+    Paint the duration of a playlist item (DURATION_ROLE), right aligned,
+    next to its name
+    '''
+    def paint(self, painter, option, index):
+        super().paint(painter, option, index)
+        duration = index.data(DURATION_ROLE)
+        if duration is None:
+            return
+
+        if option.state & QStyle.State_Selected:
+            color_role = QPalette.HighlightedText
+        else:
+            color_role = QPalette.Text
+        painter.save()
+        painter.setPen(option.palette.color(color_role))
+        painter.drawText(option.rect.adjusted(0, 0, -4, 0),
+                         Qt.AlignRight | Qt.AlignVCenter,
+                         str(datetime.timedelta(seconds=round(duration))))
+        painter.restore()
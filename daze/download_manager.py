@@ -0,0 +1,607 @@
+'''
+Download manager: runs pasted links through a two stage pipeline so
+downloads never block the GUI thread. I/O bound downloads run on a bounded
+pool of worker threads and hand the raw audio to a process pool, sized to the
+core count, for the CPU bound conversion (see utils.transcode).
+
+A link to a playlist is expanded into one job per entry. The entries of a
+playlist import and how each of them ended are kept in daze state, so an
+interrupted import resumes where it stopped. So are the jobs yet to finish,
+with their partial file, so that a download interrupted by quitting daze
+continues from where it got to.
+
+Jobs are picked up by priority. A job queued ahead of running ones, with no
+worker free, pauses the running job of lowest priority, whose partial file
+is resumed once a worker is free again. All downloads share a global
+bandwidth limit
+'''
+import collections
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from .errors import DazeDownloadPausedException
+from .utils import daze_state, progress_events, tracing, transcode
+from .utils.bandwidth import BandwidthLimiter
+from .utils.youtube_dl import YoutubeDLUtility
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+TRANSCODING = 'transcoding'
+FINISHED = 'finished'
+FAILED = 'failed'
+DUPLICATE = 'duplicate'
+# the link was a playlist, expanded into a PlaylistImport
+EXPANDED = 'expanded'
+# the playlist import entry was already in the library
+SKIPPED = 'skipped'
+
+DEFAULT_WORKERS = 3
+# seconds between saves of the progress of a download
+PROGRESS_INTERVAL = 2
+
+# job priorities, lower first
+PRIORITY_FIRST = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+PRIORITY_SHUTDOWN = 3
+IN_FLIGHT = (PENDING, RUNNING, TRANSCODING)
+
+
+class DownloadJob(object):
+    def __init__(self, job_id, link, dest_dir, source=None, ie_key=None,
+                 priority=PRIORITY_NORMAL):
+        '''
+        A single link making its way through the download manager
+
+        @param job_id: unique id of the job
+        @param link: link provided by user
+        @param dest_dir: destination directory of the downloaded audio file
+        @param source: (extractor, video id) the link points to, if known
+        @param ie_key: key of the extractor handling the link, if known
+        @param priority: one of the PRIORITY constants, lower first
+        '''
+        self.job_id = job_id
+        self.link = link
+        self.dest_dir = dest_dir
+        self.source = source
+        self.ie_key = ie_key
+        self.priority = priority
+        # set to have the running job pause at its next progress report
+        self.preempted = False
+        self.status = PENDING
+        self.name = ''
+        self.metadata = {}
+        self.error = None
+        # library file holding the same audio, for DUPLICATE jobs
+        self.duplicate = None
+        # PlaylistImport the link expanded into, for EXPANDED jobs
+        self.playlist_import = None
+        # (PlaylistImport, position) of the import entries downloaded by
+        # the job
+        self.import_entries = []
+        # id of the download in daze state, partial file and its progress
+        self.download_id = None
+        self.partial = ''
+        self.downloaded_bytes = 0
+        self.progress_saved = 0
+
+
+class PlaylistImport(object):
+    def __init__(self, import_id, link, dest_dir, title, entries):
+        '''
+        The entries of a playlist link, downloaded as separate jobs
+
+        @param import_id: id of the import in daze state
+        @param link: link of the playlist
+        @param dest_dir: destination directory of the downloaded audio files
+        @param title: title of the playlist
+        @param entries: list of dictionaries with the position, url, ie_key,
+                        video_id, title and status of every entry
+        '''
+        self.import_id = import_id
+        self.link = link
+        self.dest_dir = dest_dir
+        self.title = title
+        self.entries = entries
+
+    def entries_with_status(self, status):
+        return [entry for entry in self.entries if entry['status'] == status]
+
+    @property
+    def done(self):
+        '''
+        Number of entries no longer pending
+        '''
+        return len(self.entries) - len(self.entries_with_status(PENDING))
+
+
+class DownloadManager(QObject):
+    '''
+    Keep a queue of download jobs and hand them to a fixed number of worker
+    threads, downloaded audio is then converted on a process pool. Job
+    changes are reported through Qt signals, which are delivered on the
+    thread of the receiving object (the GUI thread for widgets)
+    '''
+    job_queued = pyqtSignal(object)
+    job_started = pyqtSignal(object)
+    job_transcoding = pyqtSignal(object)
+    job_finished = pyqtSignal(object)
+    job_failed = pyqtSignal(object)
+    job_duplicate = pyqtSignal(object)
+    job_expanded = pyqtSignal(object)
+    job_paused = pyqtSignal(object)
+    import_progress = pyqtSignal(object)
+    import_finished = pyqtSignal(object)
+
+    def __init__(self, workers=DEFAULT_WORKERS, transcoders=None,
+                 content_index=None, find_source=None, events=None,
+                 rate_limit=None, policy=None, parent=None):
+        '''
+        @param workers: number of concurrent download workers
+        @param transcoders: number of conversion processes, defaults to the
+                            number of cores
+        @param content_index: ContentIndex of the library, downloads already
+                              in the library are discarded if given
+        @param find_source: callable returning the library item downloaded
+                            from an (extractor, video id), None if there is
+                            none. Playlist entries found are not downloaded
+        @param events: EventBus the progress and log lines of the jobs are
+                       published on, a new one if None
+        @param rate_limit: global download limit in bytes per second,
+                           unlimited if None
+        @param policy: transcode.FormatPolicy downloads are converted with,
+                       the default policy if None
+        @param parent: parent QObject
+        '''
+        super().__init__(parent)
+        self.events = events or progress_events.EventBus()
+        self.content_index = content_index
+        self.find_source = find_source
+        self.jobs = collections.OrderedDict()
+        self.imports = {}
+        self._lock = threading.Lock()
+        # (priority, sequence, job), the sequence keeps jobs of the same
+        # priority in order
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._job_ids = itertools.count(1)
+        self._workers = []
+        # jobs downloading on a worker
+        self._running = {}
+        self.limiter = BandwidthLimiter(rate_limit)
+        self.policy = policy or transcode.DEFAULT_POLICY
+        # spawn rather than fork, forking a process running Qt threads is
+        # not safe
+        self._transcoder = concurrent.futures.ProcessPoolExecutor(
+            max_workers=transcoders or os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context('spawn'))
+
+        for _ in range(max(1, workers)):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, link, dest_dir, source=None, ie_key=None,
+               import_entry=None, download=None, priority=None):
+        '''
+        Queue a link for download. A link already being downloaded, or
+        pointing to a video already being downloaded, is merged into that
+        download
+
+        @param link: link provided by user
+        @param dest_dir: destination directory of the downloaded audio file
+        @param source: (extractor, video id) the link points to, if known
+        @param ie_key: key of the extractor handling the link, if known
+        @param import_entry: (PlaylistImport, position) of the playlist
+                             import entry the link is downloaded for
+        @param download: the interrupted download resumed by the job, as
+                         returned by daze_state.load_downloads
+        @param priority: one of the PRIORITY constants, PRIORITY_BULK for
+                         import entries and PRIORITY_NORMAL otherwise if None
+        @return: the queued DownloadJob, or the in-flight one it was merged
+                 into
+        '''
+        with self._lock:
+            for job in self.jobs.values():
+                if job.status in IN_FLIGHT and (job.link == link or
+                                                (source is not None and
+                                                 job.source == source)):
+                    if import_entry is not None:
+                        job.import_entries.append(import_entry)
+                    if download is not None:
+                        daze_state.remove_download(download['id'])
+                    return job
+            if priority is None:
+                priority = PRIORITY_NORMAL if import_entry is None else PRIORITY_BULK
+            job = DownloadJob(next(self._job_ids), link, dest_dir, source, ie_key,
+                              priority)
+            if import_entry is not None:
+                job.import_entries.append(import_entry)
+            self.jobs[job.job_id] = job
+
+        if download is not None:
+            job.download_id = download['id']
+            job.partial = download['partial']
+            job.downloaded_bytes = download['downloaded']
+        else:
+            try:
+                job.download_id = daze_state.save_download(
+                    link, dest_dir, ie_key, source,
+                    import_entry[0].import_id if import_entry else None)
+            except Exception as e:
+                print('Unable to record the download of {}'.format(link))
+                print(e)
+
+        self.events.publish(progress_events.QUEUED, job.job_id, message=link)
+        self.job_queued.emit(job)
+        self._enqueue(job)
+        return job
+
+    def prioritize(self, job_id, priority=PRIORITY_FIRST):
+        '''
+        Raise the priority of a pending job, pausing a running job of lower
+        priority if no worker is free
+
+        @param job_id: id of the job
+        @param priority: one of the PRIORITY constants
+        '''
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status != PENDING or job.priority <= priority:
+                return
+            job.priority = priority
+        # the entry of the old priority is skipped by the workers
+        self._enqueue(job)
+
+    def jobs_with_status(self, status):
+        '''
+        Return the jobs currently in the given status
+        '''
+        with self._lock:
+            return [job for job in self.jobs.values() if job.status == status]
+
+    def resume(self):
+        '''
+        Queue the downloads and the pending entries of the playlist imports
+        interrupted when daze last quit, in the background
+        '''
+        threading.Thread(target=self._resume, daemon=True).start()
+
+    def shutdown(self):
+        '''
+        Stop the workers once the jobs already queued have been handled
+        '''
+        for _ in self._workers:
+            self._queue.put((PRIORITY_SHUTDOWN, next(self._sequence), None))
+        self._transcoder.shutdown(wait=False)
+
+    def _enqueue(self, job):
+        with self._lock:
+            self._queue.put((job.priority, next(self._sequence), job))
+            # preempt the running job of lowest priority if it is lower
+            if len(self._running) < len(self._workers):
+                return
+            lowest = max(self._running.values(),
+                         key=lambda running: running.priority,
+                         default=None)
+            if lowest is not None and lowest.priority > job.priority:
+                lowest.preempted = True
+
+    def _work(self):
+        while True:
+            priority, _, job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                # stale entry of a job that was prioritized or already ran
+                if job.status != PENDING or job.priority != priority:
+                    continue
+                job.status = RUNNING
+                self._running[job.job_id] = job
+            self.limiter.register(job.job_id)
+            try:
+                self._run(job)
+            finally:
+                self.limiter.unregister(job.job_id)
+                with self._lock:
+                    self._running.pop(job.job_id, None)
+
+    def _run(self, job):
+        self.job_started.emit(job)
+
+        try:
+            youtubedl_item = YoutubeDLUtility(job.link,
+                                              job.dest_dir,
+                                              job.ie_key,
+                                              functools.partial(self._progress, job),
+                                              functools.partial(self.events.log,
+                                                                job.job_id))
+            with tracing.span('download', link=job.link):
+                youtubedl_item.download()
+            if youtubedl_item.entries is not None:
+                self._expand(job, youtubedl_item)
+                return
+        except DazeDownloadPausedException:
+            self._pause(job)
+            return
+        except Exception as e:
+            self._fail(job, e)
+            return
+
+        # the download slot is free again while the conversion runs
+        job.status = TRANSCODING
+        self.job_transcoding.emit(job)
+        self.events.publish(progress_events.POSTPROCESSING,
+                            job.job_id,
+                            message='Converting')
+        try:
+            future = self._transcoder.submit(transcode.convert,
+                                             youtubedl_item.download_filename,
+                                             self.policy)
+        except Exception as e:
+            self._fail(job, e)
+            return
+        future.add_done_callback(functools.partial(self._transcoded,
+                                                   job,
+                                                   youtubedl_item,
+                                                   tracing.now()))
+
+    def _transcoded(self, job, youtubedl_item, started, future):
+        # the conversion ran in a transcoder process, it is recorded on the
+        # thread the result came back to
+        tracing.record('transcode', started, link=job.link)
+        try:
+            youtubedl_item.filename = future.result()
+        except Exception as e:
+            self._fail(job, e)
+            return
+
+        job.name = youtubedl_item.name
+        job.metadata = youtubedl_item.metadata
+        if self.content_index is None:
+            self._finish(job, None)
+        else:
+            # hash on the index's threads rather than the pool's callback
+            # thread
+            self.content_index.check(youtubedl_item.filename,
+                                     functools.partial(self._finish, job))
+
+    def _pause(self, job):
+        '''
+        Put a preempted job back in the queue, its partial file is resumed
+        when it runs again
+        '''
+        with self._lock:
+            job.preempted = False
+            job.status = PENDING
+        try:
+            daze_state.save_download_progress(job.download_id,
+                                              job.partial,
+                                              job.downloaded_bytes)
+        except Exception as e:
+            self.events.log(job.job_id, str(e))
+        self.events.log(job.job_id, 'Paused at {} bytes'.format(job.downloaded_bytes))
+        self.job_paused.emit(job)
+        self._enqueue(job)
+
+    def _progress(self, job, youtubedl_item):
+        '''
+        Save where a download got to, at most every PROGRESS_INTERVAL
+        seconds unless it moved on to another partial file. Throttles the
+        download to its share of the bandwidth, and pauses it if it was
+        preempted
+
+        @raise DazeDownloadPausedException: the job was preempted
+        '''
+        if not youtubedl_item.finished:
+            if job.preempted:
+                raise DazeDownloadPausedException()
+            self.limiter.throttle(job.job_id, youtubedl_item.downloaded_bytes)
+
+        partial_changed = youtubedl_item.partial_filename != job.partial
+        if partial_changed and job.partial and \
+                job.partial != youtubedl_item.download_filename:
+            # the download started over in another file, the recorded one
+            # would never be resumed
+            _remove_partial(job.partial)
+        job.partial = youtubedl_item.partial_filename
+        job.downloaded_bytes = youtubedl_item.downloaded_bytes
+        self.events.publish(progress_events.BYTES,
+                            job.job_id,
+                            downloaded_bytes=youtubedl_item.downloaded_bytes,
+                            total_bytes=youtubedl_item.total_bytes,
+                            speed=youtubedl_item.speed,
+                            eta=youtubedl_item.eta)
+        now = time.monotonic()
+        if job.download_id is None or not (partial_changed or
+                                           now - job.progress_saved >= PROGRESS_INTERVAL):
+            return
+        job.progress_saved = now
+        try:
+            daze_state.save_download_progress(job.download_id,
+                                              job.partial,
+                                              job.downloaded_bytes)
+        except Exception as e:
+            self.events.log(job.job_id, str(e))
+
+    def _forget_download(self, job, remove_partial=False):
+        '''
+        Forget the download of a job that ended, and its partial file if
+        it can't be resumed
+        '''
+        if job.download_id is not None:
+            try:
+                daze_state.remove_download(job.download_id)
+            except Exception as e:
+                self.events.log(job.job_id, str(e))
+        if remove_partial:
+            _remove_partial(job.partial)
+
+    def _finish(self, job, duplicate):
+        self._forget_download(job)
+        if duplicate is None:
+            job.status = FINISHED
+            self.events.publish(progress_events.DONE,
+                                job.job_id,
+                                message=job.metadata.get('filename'))
+            self.job_finished.emit(job)
+            self._entries_done(job)
+            return
+
+        try:
+            os.remove(job.metadata.get('filename'))
+        except OSError as e:
+            self.events.log(job.job_id, str(e))
+        job.status = DUPLICATE
+        job.duplicate = duplicate
+        self.events.publish(progress_events.DONE,
+                            job.job_id,
+                            message='Duplicate of {}'.format(duplicate))
+        self.job_duplicate.emit(job)
+        self._entries_done(job)
+
+    def _expand(self, job, youtubedl_item):
+        '''
+        Turn the job of a playlist link into an import of its entries
+        '''
+        import_id = daze_state.save_import(job.link,
+                                           job.dest_dir,
+                                           youtubedl_item.title,
+                                           youtubedl_item.entries)
+        entries = [dict(entry, position=position, status=PENDING)
+                   for position, entry in enumerate(youtubedl_item.entries)]
+        job.playlist_import = PlaylistImport(import_id,
+                                             job.link,
+                                             job.dest_dir,
+                                             youtubedl_item.title,
+                                             entries)
+        self._forget_download(job)
+        job.status = EXPANDED
+        self.events.publish(progress_events.DONE,
+                            job.job_id,
+                            message='Playlist of {} entries'.format(len(entries)))
+        self.job_expanded.emit(job)
+        self._import(job.playlist_import)
+
+    def _resume(self):
+        imports = daze_state.load_imports()
+        import_ids = set(playlist_import[0] for playlist_import in imports)
+        for download in daze_state.load_downloads():
+            if download['import_id'] is None:
+                partial = download['partial']
+                lost = bool(partial) and not os.path.exists(partial)
+                if lost:
+                    # its fragment state is of no use without it
+                    _remove_partial(partial)
+                    download = dict(download, partial='', downloaded=0)
+                job = self.submit(download['link'],
+                                  download['dest_dir'],
+                                  download['source'],
+                                  download['ie_key'],
+                                  download=download)
+                if lost:
+                    self.events.log(job.job_id,
+                                    'Partial file {} is gone, downloading from '
+                                    'the start'.format(partial))
+                else:
+                    self.events.log(job.job_id,
+                                    'Resuming from {} bytes'.format(download['downloaded']))
+                continue
+            # resumed, partial file included, by queueing its import entry
+            # again below
+            daze_state.remove_download(download['id'])
+            if download['import_id'] not in import_ids:
+                _remove_partial(download['partial'])
+
+        for import_id, link, dest_dir, title, entries in imports:
+            self._import(PlaylistImport(import_id, link, dest_dir, title, entries))
+
+    def _import(self, playlist_import):
+        '''
+        Queue the pending entries of a playlist import, skipping the ones
+        already in the library
+        '''
+        with self._lock:
+            self.imports[playlist_import.import_id] = playlist_import
+        self.import_progress.emit(playlist_import)
+
+        for entry in playlist_import.entries_with_status(PENDING):
+            source = None
+            if entry['ie_key'] and entry['video_id']:
+                source = (entry['ie_key'], entry['video_id'])
+                if self.find_source is not None and \
+                        self.find_source(*source) is not None:
+                    self._entry_done(playlist_import, entry, SKIPPED)
+                    continue
+            self.submit(entry['url'],
+                        playlist_import.dest_dir,
+                        source,
+                        entry['ie_key'],
+                        (playlist_import, entry['position']))
+        self._entry_done(playlist_import, None, None)
+
+    def _entries_done(self, job):
+        for playlist_import, position in job.import_entries:
+            self._entry_done(playlist_import,
+                             playlist_import.entries[position],
+                             job.status)
+
+    def _entry_done(self, playlist_import, entry, status):
+        '''
+        Record how an import entry ended, and the end of the import once no
+        entry is pending
+
+        @param entry: the entry, None to only check for the end of the import
+        '''
+        with self._lock:
+            if entry is not None:
+                entry['status'] = status
+                daze_state.set_import_entry_status(playlist_import.import_id,
+                                                   entry['position'],
+                                                   status)
+            finished = (not playlist_import.entries_with_status(PENDING) and
+                        self.imports.pop(playlist_import.import_id, None) is not None)
+            if finished:
+                daze_state.remove_import(playlist_import.import_id)
+
+        if finished:
+            self.import_finished.emit(playlist_import)
+        elif entry is not None:
+            self.import_progress.emit(playlist_import)
+
+    def _fail(self, job, error):
+        self._forget_download(job, remove_partial=True)
+        job.status = FAILED
+        job.error = error
+        self.events.log(job.job_id, str(error))
+        self.events.publish(progress_events.ERROR, job.job_id, message=str(error))
+        self.job_failed.emit(job)
+        self._entries_done(job)
+
+
+def _remove_partial(partial):
+    '''
+    Remove the partial file of a download, and the youtube-dl fragment state
+    kept next to it
+    '''
+    if not partial:
+        return
+    paths = [partial]
+    if partial.endswith('.part'):
+        paths.append('{}.ytdl'.format(partial[:-len('.part')]))
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(e)
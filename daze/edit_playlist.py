@@ -1,24 +1,37 @@
 '''
 Edit playlist item
 '''
+import concurrent.futures
 import datetime
 from .qrangeslider import QRangeSlider
-from pydub import AudioSegment
-from mutagen import mp3
+from .utils import mp3_trim, stream_edit, waveform
+from .errors import DazeTrimException
 from PyQt5.QtWidgets import (QDialog,
                              QHBoxLayout,
                              QVBoxLayout,
                              QStyle,
                              QPushButton,
+                             QCheckBox,
                              QLabel)
-from PyQt5.QtCore import QUrl
+from PyQt5.QtCore import QUrl, pyqtSignal
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
 
 
 class EditPlaylistItem(QDialog):
-    def __init__(self, parent, daze_data, current_item):
+    # emitted from the waveform worker with the audio path and its Peaks
+    waveform_ready = pyqtSignal(str, object)
+    # emitted from the waveform worker with the trimmed audio path, and
+    # whether it was trimmed
+    trim_finished = pyqtSignal(str, bool)
+
+    def __init__(self, parent):
+        '''
+        Long lived playlist item editor, retargeted to a track with load()
+        '''
         super().__init__(parent)
-        self.daze_data = daze_data
+        self.waveform_worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.waveform_ready.connect(self.waveform_generated)
+        self.trim_finished.connect(self.trimmed)
         self.media_player = QMediaPlayer(self)
         self.media_player.stateChanged.connect(self.media_state_changed)
         self.media_player.positionChanged.connect(self.position_changed)
@@ -29,61 +42,98 @@ class EditPlaylistItem(QDialog):
 
         self.setGeometry(200, 200, 550, 150)
 
-        self.current_item = current_item
-        self.audio_name = QLabel(current_item.data())
+        self.audio_name = QLabel(self)
         self.save_button = QPushButton('Save', self)
         self.save_button.clicked.connect(self.save_clicked)
         self.close_button = QPushButton('Close', self)
         self.close_button.clicked.connect(self.close_clicked)
+        # cut on mp3 frame boundaries (~26ms) without re-encoding, uncheck
+        # for sample accurate edits
+        self.lossless_box = QCheckBox('Lossless', self)
+        self.lossless_box.setChecked(True)
         self.play_button = QPushButton(self)
         self.play_button.setIcon(self.style().standardIcon(QStyle.SP_MediaPlay))
         self.play_button.clicked.connect(self.play_audio)
         self.play_button.setEnabled(True)
 
-        media_path = (self.daze_data.get('Playlist')
-                                    .get(self.current_item.data())
-                                    .get('filename'))
-        audio = mp3.MP3(media_path)
-        self.audio_length = audio.info.length
-
         self.qrangeslider = QRangeSlider(parent=self)
         self.qrangeslider.setFixedHeight(50)
-        self.qrangeslider.setMin(0)
-        self.qrangeslider.setMax(round(self.audio_length))
-        self.max_val = round(self.audio_length)
-        self.min_val = round(0)
-        self.qrangeslider.setRange(0, round(self.audio_length))
-        self.qrangeslider.setBackgroundStyle('background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 #222, stop:1 #333);')
-        self.qrangeslider.setSpanStyle('background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 #282, stop:1 #393);')
+        # translucent so the waveform painted behind shows through
+        self.qrangeslider.setBackgroundStyle('background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 rgba(34, 34, 34, 200), stop:1 rgba(51, 51, 51, 200));')
+        self.qrangeslider.setSpanStyle('background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 rgba(34, 136, 34, 120), stop:1 rgba(51, 153, 51, 120));')
         self.qrangeslider.handle.setTextColor(0)
         self.qrangeslider.start_changed.connect(self.start_changed)
         self.qrangeslider.end_changed.connect(self.end_changed)
 
-        self.end_time = str(datetime.timedelta(seconds=round(self.audio_length)))
-        self.length_time = self.end_time
-        self.start_time = str(datetime.timedelta(seconds=round(0)))
-        self.current_time = self.start_time
-        self.running_time = QLabel('{}/{}'.format(self.current_time,
-                                                  self.length_time))
+        self.running_time = QLabel(self)
 
         self.vbox.addWidget(self.audio_name)
         self.hbox2.addWidget(self.play_button)
         self.hbox2.addWidget(self.qrangeslider)
         self.hbox2.addWidget(self.running_time)
+        self.hbox.addWidget(self.lossless_box)
         self.hbox.addWidget(self.close_button)
         self.hbox.addWidget(self.save_button)
         self.vbox.addLayout(self.hbox2)
         self.vbox.addLayout(self.hbox)
         self.setLayout(self.vbox)
 
-        self.audio_filename = (self.daze_data.get('Playlist')
-                                             .get(current_item.data())
-                                             .get('filename'))
-        # possibly set slider to audio length here
+    def load(self, current_item, audio_filename, audio_metadata):
+        '''
+        Point the editor at a track
+
+        @param current_item: name of the playlist item
+        @param audio_filename: path of the audio file
+        @param audio_metadata: AudioMetadata of the audio file
+        '''
+        self.media_player.stop()
+        self.audio_name.setText(current_item)
+        self.audio_filename = audio_filename
+        self.audio_metadata = audio_metadata
+        self.save_button.setEnabled(True)
+        # only mp3 frames can be cut without re-encoding, m4a, opus and ogg
+        # tracks are re-encoded at their own bitrate
+        self.lossless_box.setEnabled(audio_filename.lower().endswith('.mp3'))
+        self.audio_length = audio_metadata.duration
+
+        self.qrangeslider.setMin(0)
+        self.qrangeslider.setMax(round(self.audio_length))
+        self.max_val = round(self.audio_length)
+        self.min_val = round(0)
+        self.qrangeslider.setRange(0, round(self.audio_length))
+
+        self.end_time = str(datetime.timedelta(seconds=round(self.audio_length)))
+        self.length_time = self.end_time
+        self.start_time = str(datetime.timedelta(seconds=round(0)))
+        self.current_time = self.start_time
+        self.running_time.setText('{}/{}'.format(self.current_time,
+                                                 self.length_time))
+
         audio_file = QUrl.fromLocalFile(self.audio_filename)
         audio_content = QMediaContent(audio_file)
         self.media_player.setMedia(audio_content)
 
+        peaks = waveform.load(self.audio_filename)
+        self.qrangeslider.setWaveform(peaks)
+        if peaks is None:
+            self.waveform_worker.submit(self.generate_waveform, self.audio_filename)
+
+    def generate_waveform(self, audio_filename):
+        '''
+        Compute the waveform of an audio file, runs on the waveform worker
+        '''
+        try:
+            peaks = waveform.generate(audio_filename)
+        except (OSError, ValueError) as e:
+            print('Unable to draw the waveform of {}'.format(audio_filename))
+            print(e)
+        else:
+            self.waveform_ready.emit(audio_filename, peaks)
+
+    def waveform_generated(self, audio_filename, peaks):
+        if audio_filename == self.audio_filename:
+            self.qrangeslider.setWaveform(peaks)
+
     def end_changed(self, max_val):
         self.media_player.pause()
         self.max_val = max_val
@@ -117,12 +167,56 @@ class EditPlaylistItem(QDialog):
             self.media_player.play()
 
     def save_clicked(self):
-        song = AudioSegment.from_mp3(self.audio_filename)
-        min_mili = self.min_val * 1000
-        max_mili = self.max_val * 1000
-        new_song = song[min_mili: max_mili + 1000]
-        new_song.export(self.audio_filename, format='mp3')
-        self.close_clicked()
+        '''
+        Trim the track on the waveform worker, re-encoding a long track takes
+        seconds, the dialog closes once it is done
+        '''
+        self.media_player.stop()
+        self.save_button.setEnabled(False)
+        self.waveform_worker.submit(self.trim,
+                                    self.audio_filename,
+                                    self.audio_metadata,
+                                    self.min_val,
+                                    self.max_val + 1,
+                                    self.lossless_box.isChecked())
+
+    def trim(self, audio_filename, audio_metadata, start, end, lossless):
+        '''
+        Trim an audio file, runs on the waveform worker
+        '''
+        if lossless and audio_filename.lower().endswith('.mp3'):
+            try:
+                mp3_trim.trim(audio_filename, start, end)
+            except DazeTrimException as e:
+                print('Unable to trim losslessly, re-encoding instead')
+                print(e)
+            else:
+                self.trim_finished.emit(audio_filename, True)
+                return
+
+        try:
+            stream_edit.trim(audio_filename,
+                             start,
+                             end,
+                             bitrate=audio_metadata.bitrate,
+                             sample_rate=(audio_metadata.sample_rate or
+                                          stream_edit.DEFAULT_SAMPLE_RATE),
+                             channels=(audio_metadata.channels or
+                                       stream_edit.DEFAULT_CHANNELS))
+        except DazeTrimException as e:
+            print('Unable to trim {}'.format(audio_filename))
+            print(e)
+            self.trim_finished.emit(audio_filename, False)
+            return
+        self.trim_finished.emit(audio_filename, True)
+
+    def trimmed(self, audio_filename, done):
+        if audio_filename != self.audio_filename:
+            # the editor moved on to another track meanwhile
+            return
+        self.save_button.setEnabled(True)
+        if done:
+            self.close_clicked()
 
     def close_clicked(self):
         self.media_player.stop()
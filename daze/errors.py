@@ -6,3 +6,14 @@ daze errors
 class DazeStateException(Exception):
     pass
 
+
+class DazeTranscodeException(Exception):
+    pass
+
+
+class DazeTrimException(Exception):
+    pass
+
+
+class DazeDownloadPausedException(Exception):
+    pass
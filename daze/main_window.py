@@ -1,11 +1,13 @@
 '''
 Main window initialization
 '''
+import functools
 import sys
-import qdarkstyle
+import threading
 
 from .about_menu import AboutMenu
-from .utils import daze_state
+from .utils import startup, tracing, watchdog
+from .utils.state_service import StateService
 from .errors import DazeStateException
 from .playlist_tab import PlaylistTab
 
@@ -14,6 +16,16 @@ from PyQt5.QtWidgets import (QMainWindow,
                              QAction,
                              qApp,
                              QDesktopWidget)
+from PyQt5.QtCore import QTimer
+
+
+@functools.lru_cache(maxsize=None)
+def dark_stylesheet():
+    '''
+    Return the qdarkstyle stylesheet, generated once
+    '''
+    import qdarkstyle
+    return qdarkstyle.load_stylesheet_pyqt5()
 
 
 class MainWindow(QMainWindow):
@@ -27,21 +39,35 @@ class MainWindow(QMainWindow):
 
         self.menu_setup()
 
+        # daze data is loaded once and shared by every widget
+        self.state = StateService()
+        self.app.aboutToQuit.connect(self.state.close)
+        self.app.aboutToQuit.connect(self.write_trace)
         try:
-            self.daze_data = daze_state.load_state()
+            self.state.load()
             self.load_daze()
         except DazeStateException:
-            self.daze_data = {}
             self.set_defaults()
 
+        # reports the event loop stalls of the GUI thread
+        self.watchdog = watchdog.StallWatchdog(
+            threading.get_ident(),
+            self.state.preferences.get('stall_threshold', watchdog.DEFAULT_THRESHOLD))
+        self.heartbeat = QTimer(self)
+        self.heartbeat.timeout.connect(self.watchdog.beat)
+        self.heartbeat.start(int(watchdog.HEARTBEAT_INTERVAL * 1000))
+        self.watchdog.start()
+        self.app.aboutToQuit.connect(self.stop_watchdog)
+
+        self.painted = False
         self.initUI()
 
     def load_daze(self):
         '''
         load daze data
         '''
-        if self.daze_data.get('Preferences')['mode'] == 'night':
-            self.app.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+        if self.state.preferences.get('mode') == 'night':
+            self.app.setStyleSheet(dark_stylesheet())
             self.theme_action.setChecked(True)
         else:
             self.app.setStyleSheet('')
@@ -51,8 +77,8 @@ class MainWindow(QMainWindow):
         '''
         set daze data
         '''
-        self.daze_data.setdefault('Preferences', {}).setdefault('mode', 'night')
-        self.app.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+        self.state.set_defaults({'mode': 'night'})
+        self.app.setStyleSheet(dark_stylesheet())
 
     def menu_setup(self):
         '''
@@ -74,6 +100,10 @@ class MainWindow(QMainWindow):
         self.theme_action.setShortcut('Ctrl+M')
         self.theme_action.triggered.connect(self.toggle_theme)
 
+        self.trace_action = QAction('Record Trace', self, checkable=True)
+        self.trace_action.setChecked(tracing.enabled())
+        self.trace_action.triggered.connect(self.toggle_trace)
+
         quit_action = QAction('Quit', self)
         quit_action.setShortcut('Ctrl+Q')
         quit_action.triggered.connect(self.quit_application)
@@ -81,6 +111,7 @@ class MainWindow(QMainWindow):
         file_menu.addAction(about_action)
         file_menu.addAction(quit_action)
         settings_menu.addAction(self.theme_action)
+        settings_menu.addAction(self.trace_action)
 
     def initUI(self):
         '''
@@ -99,8 +130,19 @@ class MainWindow(QMainWindow):
         self.move(qt_rectangle.topLeft())
 
         # tabs
-        playlist_widget = PlaylistTab(self.daze_data)
-        self.setCentralWidget(playlist_widget)
+        self.playlist_widget = PlaylistTab(self.state)
+        self.playlist_widget.started.connect(startup.print_breakdown)
+        self.setCentralWidget(self.playlist_widget)
+
+    def paintEvent(self, event):
+        '''
+        Start the playlist once the window has been painted the first time
+        '''
+        super().paintEvent(event)
+        if not self.painted:
+            self.painted = True
+            startup.mark('first paint')
+            QTimer.singleShot(0, self.playlist_widget.start)
 
     def toggle_theme(self, state):
         '''
@@ -108,15 +150,37 @@ class MainWindow(QMainWindow):
         @param state: True if checkbox is checked, False otherwise
         '''
         if state:
-            self.daze_data.get('Preferences')['mode'] = 'night'
-            self.app.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+            self.state.set_preference('mode', 'night')
+            self.app.setStyleSheet(dark_stylesheet())
             self.theme_action.setChecked(True)
         else:
-            self.daze_data.get('Preferences')['mode'] = 'day'
+            self.state.set_preference('mode', 'day')
             self.app.setStyleSheet('')
             self.theme_action.setChecked(False)
 
-        daze_state.save_state(self.daze_data)
+    def stop_watchdog(self):
+        '''
+        Stop watching the event loop and print the stalls of the session
+        '''
+        self.heartbeat.stop()
+        self.watchdog.stop()
+        for line in self.watchdog.stats.summary():
+            print(line)
+
+    def toggle_trace(self, state):
+        '''
+        Start tracing, or stop it and write the trace
+        @param state: True if checkbox is checked, False otherwise
+        '''
+        if state:
+            tracing.enable()
+        else:
+            self.write_trace()
+
+    def write_trace(self):
+        path = tracing.disable()
+        if path is not None:
+            print('Trace written to {}'.format(path))
 
     def quit_application(self):
         '''
@@ -126,8 +190,13 @@ class MainWindow(QMainWindow):
 
 
 def main(args):
+    startup.enable(args)
+    tracing.enable_from_environment()
     app = QApplication(args)
+    startup.mark('QApplication')
     main_window = MainWindow(app)
+    startup.mark('MainWindow')
     main_window.show()
+    startup.mark('show')
     sys.exit(app.exec())
 
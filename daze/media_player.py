@@ -1,5 +1,6 @@
 import datetime
-from mutagen import mp3
+import functools
+import time
 from PyQt5.QtWidgets import (QDialog,
                              QPushButton,
                              QSlider,
@@ -8,16 +9,42 @@ from PyQt5.QtWidgets import (QDialog,
                              QHBoxLayout,
                              QStyle,
                              QSizePolicy)
-from PyQt5.QtCore import Qt, QUrl
+from PyQt5.QtCore import Qt, QUrl, QTimer
 from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer
 
+from .utils.play_queue import PlayQueue
+
+
+# seconds before the end of a track the next one is loaded and prerolled
+PRELOAD_SECONDS = 10
+# milliseconds between position updates, the switch to the next track is
+# rescheduled on each of them
+NOTIFY_INTERVAL = 250
+
 
 class MediaPlayer(QDialog):
-    def __init__(self, parent, current_item, media_path):
+    def __init__(self, parent, duration_of):
+        '''
+        Long lived media player going through a queue of tracks. Two
+        QMediaPlayers take turns: while one plays, the other one prerolls the
+        next track, and is started when the current track ends as per its
+        duration, so there is no gap between tracks
+
+        @param parent: parent widget
+        @param duration_of: called with the path of a track, returns its
+                            duration in seconds
+        '''
         super().__init__(parent)
-        self.initUI(current_item.data(), media_path)
+        self.duration_of = duration_of
+        self.queue = PlayQueue()
+        # path prerolled by the idle player, None if none
+        self.preloaded = None
+        self.media_length = 0
+        # time.perf_counter() time the current track is expected to end
+        self.expected_end = None
+        self.initUI()
 
-    def initUI(self, current_item, media_path):
+    def initUI(self):
         '''
         Initialize the media player
         '''
@@ -25,12 +52,15 @@ class MediaPlayer(QDialog):
         vbox = QVBoxLayout()
         hbox = QHBoxLayout()
 
-        self.media_player = QMediaPlayer(self)
-        media_url = QUrl.fromLocalFile(media_path)
-        media_content = QMediaContent(media_url)
-        self.media_player.setMedia(media_content)
-        media_mp3 = mp3.MP3(media_path)
-        media_length = media_mp3.info.length
+        # the playing player first, the other one prerolls the next track
+        self.players = [QMediaPlayer(self), QMediaPlayer(self)]
+        for player in self.players:
+            player.setNotifyInterval(NOTIFY_INTERVAL)
+
+        # switches to the next track when the current one ends
+        self.switch_timer = QTimer(self)
+        self.switch_timer.setSingleShot(True)
+        self.switch_timer.setTimerType(Qt.PreciseTimer)
 
         # set potentiona error message
         self.error_label = QLabel(self)
@@ -45,16 +75,14 @@ class MediaPlayer(QDialog):
         # media slider
         self.media_slider = QSlider(Qt.Horizontal, self)
         self.media_slider.setEnabled(True)
-        self.media_slider.setRange(0, media_length)
         self.media_slider.setFocusPolicy(Qt.NoFocus)
 
         # display time
-        self.end_time = str(datetime.timedelta(seconds=round(media_length)))
-        self.display_time = QLabel('{}/{}'.format(str(datetime.timedelta(seconds=0)),
-                                                  self.end_time))
+        self.end_time = str(datetime.timedelta(seconds=0))
+        self.display_time = QLabel(self)
 
         # current item name
-        self.current_item = QLabel(current_item)
+        self.current_item = QLabel(self)
 
         # set layouts
         vbox.addWidget(self.current_item)
@@ -68,8 +96,201 @@ class MediaPlayer(QDialog):
         # set up signals
         self.action_button.clicked.connect(self.trigger_action)
         self.media_slider.sliderMoved.connect(self.slider_value_changed)
-        self.media_player.stateChanged.connect(self.media_state_changed)
-        self.media_player.positionChanged.connect(self.position_changed)
+        self.switch_timer.timeout.connect(self.switch_track)
+        for player in self.players:
+            player.stateChanged.connect(functools.partial(self.media_state_changed, player))
+            player.positionChanged.connect(functools.partial(self.position_changed, player))
+            player.mediaStatusChanged.connect(functools.partial(self.media_status_changed,
+                                                                player))
+
+    @property
+    def media_player(self):
+        '''
+        The QMediaPlayer playing the current track
+        '''
+        return self.players[0]
+
+    @property
+    def next_player(self):
+        '''
+        The QMediaPlayer prerolling the next track
+        '''
+        return self.players[1]
+
+    def load(self, current_item, media_path, media_length):
+        '''
+        Point the media player at a single track
+
+        @param current_item: name of the playlist item
+        @param media_path: path of the audio file
+        @param media_length: duration of the audio file in seconds
+        '''
+        self.queue.set_tracks([(current_item, media_path)])
+        self.load_current(media_length)
+
+    def play_queue(self, tracks, index=0):
+        '''
+        Point the media player at a queue of tracks, played one after the
+        other
+
+        @param tracks: list of (name, path) pairs
+        @param index: index of the first track to play
+        '''
+        self.queue.set_tracks(tracks, index)
+        self.load_current()
+
+    def play_next(self, name, media_path):
+        '''
+        Queue a track right after the current one, it is loaded if nothing
+        is
+        '''
+        idle = self.queue.current() is None
+        self.queue.insert_next((name, media_path))
+        if idle:
+            self.load_current()
+        else:
+            # the track prerolled so far is no longer next
+            self.drop_preloaded()
+            self.schedule_switch()
+
+    def rename(self, before_name, after_name, media_path):
+        '''
+        Follow a renamed playlist item
+        '''
+        current = self.queue.current()
+        self.queue.rename(before_name, after_name, media_path)
+        if current is not None and current[0] == before_name:
+            self.current_item.setText(after_name)
+
+    def load_current(self, media_length=None):
+        '''
+        Load the current track of the queue, paused at its start
+        '''
+        self.switch_timer.stop()
+        self.drop_preloaded()
+        self.media_player.stop()
+        current = self.queue.current()
+        if current is None:
+            return
+        name, media_path = current
+        self.media_player.setMedia(QMediaContent(QUrl.fromLocalFile(media_path)))
+        self.show_track(name, media_path, media_length)
+
+    def show_track(self, name, media_path, media_length=None):
+        if media_length is None:
+            media_length = self.track_duration(media_path)
+        self.media_length = media_length
+        self.media_slider.setRange(0, round(media_length))
+        self.media_slider.setValue(0)
+        self.end_time = str(datetime.timedelta(seconds=round(media_length)))
+        self.display_time.setText('{}/{}'.format(str(datetime.timedelta(seconds=0)),
+                                                 self.end_time))
+        self.current_item.setText(name)
+        self.error_label.clear()
+
+    def track_duration(self, media_path):
+        '''
+        Return the duration of a track in seconds, 0 if it is unknown
+        '''
+        try:
+            return self.duration_of(media_path) or 0
+        except Exception as e:
+            print('Unable to read the duration of {}'.format(media_path))
+            print(e)
+            return 0
+
+    def drop_preloaded(self):
+        if self.preloaded is not None:
+            self.next_player.stop()
+            self.next_player.setMedia(QMediaContent())
+            self.preloaded = None
+
+    def preload_next(self):
+        '''
+        Load the next track on the idle player and preroll it, so it starts
+        without waiting on the decoder
+        '''
+        upcoming = self.queue.peek_next()
+        if upcoming is None or self.preloaded == upcoming[1]:
+            return
+        self.next_player.setMedia(QMediaContent(QUrl.fromLocalFile(upcoming[1])))
+        self.next_player.pause()
+        self.preloaded = upcoming[1]
+
+    def schedule_switch(self):
+        '''
+        Preload the next track once the current one is about to end, and
+        time the switch to its end
+        '''
+        position = self.media_player.position()
+        duration = self.media_player.duration()
+        if self.media_player.state() != QMediaPlayer.PlayingState or \
+                self.queue.peek_next() is None or \
+                not (duration > 0 or self.media_length):
+            self.switch_timer.stop()
+            self.expected_end = None
+            return
+        # the duration in the metadata cache is an estimate for VBR mp3s
+        # without a Xing header, the player's is used once known and the
+        # estimate only to preroll early
+        remaining = (duration if duration > 0 else self.media_length * 1000) - position
+        estimated = self.media_length * 1000 - position if self.media_length else remaining
+        if min(remaining, estimated) > PRELOAD_SECONDS * 1000:
+            # not near the end, or no longer after a seek back
+            self.switch_timer.stop()
+            self.expected_end = None
+            self.drop_preloaded()
+            return
+        self.preload_next()
+        if remaining > PRELOAD_SECONDS * 1000:
+            self.switch_timer.stop()
+            self.expected_end = None
+            return
+        remaining = max(0, remaining)
+        self.expected_end = time.perf_counter() + remaining / 1000.0
+        self.switch_timer.start(int(remaining))
+
+    def switch_track(self):
+        '''
+        Start the next track of the queue, the prerolled one if it is still
+        next
+        '''
+        self.switch_timer.stop()
+        expected_end, self.expected_end = self.expected_end, None
+        upcoming = self.queue.advance()
+        if upcoming is None:
+            return
+        self.queue.switch_started(expected_end)
+        name, media_path = upcoming
+
+        previous = self.media_player
+        if self.preloaded != media_path:
+            self.drop_preloaded()
+            self.next_player.setMedia(QMediaContent(QUrl.fromLocalFile(media_path)))
+        self.next_player.play()
+        self.players.reverse()
+        self.preloaded = None
+        previous.stop()
+        previous.setMedia(QMediaContent())
+
+        self.show_track(name, media_path)
+
+    def record_latency(self, position):
+        '''
+        Measure the switch to the current track once its position moved, a
+        prerolled player reports playing before any audio came out
+
+        @param position: position of the current track in milliseconds
+        '''
+        if position <= 0:
+            return
+        # the position is only notified every NOTIFY_INTERVAL, the track
+        # started position ago
+        latency = self.queue.switch_finished(time.perf_counter() - position / 1000.0)
+        if latency is not None:
+            self.current_item.setToolTip(
+                'Track switch: {:.1f} ms (mean {:.1f} ms)'.format(latency * 1000,
+                                                                self.queue.mean_latency() * 1000))
 
     def trigger_action(self):
         if self.media_player.state() == QMediaPlayer.PlayingState:
@@ -80,19 +301,40 @@ class MediaPlayer(QDialog):
     def slider_value_changed(self, new_value):
         self.media_player.setPosition(new_value * 1000)
 
-    def media_state_changed(self, state):
+    def media_state_changed(self, player, state):
+        if player is not self.media_player:
+            return
         if self.media_player.state() == QMediaPlayer.PlayingState:
             self.action_button.setIcon(self.style().standardIcon(QStyle.SP_MediaPause))
         else:
             self.action_button.setIcon(self.style().standardIcon(QStyle.SP_MediaPlay))
+        self.schedule_switch()
+
+    def media_status_changed(self, player, status):
+        if player is not self.media_player:
+            return
+        if status == QMediaPlayer.EndOfMedia:
+            # the duration of the track fell short of its actual length
+            self.switch_track()
+        elif status == QMediaPlayer.InvalidMedia:
+            # m4a, opus and ogg tracks need a decoder the multimedia backend
+            # may lack
+            self.error_label.setText('Unable to play {}: {}'.format(
+                self.current_item.text(),
+                self.media_player.errorString() or 'unsupported format'))
 
-    def position_changed(self, new_position):
+    def position_changed(self, player, new_position):
+        if player is not self.media_player:
+            return
         self.display_time.setText('{}/{}'.format(str(datetime.timedelta(seconds=round(new_position / 1000))),
                                                  self.end_time))
         if not self.media_slider.isSliderDown():
             self.media_slider.setValue(new_position / 1000.0)
+        self.record_latency(new_position)
+        self.schedule_switch()
 
     def closeEvent(self, event):
+        self.switch_timer.stop()
+        self.drop_preloaded()
         self.media_player.stop()
         super().closeEvent(event)
-
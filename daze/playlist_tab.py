@@ -1,16 +1,26 @@
 '''
 Playlist tab functionality
 '''
+import concurrent.futures
+import functools
 import os
 import re
 import shutil
-
-from .utils.youtube_dl import YoutubeDLUtility
-from .utils import daze_state
-from .errors import DazeStateException
-from .custom_interfaces import NonStandardQListView, QNonStandardItemModel
-from .edit_playlist import EditPlaylistItem
-from .media_player import MediaPlayer
+import time
+
+from .custom_interfaces import (NonStandardQListView,
+                                PlaylistModel,
+                                PlaylistFilterModel,
+                                DurationDelegate)
+from .utils.metadata_cache import MetadataCache
+from .utils.search_index import SearchIndex
+from .utils.content_hash import ContentIndex
+from .utils.library_scanner import LibraryScanner, is_audio_file, track_name
+from .download_manager import DownloadManager, DEFAULT_WORKERS, FAILED, PENDING
+from .utils.youtube_dl import source_id
+from .utils.progress_events import describe
+from .utils import startup, tracing, transcode
+from .progress_signals import ProgressSignals
 
 from PyQt5.QtWidgets import (QWidget,
                              QHBoxLayout,
@@ -20,30 +30,71 @@ from PyQt5.QtWidgets import (QWidget,
                              QPushButton,
                              QFileDialog,
                              QTextEdit,
+                             QLineEdit,
                              QMenu,
                              QAction)
-from PyQt5.QtGui import (QStandardItem,
-                         QIcon,
+from PyQt5.QtGui import (QIcon,
                          QKeySequence)
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+
+
+# log lines printed for a failed download
+FAILURE_LOG_LINES = 10
+# imported in the background once the window is shown, the player and editor
+# pull in QtMultimedia and numpy, downloads youtube_dl
+WARM_UP_MODULES = ('youtube_dl',
+                   'daze.media_player',
+                   'daze.edit_playlist')
 
 
 class PlaylistTab(QWidget):
-    def __init__(self, daze_data):
+    # emitted from metadata cache workers with a dictionary of
+    # path -> AudioMetadata
+    metadata_loaded = pyqtSignal(object)
+    # emitted from the library scanner thread with LibraryChanges
+    library_changed = pyqtSignal(object)
+    # emitted from content index workers with the file name and path of a
+    # dropped file, and the library file it duplicates or None
+    drop_checked = pyqtSignal(str, str, object)
+    # emitted from the link resolver with a pasted link and the (extractor,
+    # video id) it points to or None
+    link_resolved = pyqtSignal(str, object)
+    # emitted from the warm-up thread once the heavy modules are imported
+    warmed_up = pyqtSignal()
+    # emitted once the playlist is paged in and warmed up
+    started = pyqtSignal()
+
+    def __init__(self, state):
         '''
         Initialization of the playlist tab
 
-        @daze_data: dictionary of daze related data
+        @state: StateService shared by the widgets
         '''
         super().__init__()
-        tool_tip = ('Drag/drop mp3 file or copy/paste youtube link to '
+        tool_tip = ('Drag/drop audio file or copy/paste youtube link to '
                     'download audio. Right-click to play/edit audio files.')
         self.setToolTip(tool_tip)
 
+        # get playlist item icon
+        icon_path = os.path.join(os.path.dirname(__file__), 'icons', 'daze_icon.png')
+        self.icon = QIcon(icon_path)
+
         self.playlist = NonStandardQListView(self)
-        self.playlist_item = QNonStandardItemModel()
+        self.playlist_model = PlaylistModel(self.icon, self)
+        self.playlist_filter = PlaylistFilterModel(self)
+        self.playlist_filter.setSourceModel(self.playlist_model)
         self.playlist.setDragEnabled(True)
-        self.playlist.setModel(self.playlist_item)
+        self.playlist.setUniformItemSizes(True)
+        self.playlist.setModel(self.playlist_filter)
+        self.playlist.setItemDelegate(DurationDelegate(self.playlist))
+        self.metadata_cache = MetadataCache()
+        self.content_index = ContentIndex()
+
+        # as-you-type search over the names and tags of playlist items
+        self.search_index = SearchIndex()
+        self.search_text = QLineEdit(self)
+        self.search_text.setPlaceholderText('Search')
+        self.search_text.setClearButtonEnabled(True)
 
         # menu
         self.playlist.setContextMenuPolicy(Qt.CustomContextMenu)
@@ -61,47 +112,98 @@ class PlaylistTab(QWidget):
         # button to allow users to change the directory path
         self.choose_directory = QPushButton("Choose Folder", self)
 
-        # get playlist item icon
-        icon_path = os.path.join(os.path.dirname(__file__), 'icons', 'daze_icon.png')
-        self.icon = QIcon(icon_path)
+        # player and editor dialogs, created the first time they are needed
+        self.media_player = None
+        self.edit_media = None
+
+        # follows directory_path once the playlist is loaded
+        self.library_scanner = None
+
+        # matches pasted links against the youtube-dl extractors, whose
+        # patterns are compiled on first use unless warmed up already
+        self.link_resolver = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # ids of the download jobs to play once they finish
+        self.play_when_ready = set()
+
+        # startup steps left before started is emitted: paged in and warmed
+        # up
+        self.startup_steps = 2
 
         # load daze data
-        try:
-            self.daze_data = daze_state.load_state()
-            self.load_daze()
-        except DazeStateException:
-            self.daze_data = daze_data
-            self.set_defaults()
+        self.state = state
+        self.set_defaults()
+        self.load_daze()
+
+        preferences = self.state.preferences
+        self.download_manager = DownloadManager(
+            preferences.get('download_workers', DEFAULT_WORKERS),
+            preferences.get('transcode_workers'),
+            self.content_index,
+            self.state.find_source,
+            rate_limit=preferences.get('download_rate_limit'),
+            policy=transcode.format_policy(preferences),
+            parent=self)
+
+        self.download_progress = ProgressSignals(self.download_manager.events, self)
 
         self.initUI()
 
+    def start(self):
+        '''
+        Page in the playlist, resume the interrupted downloads and warm up
+        the heavy modules, once the window is shown
+        '''
+        self.load_playlist_page()
+        self.download_manager.resume()
+        startup.warm_up(WARM_UP_MODULES, self.warm_up_done)
+
+    def warm_up_done(self):
+        # compile the extractors' URL patterns before the first paste
+        start = time.perf_counter()
+        source_id('')
+        startup.record('compile extractor patterns', start)
+        self.warmed_up.emit()
+
+    def startup_step_done(self):
+        self.startup_steps -= 1
+        if self.startup_steps == 0:
+            startup.mark('started')
+            self.started.emit()
+
     def load_daze(self):
         '''
-        load daze data
+        load daze data, the playlist is paged in by start
         '''
-        for name, metadata in self.daze_data.setdefault('Playlist', {}).items():
-            item = QStandardItem(self.icon, name)
-            item.setDropEnabled(False)
-            self.playlist_item.appendRow(item)
+        self.playlist_pages = self.state.iter_playlist()
 
-        self.directory_path = (self.daze_data.get('Preferences')
-                                             .get('directory_path'))
+        self.directory_path = self.state.preferences.get('directory_path')
         self.directory_path_text.setText(self.directory_path)
 
+    def load_playlist_page(self):
+        '''
+        Page in the next chunk of the playlist, handing control back to the
+        event loop between pages so the window stays responsive
+        '''
+        page = next(self.playlist_pages, None)
+        if page is None:
+            startup.mark('playlist paged in')
+            self.scan_library()
+            self.startup_step_done()
+            return
+
+        tracks = [(name, metadata.get('filename')) for name, metadata in page]
+        self.playlist_model.append_tracks(tracks)
+        self.prefetch_metadata(tracks)
+
+        QTimer.singleShot(0, self.load_playlist_page)
+
     def set_defaults(self):
         '''
         set defaults
         '''
-        # set empty playlist
-        self.daze_data.setdefault('Playlist', {})
-
         # set default directory path
-        directory_path = (self.daze_data.setdefault('Preferences', {})
-                                        .setdefault('directory_path',
-                                                    self.directory_path))
-        self.directory_path_text.setText(directory_path)
-
-        daze_state.save_state(self.daze_data)
+        self.state.set_defaults({'directory_path': self.directory_path})
 
     def initUI(self):
         # wire up signals
@@ -110,7 +212,25 @@ class PlaylistTab(QWidget):
 
         # self.playlist.clicked.connect(self.item_clicked)
         self.playlist.dropped_value.connect(self.audio_dropped)
-        self.playlist_item.itemBeforeAndAfterChanged.connect(self.callback)
+        self.playlist_model.itemBeforeAndAfterChanged.connect(self.callback)
+        self.metadata_loaded.connect(self.metadata_ready)
+        self.warmed_up.connect(self.startup_step_done)
+        self.library_changed.connect(self.library_synced)
+        self.drop_checked.connect(self.add_dropped)
+        self.link_resolved.connect(self.add_pasted)
+        self.search_text.textChanged.connect(self.filter_playlist)
+
+        self.download_manager.job_queued.connect(self.download_queued)
+        self.download_manager.job_started.connect(self.download_started)
+        self.download_manager.job_transcoding.connect(self.download_transcoding)
+        self.download_manager.job_finished.connect(self.download_finished)
+        self.download_manager.job_failed.connect(self.download_failed)
+        self.download_manager.job_duplicate.connect(self.download_duplicate)
+        self.download_manager.job_expanded.connect(self.download_expanded)
+        self.download_manager.job_paused.connect(self.download_paused)
+        self.download_progress.progress.connect(self.download_progressed)
+        self.download_manager.import_progress.connect(self.import_progressed)
+        self.download_manager.import_finished.connect(self.import_finished)
 
         self.choose_directory.clicked.connect(self.open_directory)
 
@@ -118,6 +238,7 @@ class PlaylistTab(QWidget):
         self.hbox = QHBoxLayout()
         self.hbox2 = QHBoxLayout()
         self.vbox = QVBoxLayout()
+        self.vbox.addWidget(self.search_text)
         self.vbox.addWidget(self.playlist)
         self.hbox.addWidget(self.choose_directory)
         self.hbox.addWidget(self.directory_path_text)
@@ -132,13 +253,77 @@ class PlaylistTab(QWidget):
         '''
         self.directory_path = self.file_dialog.getExistingDirectory(None, "Select Folder")
         self.directory_path_text.setText(self.directory_path)
-        self.daze_data.get('Preferences')['directory_path'] = self.directory_path
-        daze_state.save_state(self.daze_data)
+        self.state.set_preference('directory_path', self.directory_path)
+        self.scan_library()
+
+    def scan_library(self):
+        '''
+        Sync the playlist with the audio files of directory_path in the
+        background, then keep following the directory
+        '''
+        if self.library_scanner is not None:
+            self.library_scanner.stop()
+
+        known = [metadata.get('filename')
+                 for metadata in self.state.playlist.values()]
+        self.library_scanner = LibraryScanner(self.directory_path,
+                                              known,
+                                              self.library_changed.emit)
+        self.library_scanner.start()
+
+    def library_synced(self, changes):
+        '''
+        Apply the files added, removed and renamed in directory_path outside
+        of daze to the playlist
+
+        @param changes: LibraryChanges
+        '''
+        added = list(changes.added)
+        # removed at once, after the renames
+        removed = []
+        for before, after in changes.renamed:
+            name = self.playlist_model.name_of_path(before)
+            after_name = track_name(after)
+            if name is None or (after_name != name and
+                                after_name in self.state.playlist):
+                if name is not None:
+                    removed.append(name)
+                added.append(after)
+                continue
+            self.state.rename_playlist_item(name,
+                                            after_name,
+                                            dict(self.state.playlist[name],
+                                                 filename=after))
+            self.playlist_model.set_track(self.playlist_model.row_of_name(name),
+                                          after_name,
+                                          after)
+            self.search_index.rename(name, after_name, after_name)
+            if self.media_player is not None:
+                self.media_player.rename(name, after_name, after)
+
+        for path in changes.removed:
+            name = self.playlist_model.name_of_path(path)
+            if name is not None:
+                removed.append(name)
+        self.remove_tracks(removed)
+
+        tracks = []
+        for path in added:
+            name = track_name(path)
+            # already added by daze itself, or a name clash
+            if (self.playlist_model.name_of_path(path) is not None or
+                    name in self.state.playlist):
+                continue
+            tracks.append((name, path))
+            self.state.set_playlist_item(name, {'filename': path})
+        self.playlist_model.append_tracks(tracks)
+        self.prefetch_metadata(tracks)
 
     def handle_paste(self):
         '''
-        User pastes link into the playlist. Trigger download/conversion of the
-        link provided to mp3 format and store it in the default directory path
+        User pastes link into the playlist. Queue download/conversion of the
+        link provided, stored in the default directory path, on
+        the download manager
         '''
         paste_output = QApplication.instance().clipboard().text()
 
@@ -155,50 +340,257 @@ class PlaylistTab(QWidget):
             print('{} is not a valid URL'.format(paste_output))
             return
 
+        self.link_resolver.submit(self.resolve_link, paste_output)
+
+    def resolve_link(self, link):
+        '''
+        Find the video a pasted link points to, runs on the link resolver
+        '''
         try:
-            youtubedl_item = YoutubeDLUtility(paste_output, self.directory_path)
-            youtubedl_item.download_and_convert()
+            with tracing.span('source_id', link=link):
+                source = source_id(link)
         except Exception as e:
-            print('Unable to download: {}'.format(paste_output))
+            # downloaded all the same, only not checked for duplicates
+            print('Unable to resolve {}'.format(link))
             print(e)
+            source = None
+        self.link_resolved.emit(link, source)
+
+    def add_pasted(self, link, source):
+        '''
+        Queue the download of a pasted link, unless the video it points to
+        was already downloaded
+
+        @param link: link pasted
+        @param source: (extractor, video id) the link points to, None if no
+                       extractor knows it
+        '''
+        with tracing.span('handle_paste', link=link):
+            # a link to a video already downloaded resolves to its playlist
+            # item
+            if source is not None:
+                name = self.state.find_source(*source)
+                if name is not None:
+                    print('{} is already in the playlist: {}'.format(link, name))
+                    self.select_row(self.playlist_model.row_of_name(name))
+                    return
+
+            job = self.download_manager.submit(link, self.directory_path, source)
+            self.select_row(self.playlist_model.row_of_job(job.job_id))
+
+    def download_queued(self, job):
+        '''
+        Show a placeholder playlist row while the link is being downloaded
+
+        @param job: the queued DownloadJob
+        '''
+        if job.import_entries:
+            # shown as part of its playlist import
+            return
+        self.playlist_model.append_placeholder(job.job_id,
+                                               'Queued: {}'.format(job.link))
+
+    def download_started(self, job):
+        '''
+        Update the placeholder row of a job picked up by a worker
+        '''
+        self.playlist_model.set_placeholder_text(job.job_id,
+                                                 'Downloading: {}'.format(job.link))
+
+    def download_progressed(self, event):
+        '''
+        Show how far the download of a job got in its placeholder row
+
+        @param event: byte progress ProgressEvent of the job
+        '''
+        job = self.download_manager.jobs.get(event.job_id)
+        if job is not None:
+            self.playlist_model.set_placeholder_text(
+                job.job_id, 'Downloading: {} ({})'.format(job.link, describe(event)))
+
+    def download_paused(self, job):
+        '''
+        Update the placeholder row of a job making way for a job of higher
+        priority
+        '''
+        self.playlist_model.set_placeholder_text(job.job_id,
+                                                 'Paused: {}'.format(job.link))
+
+    def download_transcoding(self, job):
+        '''
+        Update the placeholder row of a job handed over for conversion
+        '''
+        self.playlist_model.set_placeholder_text(job.job_id,
+                                                 'Converting: {}'.format(job.link))
+
+    def download_finished(self, job):
+        '''
+        Replace the placeholder row of a job with the downloaded audio file
+        '''
+        self.playlist_model.remove_placeholder(job.job_id)
+        name = self.playlist_model.name_of_path(job.metadata.get('filename'))
+        if name is not None:
+            # the library scanner saw the file first
+            self.state.set_playlist_item(name, job.metadata)
+        else:
+            name = job.name
+            tracks = [(name, job.metadata.get('filename'))]
+            self.playlist_model.append_tracks(tracks)
+            self.state.set_playlist_item(name, job.metadata)
+            self.prefetch_metadata(tracks)
+
+        if job.job_id in self.play_when_ready:
+            self.play_when_ready.discard(job.job_id)
+            self.play_track_next(name)
+
+    def download_failed(self, job):
+        '''
+        Drop the placeholder row of a job that could not be downloaded
+        '''
+        self.playlist_model.remove_placeholder(job.job_id)
+        self.play_when_ready.discard(job.job_id)
+        print('Unable to download: {}'.format(job.link))
+        for line in self.download_manager.events.log_lines(job.job_id)[-FAILURE_LOG_LINES:]:
+            print(line)
+
+    def download_expanded(self, job):
+        '''
+        Drop the placeholder row of a link that turned out to be a playlist,
+        its import shows a row of its own
+        '''
+        self.playlist_model.remove_placeholder(job.job_id)
+        self.play_when_ready.discard(job.job_id)
+
+    def import_progressed(self, playlist_import):
+        '''
+        Show how far a playlist import got in its placeholder row, keyed by
+        the negated import id so it never clashes with a job id
+        '''
+        text = 'Importing {}: {}/{}'.format(playlist_import.title,
+                                            playlist_import.done,
+                                            len(playlist_import.entries))
+        if self.playlist_model.row_of_job(-playlist_import.import_id) is None:
+            self.playlist_model.append_placeholder(-playlist_import.import_id, text)
         else:
-            item = QStandardItem(self.icon, youtubedl_item.name)
-            item.setDropEnabled(False)
-            self.playlist_item.appendRow(item)
-            self.daze_data.get('Playlist')[youtubedl_item.name] = youtubedl_item.metadata
-            daze_state.save_state(self.daze_data)
+            self.playlist_model.set_placeholder_text(-playlist_import.import_id, text)
+
+    def import_finished(self, playlist_import):
+        '''
+        Drop the placeholder row of a finished playlist import
+        '''
+        self.playlist_model.remove_placeholder(-playlist_import.import_id)
+        for entry in playlist_import.entries_with_status(FAILED):
+            print('Unable to download {} from {}'.format(entry['title'],
+                                                         playlist_import.title))
+
+    def download_duplicate(self, job):
+        '''
+        Drop the placeholder row of a job whose audio is already in the
+        playlist, and select the playlist item holding it
+        '''
+        self.playlist_model.remove_placeholder(job.job_id)
+        self.select_path(job.duplicate)
+        print('{} is already in the playlist: {}'.format(job.link, job.duplicate))
+        if job.job_id in self.play_when_ready:
+            self.play_when_ready.discard(job.job_id)
+            name = self.playlist_model.name_of_path(job.duplicate)
+            if name is not None:
+                self.play_track_next(name)
+
+    def select_path(self, path):
+        '''
+        Select the playlist item of a file, if it is shown
+        '''
+        self.select_row(self.playlist_model.row_of_name(
+            self.playlist_model.name_of_path(path)))
+
+    def select_row(self, row):
+        '''
+        Select a row of the playlist model, if it is shown
+
+        @param row: row of the playlist model, nothing is selected if None
+        '''
+        if row is not None:
+            self.playlist.setCurrentIndex(
+                self.playlist_filter.mapFromSource(self.playlist_model.index(row)))
 
     def handle_remove(self):
         '''
         User removes a playlist item
         '''
         item = self.playlist.currentIndex()
-        del self.daze_data.get('Playlist')[item.data()]
-        self.playlist_item.removeRow(item.row())
-        daze_state.save_state(self.daze_data)
+        if item.data() not in self.state.playlist:
+            # placeholder of an in-flight download
+            return
+        self.remove_track(item.data())
+
+    def remove_track(self, name):
+        '''
+        Remove a playlist item from the playlist, the state and the search
+        index
+
+        @param name: name of the playlist item
+        '''
+        self.remove_tracks([name])
+
+    def remove_tracks(self, names):
+        '''
+        Remove playlist items, their rows in a single removal
+
+        @param names: names of the playlist items
+        '''
+        rows = []
+        for name in names:
+            if name not in self.state.playlist:
+                continue
+            self.content_index.forget(self.state.playlist.get(name).get('filename'))
+            self.state.remove_playlist_item(name)
+            self.search_index.remove(name)
+            row = self.playlist_model.row_of_name(name)
+            if row is not None:
+                rows.append(row)
+        self.playlist_model.remove_rows(rows)
 
     def audio_dropped(self, file_name, path):
         '''
-        User drags/drops an mp3 file into the playlist
+        User drags/drops an audio file into the playlist
 
         @param file_name: name of the file dragged into the playlist
         @param path: the path of the file dragged into the playlist
         '''
-        if not file_name.endswith('.mp3'):
-            print('Only mp3 files support dragging/dropping')
+        if not is_audio_file(file_name):
+            print('Only {} files support dragging/dropping'.format(
+                ', '.join(transcode.AUDIO_EXTENSIONS)))
             return
-        # move mp3 file into directory_path if not already in there
+        self.content_index.check(path, functools.partial(self.drop_checked.emit,
+                                                         file_name,
+                                                         path))
+
+    def add_dropped(self, file_name, path, duplicate):
+        '''
+        Add a dropped audio file to the playlist, unless its audio already is
+
+        @param file_name: name of the file dragged into the playlist
+        @param path: the path of the file dragged into the playlist
+        @param duplicate: path of the library file holding the same audio,
+                          None if there is none
+        '''
+        if duplicate is not None:
+            print('{} is already in the playlist: {}'.format(path, duplicate))
+            self.select_path(duplicate)
+            return
+        # move audio file into directory_path if not already in there
         if self.directory_path not in path:
             shutil.move(path, self.directory_path)
 
         new_path = os.path.join(self.directory_path, file_name)
-        name = file_name.split('.mp3')[0]
-        item = QStandardItem(self.icon, name)
-        item.setDropEnabled(False)
-
-        self.playlist_item.appendRow(item)
-        self.daze_data.get('Playlist')[name] = {'filename': new_path}
-        daze_state.save_state(self.daze_data)
+        name = track_name(new_path)
+        if self.playlist_model.name_of_path(new_path) is not None:
+            # the library scanner saw the file first
+            return
+        self.playlist_model.append_tracks([(name, new_path)])
+        self.state.set_playlist_item(name, {'filename': new_path})
+        self.prefetch_metadata([(name, new_path)])
 
     def callback(self,
                  index_qmodel_index,
@@ -208,37 +600,198 @@ class PlaylistTab(QWidget):
         '''
         User changes a playlist item's name
         '''
-        new_filename = (self.daze_data.get('Playlist')
-                                      .get(before_value)
-                                      .get('filename').replace(before_value,
-                                                               after_value))
-        os.rename((self.daze_data.get('Playlist')
-                                 .get(before_value)
-                                 .get('filename')), new_filename)
-
-        del self.daze_data.get('Playlist')[before_value]
-        self.daze_data.get('Playlist')[after_value] = {'filename': new_filename}
-        daze_state.save_state(self.daze_data)
+        new_filename = (self.state.playlist
+                                  .get(before_value)
+                                  .get('filename').replace(before_value,
+                                                           after_value))
+        os.rename((self.state.playlist
+                             .get(before_value)
+                             .get('filename')), new_filename)
+
+        self.state.rename_playlist_item(before_value,
+                                        after_value,
+                                        dict(self.state.playlist.get(before_value),
+                                             filename=new_filename))
+        self.playlist_model.set_path(index_qmodel_index.row(), new_filename)
+        self.search_index.rename(before_value, after_value, after_value)
+        if self.media_player is not None:
+            self.media_player.rename(before_value, after_value, new_filename)
+        self.prefetch_metadata([(after_value, new_filename)])
 
     def display_menu(self, position):
-        menu = QMenu('Menu', self)
-        play_action = QAction('Play', self)
-        play_action.setShortcut('Ctrl+P')
-        edit_action = QAction('Edit', self)
-        edit_action.setShortcut('Ctrl+E')
+        index = self.playlist.currentIndex()
+        name = index.data()
+        if name not in self.state.playlist:
+            # placeholder of an in-flight download
+            self.display_download_menu(index, position)
+            return
+        media_path = self.state.playlist.get(name).get('filename')
+        if not os.path.exists(media_path):
+            print('{} no longer exists'.format(media_path))
+            self.remove_track(name)
+            return
+
+        with tracing.span('display_menu'):
+            menu = QMenu('Menu', self)
+            play_action = QAction('Play', self)
+            play_action.setShortcut('Ctrl+P')
+            play_next_action = QAction('Play Next', self)
+            edit_action = QAction('Edit', self)
+            edit_action.setShortcut('Ctrl+E')
+
+            menu.addAction(play_action)
+            menu.addAction(play_next_action)
+            menu.addAction(edit_action)
 
-        media_path = (self.daze_data.get('Playlist')
-                                    .get(self.playlist.currentIndex().data())
-                                    .get('filename'))
+            play_action.triggered.connect(self.play_current)
+            play_next_action.triggered.connect(self.play_current_next)
+            edit_action.triggered.connect(self.edit_current)
+
+        # the dialogs of the actions are traced as they are built
+        menu.exec_(self.playlist.mapToGlobal(position))
+
+    def display_download_menu(self, index, position):
+        '''
+        Menu of the placeholder row of a queued download, to move it ahead
+        of the other downloads
+        '''
+        row = self.playlist_filter.mapToSource(index).row()
+        if row < 0:
+            return
+        job = self.download_manager.jobs.get(self.playlist_model.job_id(row))
+        if job is None or job.status != PENDING:
+            return
 
-        menu.addAction(play_action)
-        menu.addAction(edit_action)
+        menu = QMenu('Menu', self)
+        first_action = QAction('Download First', self)
+        play_next_action = QAction('Play Next', self)
 
-        media_player = MediaPlayer(self, self.playlist.currentIndex(), media_path)
-        edit_media = EditPlaylistItem(self, self.daze_data, self.playlist.currentIndex())
+        menu.addAction(first_action)
+        menu.addAction(play_next_action)
 
-        play_action.triggered.connect(media_player.show)
-        edit_action.triggered.connect(edit_media.show)
+        first_action.triggered.connect(
+            lambda: self.download_manager.prioritize(job.job_id))
+        play_next_action.triggered.connect(lambda: self.play_next(job))
 
         menu.exec_(self.playlist.mapToGlobal(position))
 
+    def play_next(self, job):
+        '''
+        Download a queued job first and play it once it is done
+        '''
+        self.play_when_ready.add(job.job_id)
+        self.download_manager.prioritize(job.job_id)
+
+    def prefetch_metadata(self, tracks):
+        '''
+        Fill the metadata cache, then the search index, and the content
+        index of playlist items in the background
+
+        @param tracks: list of (name, path) pairs
+        '''
+        names = {path: name for name, path in tracks}
+        self.content_index.prefetch(names)
+        self.metadata_cache.prefetch(names,
+                                     functools.partial(self.metadata_fetched,
+                                                       names))
+
+    def metadata_fetched(self, names, audio_metadata):
+        '''
+        Index the names and tags of playlist items, runs on a metadata cache
+        worker
+
+        @param names: dictionary of path -> playlist item name
+        @param audio_metadata: dictionary of path -> AudioMetadata
+        '''
+        for path, name in names.items():
+            # renamed or removed meanwhile
+            if name not in self.state.playlist:
+                continue
+            metadata = audio_metadata.get(path)
+            self.search_index.add(name, name, metadata and metadata.tags)
+        self.metadata_loaded.emit(audio_metadata)
+
+    def metadata_ready(self, audio_metadata):
+        '''
+        Show the durations of playlist items once they are known
+
+        @param audio_metadata: dictionary of path -> AudioMetadata
+        '''
+        self.playlist_model.set_durations({path: metadata.duration
+                                           for path, metadata in
+                                           audio_metadata.items()})
+        # newly indexed items may match the current search
+        if self.search_text.text():
+            self.filter_playlist(self.search_text.text())
+
+    def filter_playlist(self, query):
+        '''
+        Show only the playlist items matching the search query
+
+        @param query: text typed in the search box
+        '''
+        if query:
+            self.playlist_filter.set_filter(self.search_index.search(query))
+        else:
+            self.playlist_filter.set_filter(None)
+
+    def current_media(self):
+        '''
+        Return the name, path and AudioMetadata of the selected playlist item
+        '''
+        name = self.playlist.currentIndex().data()
+        media_path = self.state.playlist.get(name).get('filename')
+        return name, media_path, self.metadata_cache.get(media_path)
+
+    def media_duration(self, media_path):
+        '''
+        Return the duration in seconds of an audio file, from the metadata
+        cache
+        '''
+        return self.metadata_cache.get(media_path).duration
+
+    def show_media_player(self):
+        if self.media_player is None:
+            with tracing.span('MediaPlayer construction'):
+                # imported on first use, it pulls in QtMultimedia
+                from .media_player import MediaPlayer
+                self.media_player = MediaPlayer(self, self.media_duration)
+        self.media_player.show()
+        return self.media_player
+
+    def play_current(self):
+        '''
+        Play the playlist from the selected item on, as currently shown
+        '''
+        current = self.playlist.currentIndex().row()
+        tracks = []
+        for row in range(current, self.playlist_filter.rowCount()):
+            name = self.playlist_filter.index(row).data()
+            if name in self.state.playlist:
+                tracks.append((name, self.state.playlist[name].get('filename')))
+        self.show_media_player().play_queue(tracks)
+
+    def play_track_next(self, name):
+        '''
+        Queue a playlist item right after the track playing
+
+        @param name: name of the playlist item
+        '''
+        self.show_media_player().play_next(name,
+                                           self.state.playlist.get(name).get('filename'))
+
+    def play_current_next(self):
+        self.play_track_next(self.playlist.currentIndex().data())
+
+    def edit_current(self):
+        '''
+        Edit the selected playlist item
+        '''
+        with tracing.span('EditPlaylistItem construction'):
+            if self.edit_media is None:
+                # imported on first use, it pulls in QtMultimedia and numpy
+                from .edit_playlist import EditPlaylistItem
+                self.edit_media = EditPlaylistItem(self)
+            self.edit_media.load(*self.current_media())
+        self.edit_media.show()
+
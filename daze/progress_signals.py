@@ -0,0 +1,34 @@
+'''
+Qt delivery of progress events
+'''
+from .utils import progress_events
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+class ProgressSignals(QObject):
+    '''
+    Re-emit the events of an EventBus as Qt signals, which are delivered on
+    the thread of the receiving object (the GUI thread for widgets)
+    '''
+    queued = pyqtSignal(object)
+    progress = pyqtSignal(object)
+    postprocessing = pyqtSignal(object)
+    done = pyqtSignal(object)
+    error = pyqtSignal(object)
+
+    def __init__(self, bus, parent=None):
+        '''
+        @param bus: EventBus to follow
+        @param parent: parent QObject
+        '''
+        super().__init__(parent)
+        self._signals = {progress_events.QUEUED: self.queued,
+                         progress_events.BYTES: self.progress,
+                         progress_events.POSTPROCESSING: self.postprocessing,
+                         progress_events.DONE: self.done,
+                         progress_events.ERROR: self.error}
+        bus.subscribe(self.dispatch)
+
+    def dispatch(self, event):
+        self._signals[event.kind].emit(event)
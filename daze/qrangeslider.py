@@ -32,6 +32,9 @@ QRangeSlider > QSplitter::handle:pressed {
 """
 
 
+WAVEFORM_COLOR = QtGui.QColor(150, 200, 150)
+
+
 def scale(val, src, dst):
     return int(((val - src[0]) / float(src[1] - src[0])) * (dst[1] - dst[0]) + dst[0])
 
@@ -275,6 +278,35 @@ class QRangeSlider(QtWidgets.QWidget, UIForm):
         if s >= self.min() and e <= self.max():
             self.setRange(s, e)
 
+    def waveform(self):
+        return getattr(self, '__waveform', None)
+
+    def setWaveform(self, peaks):
+        '''
+        Set the waveform peaks (utils.waveform.Peaks) painted behind the
+        slider, None to clear them. Head, span and tail backgrounds need to be
+        translucent for the waveform to show through
+        '''
+        setattr(self, '__waveform', peaks)
+        self.update()
+
+    def paintEvent(self, event):
+        super(QRangeSlider, self).paintEvent(event)
+        peaks = self.waveform()
+        if peaks is None:
+            return
+
+        minimums, maximums = peaks.columns(self.width())
+        middle = self.height() / 2.0
+        lines = [QtCore.QLineF(x, middle - maximum * middle,
+                               x, middle - minimum * middle)
+                 for x, (minimum, maximum) in enumerate(zip(minimums, maximums))]
+        qp = QtGui.QPainter()
+        qp.begin(self)
+        qp.setPen(WAVEFORM_COLOR)
+        qp.drawLines(lines)
+        qp.end()
+
     def setBackgroundStyle(self, style):
         self._tail.setStyleSheet(style)
         self._head.setStyleSheet(style)
@@ -0,0 +1,68 @@
+'''
+Global download bandwidth limiter
+
+Every active download gets an equal share of the global rate, enforced by a
+token bucket of its own that is refilled at that share. Shares are worked
+out again whenever a download starts or ends, so the sum never exceeds the
+global rate. Downloads are slowed down by sleeping in their progress hook,
+on their own thread
+'''
+import threading
+import time
+
+
+# seconds of a download's share it may burst
+BURST_SECONDS = 1.0
+
+
+class BandwidthLimiter(object):
+    def __init__(self, rate=None):
+        '''
+        @param rate: global limit in bytes per second, unlimited if None or 0
+        '''
+        self.rate = rate
+        self._lock = threading.Lock()
+        # job id -> [tokens, time of the last refill, bytes seen], bytes
+        # seen is None until the first report of the download
+        self._buckets = {}
+
+    def register(self, job_id):
+        '''
+        Count a download in the shares of the rate. Its first report is
+        taken as where it starts from, a resumed download reports the bytes
+        of its partial file first
+        '''
+        with self._lock:
+            self._buckets[job_id] = [0.0, time.monotonic(), None]
+
+    def unregister(self, job_id):
+        with self._lock:
+            self._buckets.pop(job_id, None)
+
+    def throttle(self, job_id, downloaded_bytes):
+        '''
+        Wait for as long as the download is ahead of its share of the rate
+
+        @param job_id: id of the download, registered
+        @param downloaded_bytes: total bytes downloaded so far
+        '''
+        with self._lock:
+            bucket = self._buckets.get(job_id)
+            if bucket is None:
+                return
+            seen, bucket[2] = bucket[2], downloaded_bytes
+            if seen is None:
+                return
+            delta = max(0, downloaded_bytes - seen)
+            if not self.rate:
+                return
+
+            share = float(self.rate) / len(self._buckets)
+            now = time.monotonic()
+            bucket[0] = min(share * BURST_SECONDS,
+                            bucket[0] + (now - bucket[1]) * share) - delta
+            bucket[1] = now
+            wait = -bucket[0] / share if bucket[0] < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,215 @@
+'''
+Content addressed index of the library, to detect duplicate audio files
+
+Files are compared on their audio payload, ID3 tags excluded, so the same
+audio tagged differently is still a duplicate. Hashing is lazy: the payload
+size of every library file is recorded, which only reads its first and last
+bytes, and payloads are only hashed when another file has the same payload
+size. Sizes and digests are kept in daze state keyed by path, size and mtime,
+an unchanged file is never read again
+'''
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+from . import daze_state
+from .mp3_trim import id3v2_size, ID3V1_SIZE
+
+
+DEFAULT_WORKERS = 4
+CHUNK_SIZE = 1 << 20
+ID3V2_HEADER_SIZE = 10
+
+
+def payload_range(handle, size):
+    '''
+    Return the start and end offsets of the audio of a file, without its
+    leading ID3v2 and trailing ID3v1 tags
+
+    @param handle: file opened in binary mode
+    @param size: size of the file
+    '''
+    start = min(size, id3v2_size(handle.read(ID3V2_HEADER_SIZE)))
+    end = size
+    if end - start >= ID3V1_SIZE:
+        handle.seek(end - ID3V1_SIZE)
+        if handle.read(3) == b'TAG':
+            end -= ID3V1_SIZE
+    return start, end
+
+
+def digest(handle, start, end):
+    '''
+    Hash a range of a file in chunked reads
+    '''
+    hasher = hashlib.blake2b(digest_size=20)
+    handle.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = handle.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        remaining -= len(chunk)
+    return hasher.hexdigest()
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class ContentIndex(object):
+    def __init__(self, workers=DEFAULT_WORKERS):
+        '''
+        @param workers: number of threads reading files in the background
+        '''
+        # path -> [size, mtime, payload size, digest or None]
+        self._entries = {}
+        # payload size -> set of paths of library files
+        self._library = {}
+        self._lock = threading.Lock()
+        # held by the worker loading every entry, the others wait for it
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def prefetch(self, paths):
+        '''
+        Add files to the library in the background
+
+        @param paths: paths of the audio files of the library
+        @return: concurrent.futures.Future
+        '''
+        return self._executor.submit(self._add, list(paths))
+
+    def forget(self, path):
+        '''
+        Remove a file from the library
+        '''
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._library.get(entry[2], set()).discard(path)
+
+    def check(self, path, callback):
+        '''
+        Look for a duplicate of a file in the background
+
+        @param path: path of the audio file
+        @param callback: called from a worker thread with the path of the
+                         library file holding the same audio, None if none
+        @return: concurrent.futures.Future
+        '''
+        return self._executor.submit(self._check, path, callback)
+
+    def find_duplicate(self, path):
+        '''
+        Return the path of a library file holding the same audio as a file
+
+        @param path: path of the audio file, in the library or not
+        @return: path of the duplicate, None if there is none
+        @raise OSError: the file can't be read
+        '''
+        self._load()
+        unsaved = []
+        try:
+            payload_size = self._entry(path, unsaved)[2]
+            with self._lock:
+                candidates = sorted(self._library.get(payload_size, set()) - {path})
+            if not candidates:
+                return None
+
+            file_digest = self._digest(path, unsaved)
+            for candidate in candidates:
+                try:
+                    if (self._entry(candidate, unsaved)[2] == payload_size and
+                            self._digest(candidate, unsaved) == file_digest):
+                        return candidate
+                except OSError:
+                    # gone since it was indexed
+                    self.forget(candidate)
+                    daze_state.remove_content_hashes([candidate])
+            return None
+        finally:
+            daze_state.save_content_hashes(unsaved)
+
+    def _check(self, path, callback):
+        try:
+            duplicate = self.find_duplicate(path)
+        except OSError as e:
+            print('Unable to look for duplicates of {}'.format(path))
+            print(e)
+            duplicate = None
+        callback(duplicate)
+
+    def _add(self, paths):
+        self._load()
+        unsaved = []
+        for path in paths:
+            try:
+                payload_size = self._entry(path, unsaved)[2]
+            except OSError as e:
+                print('Unable to index {}'.format(path))
+                print(e)
+                continue
+            with self._lock:
+                self._library.setdefault(payload_size, set()).add(path)
+        daze_state.save_content_hashes(unsaved)
+
+    def _load(self):
+        '''
+        Load every stored entry into memory, once. The stored files count as
+        the library until the prefetch of the library is done, the ones
+        gone since are forgotten when they come up as candidates
+        '''
+        with self._load_lock:
+            if self._loaded:
+                return
+            stored = daze_state.load_content_hashes()
+            with self._lock:
+                for path, entry in stored.items():
+                    entry = self._entries.setdefault(path, list(entry))
+                    self._library.setdefault(entry[2], set()).add(path)
+            self._loaded = True
+
+    def _entry(self, path, unsaved):
+        '''
+        Return the entry of a file, reading its payload range if it is not
+        known or the file changed
+
+        @param unsaved: list the entry is appended to if it must be saved
+        '''
+        key = _file_key(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and tuple(entry[:2]) == key:
+            return entry
+
+        with open(path, 'rb') as handle:
+            start, end = payload_range(handle, key[0])
+        entry = [key[0], key[1], end - start, None]
+        with self._lock:
+            previous = self._entries.get(path)
+            if previous is not None and previous[2] != entry[2]:
+                # the payload size changed, so does its library bucket
+                paths = self._library.get(previous[2], set())
+                if path in paths:
+                    paths.discard(path)
+                    self._library.setdefault(entry[2], set()).add(path)
+            self._entries[path] = entry
+        unsaved.append([path] + entry)
+        return entry
+
+    def _digest(self, path, unsaved):
+        '''
+        Return the digest of the payload of a file, hashing it if needed
+        '''
+        entry = self._entry(path, unsaved)
+        if entry[3] is None:
+            with open(path, 'rb') as handle:
+                start, end = payload_range(handle, entry[0])
+                entry[3] = digest(handle, start, end)
+            unsaved.append([path] + entry)
+        return entry[3]
@@ -1,36 +1,557 @@
 '''
 The loading and saving of daze state
+
+State lives in an indexed SQLite database in WAL mode so that every change
+only touches the rows it affects. Daze data from the older pickle file is
+migrated into the database the first time it is opened
 '''
+import json
 import os
 import pickle
+import sqlite3
+import threading
 
+from . import tracing
 from ..errors import DazeStateException
 
 
-DAZE_STORAGE = '~/.daze_data.pkl'
+DAZE_STORAGE = '~/.daze_data.db'
+LEGACY_STORAGE = '~/.daze_data.pkl'
+PAGE_SIZE = 1000
 
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS playlist (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    filename TEXT NOT NULL,
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS playlist_filename ON playlist (filename);
+CREATE INDEX IF NOT EXISTS playlist_source ON playlist (
+    json_extract(metadata, '$.extractor'),
+    json_extract(metadata, '$.video_id')
+);
+CREATE TABLE IF NOT EXISTS preferences (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sections (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS audio_metadata (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    duration REAL,
+    bitrate INTEGER,
+    sample_rate INTEGER,
+    channels INTEGER,
+    tags TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS content_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    payload_size INTEGER NOT NULL,
+    digest TEXT
+);
+CREATE TABLE IF NOT EXISTS imports (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    link TEXT NOT NULL,
+    dest_dir TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS import_entries (
+    import_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    ie_key TEXT,
+    video_id TEXT,
+    title TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'pending',
+    PRIMARY KEY (import_id, position)
+);
+CREATE TABLE IF NOT EXISTS downloads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    link TEXT NOT NULL,
+    dest_dir TEXT NOT NULL,
+    ie_key TEXT,
+    extractor TEXT,
+    video_id TEXT,
+    import_id INTEGER,
+    partial TEXT NOT NULL DEFAULT '',
+    downloaded INTEGER NOT NULL DEFAULT 0
+);
+'''
 
-def save_state(new_data):
+_local = threading.local()
+
+
+def _connection():
     '''
-    Save daze data into appropriate location
+    Return the database connection of the calling thread, creating the
+    database (and migrating the legacy pickle file) on first use
     '''
-    try:
-        daze_data = load_state()
-    except DazeStateException:
-        daze_data = new_data
-    else:
-        daze_data.update(new_data)
+    path = os.path.expanduser(DAZE_STORAGE)
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path in connections:
+        return connections[path]
 
-    with open(os.path.expanduser(DAZE_STORAGE), 'wb') as handle:
-        pickle.dump(daze_data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    is_new = not os.path.exists(path)
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    with connection:
+        connection.executescript(SCHEMA)
+    connections[path] = connection
 
+    if is_new:
+        _migrate_legacy_state(connection)
+    return connection
 
-def load_state():
+
+def _migrate_legacy_state(connection):
+    '''
+    Import the pickled daze data, if there is any, into a new database
+    '''
+    legacy_path = os.path.expanduser(LEGACY_STORAGE)
     try:
-        with open(os.path.expanduser(DAZE_STORAGE), 'rb') as handle:
+        with open(legacy_path, 'rb') as handle:
             daze_data = pickle.load(handle)
-    except OSError as e:
-        raise DazeStateException('No daze data to load!')
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return
+
+    _save_state(connection, daze_data)
+    os.rename(legacy_path, '{}.migrated'.format(legacy_path))
+
+
+def _split_metadata(metadata):
+    metadata = dict(metadata)
+    filename = metadata.pop('filename', '')
+    return filename, json.dumps(metadata)
+
+
+def _join_metadata(filename, metadata):
+    metadata = json.loads(metadata)
+    metadata['filename'] = filename
+    return metadata
+
+
+def _save_playlist_item(connection, name, metadata):
+    filename, extra = _split_metadata(metadata)
+    # update in place rather than INSERT OR REPLACE, which would move the
+    # item to the end of the playlist
+    cursor = connection.execute('UPDATE playlist SET filename = ?, metadata = ? '
+                                'WHERE name = ?', (filename, extra, name))
+    if cursor.rowcount == 0:
+        connection.execute('INSERT INTO playlist (name, filename, metadata) '
+                           'VALUES (?, ?, ?)', (name, filename, extra))
+
+
+def _save_state(connection, new_data):
+    with connection:
+        for key, value in new_data.items():
+            if key == 'Playlist':
+                connection.execute('CREATE TEMP TABLE IF NOT EXISTS '
+                                   'kept (name TEXT PRIMARY KEY)')
+                connection.execute('DELETE FROM kept')
+                connection.executemany('INSERT OR IGNORE INTO kept VALUES (?)',
+                                       ((name,) for name in value))
+                connection.execute('DELETE FROM playlist '
+                                   'WHERE name NOT IN (SELECT name FROM kept)')
+                for name, metadata in value.items():
+                    _save_playlist_item(connection, name, metadata)
+            elif key == 'Preferences':
+                connection.executemany('INSERT OR REPLACE INTO preferences '
+                                       'VALUES (?, ?)',
+                                       ((pref, json.dumps(pref_value))
+                                        for pref, pref_value in value.items()))
+            else:
+                connection.execute('INSERT OR REPLACE INTO sections '
+                                   'VALUES (?, ?)', (key, json.dumps(value)))
+
+
+@tracing.traced('daze_state.save_state')
+def save_state(new_data):
+    '''
+    Save daze data into appropriate location. The top level keys given
+    replace the stored ones, prefer the per row functions below for single
+    changes
+
+    @param new_data: dictionary of daze related data
+    '''
+    _save_state(_connection(), new_data)
+
+
+def save_playlist_item(name, metadata):
+    '''
+    Insert or update a single playlist item
+
+    @param name: name of the playlist item
+    @param metadata: dictionary of metadata about the audio file
+    '''
+    connection = _connection()
+    with connection:
+        _save_playlist_item(connection, name, metadata)
+
+
+def save_playlist_items(items):
+    '''
+    Insert or update playlist items in a single transaction
+
+    @param items: iterable of (name, metadata) pairs
+    '''
+    connection = _connection()
+    with connection:
+        for name, metadata in items:
+            _save_playlist_item(connection, name, metadata)
+
+
+def _rename_playlist_item(connection, before_name, after_name, metadata):
+    filename, extra = _split_metadata(metadata)
+    # the new name replaces any item already using it
+    connection.execute('DELETE FROM playlist WHERE name = ?', (after_name,))
+    connection.execute('UPDATE playlist SET name = ?, filename = ?, '
+                       'metadata = ? WHERE name = ?',
+                       (after_name, filename, extra, before_name))
+
+
+def rename_playlist_item(before_name, after_name, metadata):
+    '''
+    Rename a playlist item, keeping its position in the playlist
+
+    @param before_name: current name of the playlist item
+    @param after_name: new name of the playlist item
+    @param metadata: dictionary of metadata about the renamed audio file
+    '''
+    connection = _connection()
+    with connection:
+        _rename_playlist_item(connection, before_name, after_name, metadata)
+
+
+def remove_playlist_item(name):
+    '''
+    Remove a single playlist item
+    '''
+    connection = _connection()
+    with connection:
+        connection.execute('DELETE FROM playlist WHERE name = ?', (name,))
+
+
+def save_preference(key, value):
+    '''
+    Save a single preference
+    '''
+    connection = _connection()
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO preferences VALUES (?, ?)',
+                           (key, json.dumps(value)))
+
+
+@tracing.traced('daze_state.apply_changes')
+def apply_changes(removed=(), renamed=(), saved=(), preferences=(),
+                  sections=()):
+    '''
+    Apply a batch of changes in a single transaction, in the order removals,
+    renames, then inserts/updates
+
+    @param removed: iterable of playlist item names
+    @param renamed: iterable of (before_name, after_name, metadata) tuples
+    @param saved: iterable of (name, metadata) pairs
+    @param preferences: iterable of (key, value) pairs
+    @param sections: iterable of (key, value) pairs of other top level data
+    '''
+    connection = _connection()
+    with connection:
+        connection.executemany('DELETE FROM playlist WHERE name = ?',
+                               ((name,) for name in removed))
+        for before_name, after_name, metadata in renamed:
+            _rename_playlist_item(connection, before_name, after_name, metadata)
+        for name, metadata in saved:
+            _save_playlist_item(connection, name, metadata)
+        connection.executemany('INSERT OR REPLACE INTO preferences '
+                               'VALUES (?, ?)',
+                               ((key, json.dumps(value))
+                                for key, value in preferences))
+        connection.executemany('INSERT OR REPLACE INTO sections VALUES (?, ?)',
+                               ((key, json.dumps(value))
+                                for key, value in sections))
+
+
+def load_audio_metadata(path=None):
+    '''
+    Load cached audio metadata
+
+    @param path: path of a single audio file, all cached files if None
+    @return: dictionary of path -> (size, mtime, metadata dictionary)
+    '''
+    query = ('SELECT path, size, mtime, duration, bitrate, sample_rate, '
+             'channels, tags FROM audio_metadata')
+    if path is None:
+        rows = _connection().execute(query)
     else:
-        return daze_data
+        rows = _connection().execute(query + ' WHERE path = ?', (path,))
+
+    return {path: (size, mtime, {'duration': duration,
+                                 'bitrate': bitrate,
+                                 'sample_rate': sample_rate,
+                                 'channels': channels,
+                                 'tags': json.loads(tags)})
+            for (path, size, mtime, duration, bitrate, sample_rate, channels,
+                 tags) in rows}
+
+
+def save_audio_metadata(entries):
+    '''
+    Save audio metadata in a single transaction
+
+    @param entries: iterable of (path, size, mtime, metadata dictionary)
+    '''
+    connection = _connection()
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO audio_metadata '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               ((path, size, mtime,
+                                 metadata.get('duration'),
+                                 metadata.get('bitrate'),
+                                 metadata.get('sample_rate'),
+                                 metadata.get('channels'),
+                                 json.dumps(metadata.get('tags', {})))
+                                for path, size, mtime, metadata in entries))
+
+
+def find_source(extractor, video_id):
+    '''
+    Return the name of the playlist item downloaded from a video
+
+    @param extractor: youtube-dl extractor of the video
+    @param video_id: id of the video
+    @return: name of the playlist item, None if there is none
+    '''
+    row = _connection().execute("SELECT name FROM playlist "
+                                "WHERE json_extract(metadata, '$.extractor') = ? "
+                                "AND json_extract(metadata, '$.video_id') = ?",
+                                (extractor, video_id)).fetchone()
+    return row[0] if row else None
+
+
+def load_content_hashes():
+    '''
+    Load the content hashes of audio files
+
+    @return: dictionary of path -> (size, mtime, payload size, digest or None)
+    '''
+    return {path: (size, mtime, payload_size, digest)
+            for path, size, mtime, payload_size, digest in
+            _connection().execute('SELECT path, size, mtime, payload_size, '
+                                  'digest FROM content_hashes')}
+
+
+def save_content_hashes(entries):
+    '''
+    Save content hashes in a single transaction
+
+    @param entries: iterable of (path, size, mtime, payload size, digest)
+    '''
+    connection = _connection()
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO content_hashes '
+                               'VALUES (?, ?, ?, ?, ?)', entries)
+
+
+def remove_content_hashes(paths):
+    '''
+    Forget the content hashes of audio files in a single transaction
+    '''
+    connection = _connection()
+    with connection:
+        connection.executemany('DELETE FROM content_hashes WHERE path = ?',
+                               ((path,) for path in paths))
+
+
+def save_import(link, dest_dir, title, entries):
+    '''
+    Save a playlist import and its entries in a single transaction
+
+    @param link: link of the playlist
+    @param dest_dir: destination directory of the downloaded audio files
+    @param title: title of the playlist
+    @param entries: list of dictionaries with the url, ie_key, video_id and
+                    title of every entry
+    @return: id of the import
+    '''
+    connection = _connection()
+    with connection:
+        import_id = connection.execute('INSERT INTO imports (link, dest_dir, title) '
+                                       'VALUES (?, ?, ?)',
+                                       (link, dest_dir, title)).lastrowid
+        connection.executemany('INSERT INTO import_entries (import_id, position, '
+                               'url, ie_key, video_id, title) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               ((import_id, position, entry['url'],
+                                 entry.get('ie_key'), entry.get('video_id'),
+                                 entry.get('title') or '')
+                                for position, entry in enumerate(entries)))
+    return import_id
+
+
+def set_import_entry_status(import_id, position, status):
+    '''
+    Record how the download of a playlist import entry ended
+    '''
+    connection = _connection()
+    with connection:
+        connection.execute('UPDATE import_entries SET status = ? '
+                           'WHERE import_id = ? AND position = ?',
+                           (status, import_id, position))
+
+
+def remove_import(import_id):
+    '''
+    Forget a playlist import and its entries
+    '''
+    connection = _connection()
+    with connection:
+        connection.execute('DELETE FROM import_entries WHERE import_id = ?',
+                           (import_id,))
+        connection.execute('DELETE FROM imports WHERE id = ?', (import_id,))
+
+
+def load_imports():
+    '''
+    Load the playlist imports
+
+    @return: list of (id, link, dest_dir, title, entries) tuples, entries
+             being a list of dictionaries with the position, url, ie_key,
+             video_id, title and status of every entry
+    '''
+    connection = _connection()
+    imports = []
+    for import_id, link, dest_dir, title in connection.execute(
+            'SELECT id, link, dest_dir, title FROM imports ORDER BY id').fetchall():
+        entries = [{'position': position,
+                    'url': url,
+                    'ie_key': ie_key,
+                    'video_id': video_id,
+                    'title': entry_title,
+                    'status': status}
+                   for position, url, ie_key, video_id, entry_title, status in
+                   connection.execute('SELECT position, url, ie_key, video_id, '
+                                      'title, status FROM import_entries '
+                                      'WHERE import_id = ? ORDER BY position',
+                                      (import_id,))]
+        imports.append((import_id, link, dest_dir, title, entries))
+    return imports
+
+
+def save_download(link, dest_dir, ie_key=None, source=None, import_id=None):
+    '''
+    Record a download that has yet to finish
+
+    @param link: link being downloaded
+    @param dest_dir: destination directory of the downloaded audio file
+    @param ie_key: key of the extractor handling the link, if known
+    @param source: (extractor, video id) the link points to, if known
+    @param import_id: id of the playlist import the download is part of
+    @return: id of the download
+    '''
+    extractor, video_id = source or (None, None)
+    connection = _connection()
+    with connection:
+        return connection.execute('INSERT INTO downloads (link, dest_dir, ie_key, '
+                                  'extractor, video_id, import_id) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)',
+                                  (link, dest_dir, ie_key, extractor, video_id,
+                                   import_id)).lastrowid
+
+
+def save_download_progress(download_id, partial, downloaded):
+    '''
+    Record the partial file of a download and how much of it was downloaded
+    '''
+    connection = _connection()
+    with connection:
+        connection.execute('UPDATE downloads SET partial = ?, downloaded = ? '
+                           'WHERE id = ?', (partial, downloaded, download_id))
+
+
+def remove_download(download_id):
+    '''
+    Forget a download that finished or was given up on
+    '''
+    connection = _connection()
+    with connection:
+        connection.execute('DELETE FROM downloads WHERE id = ?', (download_id,))
+
+
+def load_downloads():
+    '''
+    Load the downloads that have yet to finish
+
+    @return: list of dictionaries with the id, link, dest_dir, ie_key,
+             source, import_id, partial and downloaded bytes of every download
+    '''
+    return [{'id': download_id,
+             'link': link,
+             'dest_dir': dest_dir,
+             'ie_key': ie_key,
+             'source': (extractor, video_id) if extractor and video_id else None,
+             'import_id': import_id,
+             'partial': partial,
+             'downloaded': downloaded}
+            for (download_id, link, dest_dir, ie_key, extractor, video_id,
+                 import_id, partial, downloaded) in
+            _connection().execute('SELECT id, link, dest_dir, ie_key, extractor, '
+                                  'video_id, import_id, partial, downloaded '
+                                  'FROM downloads ORDER BY id')]
+
+
+def iter_playlist(page_size=PAGE_SIZE):
+    '''
+    Yield the playlist in pages, in playlist order, so it can be paged in
+    rather than loaded all at once
+
+    @param page_size: number of playlist items per page
+    @return: generator of lists of (name, metadata) pairs
+    '''
+    connection = _connection()
+    last_id = 0
+    while True:
+        rows = connection.execute('SELECT id, name, filename, metadata '
+                                  'FROM playlist WHERE id > ? '
+                                  'ORDER BY id LIMIT ?',
+                                  (last_id, page_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [(name, _join_metadata(filename, metadata))
+               for _, name, filename, metadata in rows]
+
+
+@tracing.traced('daze_state.load_state')
+def load_state(playlist=True):
+    '''
+    Load daze data
+
+    @param playlist: whether to include the playlist, which can instead be
+                     paged in through iter_playlist
+    @return: dictionary of daze related data
+    '''
+    connection = _connection()
+    preferences = connection.execute('SELECT key, value '
+                                     'FROM preferences').fetchall()
+    if not preferences:
+        raise DazeStateException('No daze data to load!')
 
+    daze_data = {key: json.loads(value) for key, value in
+                 connection.execute('SELECT key, value FROM sections')}
+    daze_data['Preferences'] = {key: json.loads(value)
+                                for key, value in preferences}
+    if playlist:
+        daze_data['Playlist'] = {name: metadata
+                                 for page in iter_playlist()
+                                 for name, metadata in page}
+    return daze_data
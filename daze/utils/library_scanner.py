@@ -0,0 +1,331 @@
+'''
+Library scanner
+
+Keeps the playlist in sync with the audio files of the daze directory. The
+directory is scanned once in the background, stat calls batched over a
+thread pool, and then followed through inotify (or by polling it where
+inotify is unavailable). Only the differences are reported, as
+LibraryChanges, from the scanner thread
+'''
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+
+from .transcode import AUDIO_EXTENSIONS
+
+
+DEFAULT_WORKERS = 8
+STAT_BATCH_SIZE = 512
+POLL_INTERVAL = 5
+# events are coalesced until the directory has been quiet for this long
+SETTLE_DELAY = 0.5
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 1 << 16
+
+LibraryChanges = collections.namedtuple('LibraryChanges', ['added',
+                                                           'removed',
+                                                           'renamed'])
+
+
+def is_audio_file(name):
+    '''
+    Whether a file name is one of a track, hidden (temporary) files excluded
+    '''
+    return (not name.startswith('.') and
+            os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS)
+
+
+def track_name(path):
+    '''
+    Return the playlist item name of an audio file
+    '''
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _stat_batch(entries):
+    found = {}
+    for entry in entries:
+        try:
+            if entry.is_file():
+                stat = entry.stat()
+                found[entry.path] = (stat.st_size, stat.st_mtime)
+        except OSError:
+            # deleted while scanning
+            pass
+    return found
+
+
+def scan(directory, executor):
+    '''
+    Find the audio files of a directory
+
+    @param directory: path of the directory, not descended into
+    @param executor: executor running the batches of stat calls
+    @return: dictionary of path -> (size, mtime)
+    '''
+    try:
+        with os.scandir(directory) as iterator:
+            entries = [entry for entry in iterator if is_audio_file(entry.name)]
+    except OSError:
+        return {}
+
+    batches = [entries[i:i + STAT_BATCH_SIZE]
+               for i in range(0, len(entries), STAT_BATCH_SIZE)]
+    snapshot = {}
+    for found in executor.map(_stat_batch, batches):
+        snapshot.update(found)
+    return snapshot
+
+
+def diff(before, after):
+    '''
+    Compare two snapshots of a directory. A removed and an added file with
+    the same size and mtime, and no other file sharing them, are a rename
+
+    @return: LibraryChanges
+    '''
+    added = {path: key for path, key in after.items() if path not in before}
+    removed = {path: key for path, key in before.items() if path not in after}
+
+    renamed = []
+    removed_keys = collections.Counter(removed.values())
+    added_keys = collections.Counter(added.values())
+    added_by_key = {key: path for path, key in added.items()}
+    for path, key in list(removed.items()):
+        if key is not None and removed_keys[key] == 1 and added_keys.get(key) == 1:
+            renamed.append((path, added_by_key[key]))
+            del removed[path]
+            del added[added_by_key[key]]
+    return LibraryChanges(sorted(added), sorted(removed), renamed)
+
+
+class Inotify(object):
+    '''
+    Minimal inotify binding of a single directory watch
+    '''
+    _libc = None
+
+    def __init__(self, directory):
+        '''
+        @raise OSError: inotify is unavailable or the directory can't be
+                        watched
+        '''
+        if Inotify._libc is None:
+            Inotify._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                        use_errno=True)
+        libc = Inotify._libc
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is unavailable')
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        watch = libc.inotify_add_watch(self.fd,
+                                       os.fsencode(directory),
+                                       WATCH_MASK)
+        if watch < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'Unable to watch {}'.format(directory))
+
+    def read(self):
+        '''
+        Return the pending events as (mask, cookie, name) tuples
+        '''
+        try:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            _, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryScanner(object):
+    def __init__(self, directory, known, callback,
+                 workers=DEFAULT_WORKERS, poll_interval=POLL_INTERVAL):
+        '''
+        @param directory: path of the directory to follow
+        @param known: paths of the tracks already in the playlist, those
+                      outside of the directory are ignored
+        @param callback: called from the scanner thread with LibraryChanges
+        @param workers: number of threads stat-ing files during scans
+        @param poll_interval: seconds between scans when inotify is
+                              unavailable
+        '''
+        self.directory = directory
+        self.callback = callback
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._known = known
+        self._snapshot = {}
+        self._stopped = threading.Event()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop following the directory, changes are no longer reported
+        '''
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except OSError:
+            # the scanner thread is gone
+            pass
+        os.close(self._wakeup_write)
+
+    def _report(self, changes):
+        if (changes.added or changes.removed or changes.renamed) and \
+                not self._stopped.is_set():
+            self.callback(changes)
+
+    def _rescan(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            snapshot = scan(self.directory, executor)
+        changes = diff(self._snapshot, snapshot)
+        self._snapshot = snapshot
+        return changes
+
+    def _run(self):
+        try:
+            # watch before scanning, so nothing changing during the scan is
+            # missed
+            try:
+                watcher = Inotify(self.directory)
+            except OSError as e:
+                print('Polling {}, unable to watch it'.format(self.directory))
+                print(e)
+                watcher = None
+
+            directory = os.path.abspath(self.directory)
+            self._snapshot = dict.fromkeys(
+                path for path in self._known
+                if os.path.dirname(os.path.abspath(path)) == directory)
+            self._report(self._rescan())
+            if watcher is None:
+                self._poll()
+            else:
+                try:
+                    self._watch(watcher)
+                finally:
+                    watcher.close()
+        finally:
+            os.close(self._wakeup_read)
+
+    def _poll(self):
+        while not self._stopped.wait(self.poll_interval):
+            self._report(self._rescan())
+
+    def _watch(self, watcher):
+        # names touched and (before, after) moves since the last report
+        touched = set()
+        moves = []
+        moved_from = {}
+        rescan = False
+        while not self._stopped.is_set():
+            pending = touched or moves or moved_from or rescan
+            readable, _, _ = select.select([watcher.fd, self._wakeup_read], [], [],
+                                           SETTLE_DELAY if pending else None)
+            if self._wakeup_read in readable:
+                return
+            if readable:
+                for mask, cookie, name in watcher.read():
+                    if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                        rescan = True
+                    elif mask & IN_ISDIR or not name:
+                        continue
+                    elif mask & IN_MOVED_FROM:
+                        moved_from[cookie] = name
+                    elif mask & IN_MOVED_TO and cookie in moved_from:
+                        moves.append((moved_from.pop(cookie), name))
+                    else:
+                        touched.add(name)
+                continue
+
+            # settled
+            if rescan:
+                changes = self._rescan()
+            else:
+                # a move whose other half is outside the directory is a
+                # deletion or a creation
+                touched.update(moved_from.values())
+                changes = self._apply(touched, moves)
+            touched, moves, moved_from, rescan = set(), [], {}, False
+            self._report(changes)
+
+    def _apply(self, names, moves):
+        '''
+        Update the snapshot from the current state of the touched files
+        '''
+        renamed = []
+        for before_name, after_name in moves:
+            before = os.path.join(self.directory, before_name)
+            after = os.path.join(self.directory, after_name)
+            key = self._stat(after)
+            if (before in self._snapshot and after not in self._snapshot and
+                    key is not None and not os.path.exists(before)):
+                del self._snapshot[before]
+                self._snapshot[after] = key
+                renamed.append((before, after))
+            else:
+                names.update((before_name, after_name))
+
+        added = []
+        removed = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            key = self._stat(path)
+            if key is None and path in self._snapshot:
+                del self._snapshot[path]
+                removed.append(path)
+            elif key is not None:
+                if path not in self._snapshot:
+                    added.append(path)
+                self._snapshot[path] = key
+        return LibraryChanges(sorted(added), sorted(removed), renamed)
+
+    @staticmethod
+    def _stat(path):
+        '''
+        Return the (size, mtime) of a track, None if it is not one
+        '''
+        if not is_audio_file(os.path.basename(path)):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
@@ -0,0 +1,158 @@
+'''
+Persistent cache of audio metadata (duration, bitrate, sample rate, channels
+and tags), stored alongside daze state. Entries are keyed by path, size and
+mtime so that a file that changed is probed again automatically
+'''
+import collections
+import concurrent.futures
+import os
+import threading
+
+import mutagen
+
+from . import daze_state, tracing
+
+
+AudioMetadata = collections.namedtuple('AudioMetadata', ['duration',
+                                                         'bitrate',
+                                                         'sample_rate',
+                                                         'channels',
+                                                         'tags'])
+
+DEFAULT_WORKERS = 2
+
+
+def probe(path):
+    '''
+    Read the metadata of an audio file
+
+    @param path: path of the audio file
+    @return: AudioMetadata
+    '''
+    with tracing.span('mutagen probe', path=path):
+        audio = mutagen.File(path, easy=True)
+    if audio is None:
+        raise mutagen.MutagenError('Unknown audio format: {}'.format(path))
+
+    tags = {}
+    for key, values in (audio.tags or {}).items():
+        if isinstance(values, list):
+            tags[str(key)] = [str(value) for value in values]
+
+    return AudioMetadata(duration=audio.info.length,
+                         bitrate=getattr(audio.info, 'bitrate', None),
+                         sample_rate=getattr(audio.info, 'sample_rate', None),
+                         channels=getattr(audio.info, 'channels', None),
+                         tags=tags)
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class MetadataCache(object):
+    def __init__(self, workers=DEFAULT_WORKERS):
+        '''
+        @param workers: number of threads filling the cache in the background
+        '''
+        # path -> (size, mtime, AudioMetadata)
+        self._entries = {}
+        self._lock = threading.Lock()
+        # held by the worker loading every entry, the others wait for it
+        self._load_lock = threading.Lock()
+        # set once every entry is in memory, until then get looks its path
+        # up in daze state rather than probing the file
+        self._loaded = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def peek(self, path):
+        '''
+        Return the cached metadata of a file without touching the file
+
+        @return: AudioMetadata, or None if the file is not cached yet
+        '''
+        entry = self._entries.get(path)
+        if entry is not None:
+            return entry[2]
+
+    def get(self, path):
+        '''
+        Return the metadata of a file, only probing it if it is not cached or
+        changed since it was cached
+
+        @return: AudioMetadata
+        '''
+        key = _file_key(path)
+        entry = self._entries.get(path)
+        if entry is None and not self._loaded:
+            stored = daze_state.load_audio_metadata(path)
+            self._remember(stored)
+            entry = self._entries.get(path)
+
+        if entry is not None and entry[:2] == key:
+            return entry[2]
+
+        metadata = probe(path)
+        self._store([(path, key[0], key[1], metadata)])
+        return metadata
+
+    def prefetch(self, paths, callback=None):
+        '''
+        Fill the cache for the given files in the background
+
+        @param paths: paths of the audio files
+        @param callback: called from a worker thread with a dictionary of
+                         path -> AudioMetadata once the files are cached
+        @return: concurrent.futures.Future
+        '''
+        return self._executor.submit(self._prefetch, list(paths), callback)
+
+    def _prefetch(self, paths, callback):
+        self._load()
+
+        found = {}
+        probed = []
+        for path in paths:
+            try:
+                key = _file_key(path)
+                entry = self._entries.get(path)
+                if entry is not None and entry[:2] == key:
+                    found[path] = entry[2]
+                    continue
+                found[path] = probe(path)
+            except (OSError, mutagen.MutagenError) as e:
+                print('Unable to read metadata of {}'.format(path))
+                print(e)
+            else:
+                probed.append((path, key[0], key[1], found[path]))
+
+        self._store(probed)
+        if callback is not None:
+            callback(found)
+
+    def _load(self):
+        '''
+        Load every cached entry into memory, once
+        '''
+        with self._load_lock:
+            if self._loaded:
+                return
+            self._remember(daze_state.load_audio_metadata())
+            self._loaded = True
+
+    def _remember(self, stored):
+        with self._lock:
+            for path, (size, mtime, metadata) in stored.items():
+                self._entries.setdefault(path, (size,
+                                                mtime,
+                                                AudioMetadata(**metadata)))
+
+    def _store(self, entries):
+        if not entries:
+            return
+        with self._lock:
+            for path, size, mtime, metadata in entries:
+                self._entries[path] = (size, mtime, metadata)
+        daze_state.save_audio_metadata((path, size, mtime, metadata._asdict())
+                                       for path, size, mtime, metadata in entries)
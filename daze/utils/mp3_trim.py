@@ -0,0 +1,312 @@
+'''
+Lossless mp3 trimming
+
+Cuts an MPEG audio layer III stream on frame boundaries by copying the kept
+frames as they are, without decoding or re-encoding. ID3 tags are copied
+verbatim and the Xing/LAME header, if any, is rewritten for the kept frames
+'''
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from . import tracing
+from ..errors import DazeTrimException
+
+
+# bit rates in kbit/s by bit rate index, MPEG 1 and MPEG 2/2.5 layer III
+BITRATES = {
+    'mpeg1': (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    'mpeg2': (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# sample rates by version bits and sample rate index
+SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+LAYER_III = 1
+ID3V1_SIZE = 128
+# size of the part of the info frame covered by the LAME tag CRC
+LAME_CRC_SPAN = 190
+# encoder strings starting a LAME extension (lame itself, ffmpeg)
+LAME_ENCODERS = (b'LAME', b'Lavc', b'Lavf')
+CHUNK_SIZE = 1 << 20
+
+
+def _crc16(data, crc=0):
+    '''
+    CRC-16 (polynomial 0x8005, reflected) as used by the LAME tag
+    '''
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+class Frame(object):
+    __slots__ = ('offset', 'length', 'samples', 'sample_rate', 'side_info')
+
+    def __init__(self, offset, length, samples, sample_rate, side_info):
+        self.offset = offset
+        self.length = length
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.side_info = side_info
+
+    @property
+    def end(self):
+        return self.offset + self.length
+
+
+def parse_header(header, offset=0):
+    '''
+    Parse a 4 byte frame header
+
+    @param header: frame header as an integer
+    @param offset: offset of the frame in the file
+    @return: Frame, or None if the header is not a valid layer III header
+    '''
+    if header >> 21 != 0x7FF:
+        return None
+    version = (header >> 19) & 0x3
+    layer = (header >> 17) & 0x3
+    bitrate_index = (header >> 12) & 0xF
+    sample_rate_index = (header >> 10) & 0x3
+    padding = (header >> 9) & 0x1
+    mono = (header >> 6) & 0x3 == 3
+
+    if (version == 1 or layer != LAYER_III or bitrate_index in (0, 15) or
+            sample_rate_index == 3):
+        return None
+
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        bitrate = BITRATES['mpeg1'][bitrate_index] * 1000
+        samples = 1152
+        side_info = 17 if mono else 32
+    else:
+        bitrate = BITRATES['mpeg2'][bitrate_index] * 1000
+        samples = 576
+        side_info = 9 if mono else 17
+
+    length = samples // 8 * bitrate // sample_rate + padding
+    return Frame(offset, length, samples, sample_rate, side_info)
+
+
+def id3v2_size(data):
+    '''
+    Return the size of the ID3v2 tag at the start of the data, 0 if none
+    '''
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def scan_frames(data, start, stop):
+    '''
+    Find the frames between the two offsets, resynchronising over garbage
+
+    @param data: bytes like object of the whole file
+    @return: list of Frame
+    '''
+    frames = []
+    # a stream only uses a handful of distinct headers
+    headers = {}
+    unpack_from = struct.unpack_from
+    offset = start
+    while offset + 4 <= stop:
+        header, = unpack_from('>I', data, offset)
+        if header not in headers:
+            headers[header] = parse_header(header)
+        frame = headers[header]
+        if frame is not None and offset + frame.length <= stop:
+            end = offset + frame.length
+            # when resynchronising, require the next frame to be valid too
+            in_sync = frames and frames[-1].end == offset
+            if not in_sync and end + 4 <= stop:
+                following, = unpack_from('>I', data, end)
+                in_sync = parse_header(following) is not None
+            if in_sync or end + 4 > stop:
+                frames.append(Frame(offset,
+                                    frame.length,
+                                    frame.samples,
+                                    frame.sample_rate,
+                                    frame.side_info))
+                offset = end
+                continue
+        offset += 1
+    return frames
+
+
+def _info_tag_offset(data, frame):
+    '''
+    Return the offset of a Xing/Info tag in the frame, None if there is none
+    '''
+    for offset in (frame.offset + 4 + frame.side_info,
+                   frame.offset + 6 + frame.side_info):
+        if data[offset:offset + 4] in (b'Xing', b'Info'):
+            return offset
+
+
+def _is_vbri_frame(data, frame):
+    return data[frame.offset + 36:frame.offset + 40] == b'VBRI'
+
+
+def _rewrite_info_frame(data, info_frame, tag_offset, frames, cut_start,
+                        cut_end):
+    '''
+    Return the info frame with its Xing and LAME headers updated for the
+    kept frames
+
+    @param cut_start: whether frames were dropped from the start
+    @param cut_end: whether frames were dropped from the end
+    '''
+    info = bytearray(data[info_frame.offset:info_frame.end])
+    position = tag_offset - info_frame.offset + 4
+    flags, = struct.unpack_from('>I', info, position)
+    position += 4
+
+    music_bytes = sum(frame.length for frame in frames)
+    if flags & 0x1:
+        struct.pack_into('>I', info, position, len(frames))
+        position += 4
+    if flags & 0x2:
+        struct.pack_into('>I', info, position, info_frame.length + music_bytes)
+        position += 4
+    if flags & 0x4:
+        # seek table: byte position, out of 256, of each percent of the track
+        total_samples = sum(frame.samples for frame in frames)
+        toc = bytearray(100)
+        samples = 0
+        byte_offset = 0
+        percent = 0
+        for frame in frames:
+            while percent < 100 and samples * 100 >= total_samples * percent:
+                toc[percent] = min(255, byte_offset * 256 // music_bytes)
+                percent += 1
+            samples += frame.samples
+            byte_offset += frame.length
+        for index in range(percent, 100):
+            toc[index] = 255
+        info[position:position + 100] = toc
+        position += 100
+    if flags & 0x8:
+        position += 4
+
+    if (position + 36 > len(info) or
+            bytes(info[position:position + 4]) not in LAME_ENCODERS):
+        return bytes(info)
+
+    # LAME extension. The encoder delay/padding samples on a cut side are
+    # gone along with the dropped frames. The music CRC is left as is,
+    # decoders don't check it and it would mean reading every kept byte
+    delay_padding = int.from_bytes(info[position + 21:position + 24], 'big')
+    delay, padding = delay_padding >> 12, delay_padding & 0xFFF
+    if cut_start:
+        delay = 0
+    if cut_end:
+        padding = 0
+    info[position + 21:position + 24] = ((delay << 12) | padding).to_bytes(3, 'big')
+    struct.pack_into('>I', info, position + 28, info_frame.length + music_bytes)
+    struct.pack_into('>H', info, position + 34, _crc16(info[:LAME_CRC_SPAN]))
+    return bytes(info)
+
+
+@tracing.traced('mp3_trim.trim')
+def trim(path, start, end, dest=None):
+    '''
+    Keep the frames of an mp3 file between two points in time
+
+    @param path: path of the mp3 file
+    @param start: start of the kept audio in seconds
+    @param end: end of the kept audio in seconds
+    @param dest: path of the trimmed file, defaults to replacing path
+    @raise DazeTrimException: the file is not an MPEG layer III stream
+    '''
+    dest = dest or path
+    with open(path, 'rb') as handle:
+        try:
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise DazeTrimException('{} is empty'.format(path))
+
+    try:
+        audio_start = id3v2_size(data)
+        audio_stop = len(data)
+        if audio_stop - audio_start >= ID3V1_SIZE and \
+                data[audio_stop - ID3V1_SIZE:audio_stop - ID3V1_SIZE + 3] == b'TAG':
+            audio_stop -= ID3V1_SIZE
+
+        frames = scan_frames(data, audio_start, audio_stop)
+        if not frames:
+            raise DazeTrimException('No mp3 frames found in {}'.format(path))
+
+        info_frame = None
+        tag_offset = _info_tag_offset(data, frames[0])
+        if tag_offset is not None:
+            info_frame = frames.pop(0)
+        elif _is_vbri_frame(data, frames[0]):
+            # a VBRI header can't be kept accurate, drop it
+            frames.pop(0)
+
+        # keep the frames overlapping the range, counting whole samples so
+        # rounding doesn't add up over long files
+        kept = []
+        samples = 0
+        for frame in frames:
+            frame_start = samples / frame.sample_rate
+            samples += frame.samples
+            if samples / frame.sample_rate > start and frame_start < end:
+                kept.append(frame)
+        if not kept:
+            raise DazeTrimException('Nothing to keep between {}s and {}s'.format(start, end))
+
+        directory = os.path.dirname(os.path.abspath(dest))
+        # hidden, so the library scanner doesn't pick it up
+        fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.mp3', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                output.write(data[:audio_start])
+                if info_frame is not None:
+                    output.write(_rewrite_info_frame(data,
+                                                     info_frame,
+                                                     tag_offset,
+                                                     kept,
+                                                     kept[0] is not frames[0],
+                                                     kept[-1] is not frames[-1]))
+                _copy_frames(data, kept, output)
+                # trailing tags (ID3v1, APE, ...) after the last frame
+                output.write(data[frames[-1].end:])
+            shutil.copymode(path, temp_path)
+            os.replace(temp_path, dest)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    finally:
+        data.close()
+
+
+def _copy_frames(data, frames, output):
+    '''
+    Copy frames, coalescing contiguous frames into chunked copies
+    '''
+    run_start = frames[0].offset
+    run_end = frames[0].offset
+    for frame in frames:
+        if frame.offset != run_end:
+            _copy_range(data, run_start, run_end, output)
+            run_start = frame.offset
+        run_end = frame.end
+    _copy_range(data, run_start, run_end, output)
+
+
+def _copy_range(data, start, end, output):
+    for offset in range(start, end, CHUNK_SIZE):
+        output.write(data[offset:min(end, offset + CHUNK_SIZE)])
@@ -0,0 +1,112 @@
+'''
+Playback queue
+
+Order of the tracks the media player goes through one after the other, and
+the latency measured at every switch from a track to the next
+'''
+import collections
+import time
+
+
+# number of track switches whose latency is kept
+LATENCY_SAMPLES = 50
+
+
+class PlayQueue(object):
+    def __init__(self):
+        # (name, path) pairs
+        self.tracks = []
+        self.index = -1
+        # seconds between the end of a track and the start of the next one
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._switch_started = None
+
+    def set_tracks(self, tracks, index=0):
+        '''
+        Replace the queue
+
+        @param tracks: list of (name, path) pairs
+        @param index: index of the current track
+        '''
+        self.tracks = list(tracks)
+        self.index = index if self.tracks else -1
+        self._switch_started = None
+
+    def current(self):
+        '''
+        Return the (name, path) of the current track, None if the queue is
+        empty
+        '''
+        if 0 <= self.index < len(self.tracks):
+            return self.tracks[self.index]
+
+    def peek_next(self):
+        '''
+        Return the (name, path) of the track after the current one, None if
+        it is the last
+        '''
+        if 0 <= self.index + 1 < len(self.tracks):
+            return self.tracks[self.index + 1]
+
+    def advance(self):
+        '''
+        Move on to the next track
+
+        @return: (name, path) of the new current track, None at the end of
+                 the queue
+        '''
+        if self.peek_next() is None:
+            return None
+        self.index += 1
+        return self.tracks[self.index]
+
+    def insert_next(self, track):
+        '''
+        Queue a track right after the current one, the current one if the
+        queue is empty
+
+        @param track: (name, path) pair
+        '''
+        if self.current() is None:
+            self.set_tracks([track])
+        else:
+            self.tracks.insert(self.index + 1, track)
+
+    def rename(self, before_name, after_name, path):
+        '''
+        Follow a renamed playlist item
+        '''
+        self.tracks = [(after_name, path) if name == before_name else (name, track_path)
+                       for name, track_path in self.tracks]
+
+    def switch_started(self, at=None):
+        '''
+        Mark the end of the current track
+
+        @param at: time.perf_counter() time the track ended, now if None
+        '''
+        self._switch_started = time.perf_counter() if at is None else at
+
+    def switch_finished(self, at=None):
+        '''
+        Mark the start of the next track
+
+        @param at: time.perf_counter() time the track started, now if None
+        @return: latency of the switch in seconds, None if no switch was
+                 started
+        '''
+        if self._switch_started is None:
+            return None
+        at = time.perf_counter() if at is None else at
+        latency = max(0.0, at - self._switch_started)
+        self._switch_started = None
+        self.latencies.append(latency)
+        return latency
+
+    def mean_latency(self):
+        '''
+        Return the mean latency of the recent switches in seconds, None if
+        there was none
+        '''
+        if self.latencies:
+            return sum(self.latencies) / len(self.latencies)
@@ -0,0 +1,136 @@
+'''
+Progress event bus
+
+Download jobs publish typed events (queued, bytes, postprocessing, done,
+error) from whatever thread they run on, and subscribers are called on that
+thread (see progress_signals for delivery as Qt signals). Byte progress is
+rate limited per job, so busy downloads don't flood the subscribers. Log
+lines of every job are kept in a bounded ring buffer rather than printed
+'''
+import collections
+import threading
+import time
+
+
+QUEUED = 'queued'
+# bytes downloaded, with the total, speed and eta when known
+BYTES = 'bytes'
+POSTPROCESSING = 'postprocessing'
+DONE = 'done'
+ERROR = 'error'
+
+# seconds between two byte progress events of a job
+MIN_INTERVAL = 0.25
+LOG_LINES = 200
+# number of jobs whose log lines are kept
+LOGGED_JOBS = 100
+
+ProgressEvent = collections.namedtuple('ProgressEvent', ['kind',
+                                                         'job_id',
+                                                         'time',
+                                                         'downloaded_bytes',
+                                                         'total_bytes',
+                                                         'speed',
+                                                         'eta',
+                                                         'message'])
+
+
+def format_bytes(count):
+    '''
+    Return a byte count in human readable units
+    '''
+    if count < 1024:
+        return '{:.0f} B'.format(count)
+    for unit in ('KiB', 'MiB'):
+        count /= 1024.0
+        if count < 1024:
+            return '{:.1f} {}'.format(count, unit)
+    return '{:.1f} GiB'.format(count / 1024.0)
+
+
+def describe(event):
+    '''
+    Return a short description of a byte progress event, as in
+    '45% of 12.3 MiB at 1.2 MiB/s, 0:30 left'
+    '''
+    if event.total_bytes:
+        parts = ['{:.0f}% of {}'.format(100.0 * event.downloaded_bytes / event.total_bytes,
+                                        format_bytes(event.total_bytes))]
+    else:
+        parts = [format_bytes(event.downloaded_bytes or 0)]
+    if event.speed:
+        parts.append('at {}/s'.format(format_bytes(event.speed)))
+    description = ' '.join(parts)
+    if event.eta is not None:
+        minutes, seconds = divmod(int(event.eta), 60)
+        description += ', {}:{:02d} left'.format(minutes, seconds)
+    return description
+
+
+class EventBus(object):
+    def __init__(self, min_interval=MIN_INTERVAL, max_log_lines=LOG_LINES):
+        '''
+        @param min_interval: seconds between two byte progress events of a
+                             job, the ones in between are dropped
+        @param max_log_lines: number of log lines kept per job
+        '''
+        self.min_interval = min_interval
+        self.max_log_lines = max_log_lines
+        self._subscribers = []
+        self._lock = threading.Lock()
+        # job id -> time of the last byte progress event published
+        self._last_bytes = {}
+        # job id -> deque of log lines, least recently logged job first
+        self._logs = collections.OrderedDict()
+
+    def subscribe(self, callback):
+        '''
+        @param callback: called with every published ProgressEvent, from the
+                         publishing thread
+        '''
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def publish(self, kind, job_id, downloaded_bytes=None, total_bytes=None,
+                speed=None, eta=None, message=''):
+        '''
+        Publish an event of a job
+
+        @return: whether the event was published, byte progress events are
+                 dropped when they come too soon after the previous one
+        '''
+        now = time.monotonic()
+        with self._lock:
+            if kind == BYTES:
+                if now - self._last_bytes.get(job_id, -self.min_interval) < self.min_interval:
+                    return False
+                self._last_bytes[job_id] = now
+            elif kind in (DONE, ERROR):
+                self._last_bytes.pop(job_id, None)
+            subscribers = list(self._subscribers)
+
+        event = ProgressEvent(kind, job_id, now, downloaded_bytes, total_bytes,
+                              speed, eta, message)
+        for callback in subscribers:
+            callback(event)
+        return True
+
+    def log(self, job_id, line):
+        '''
+        Keep a log line of a job
+        '''
+        with self._lock:
+            lines = self._logs.pop(job_id, None)
+            if lines is None:
+                lines = collections.deque(maxlen=self.max_log_lines)
+                if len(self._logs) >= LOGGED_JOBS:
+                    self._logs.popitem(last=False)
+            self._logs[job_id] = lines
+            lines.append(line)
+
+    def log_lines(self, job_id):
+        '''
+        Return the most recent log lines of a job, oldest first
+        '''
+        with self._lock:
+            return list(self._logs.get(job_id, ()))
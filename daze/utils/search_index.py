@@ -0,0 +1,103 @@
+'''
+Incremental trigram search index over playlist items
+
+Every item is indexed by the trigrams of its lower cased name and tags. A
+query is answered by intersecting the posting sets of its trigrams, smallest
+first, and checking the few remaining candidates for the whole substring
+'''
+import threading
+
+
+def trigrams(text):
+    '''
+    Return the set of trigrams of a lower cased text
+    '''
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex(object):
+    def __init__(self):
+        # key -> lower cased searchable text
+        self._texts = {}
+        # trigram -> set of keys
+        self._postings = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, key, name, tags=None):
+        '''
+        Index an item, replacing what was indexed under the key
+
+        @param key: key of the item, the playlist item name
+        @param name: name of the item
+        @param tags: dictionary of tag -> list of values to index as well
+        '''
+        parts = [name]
+        for values in (tags or {}).values():
+            parts.extend(values)
+        text = '\n'.join(parts).lower()
+
+        with self._lock:
+            self._remove(key)
+            self._texts[key] = text
+            for trigram in trigrams(text):
+                self._postings.setdefault(trigram, set()).add(key)
+
+    def remove(self, key):
+        '''
+        Remove an item from the index
+        '''
+        with self._lock:
+            self._remove(key)
+
+    def rename(self, before_key, after_key, name):
+        '''
+        Move an item to a new key, indexing its new name and keeping the
+        tags indexed under the old key
+        '''
+        with self._lock:
+            text = self._texts.get(before_key, '')
+        tags = text.split('\n')[1:]
+        self.add(after_key, name, {'tags': tags})
+        if before_key != after_key:
+            self.remove(before_key)
+
+    def search(self, query):
+        '''
+        Return the keys of the items containing the query
+
+        @param query: text to look for, case insensitive
+        @return: set of keys
+        '''
+        query = query.lower()
+        with self._lock:
+            if len(query) < 3:
+                # too short for trigrams, scan the texts
+                return {key for key, text in self._texts.items() if query in text}
+
+            postings = []
+            for trigram in trigrams(query):
+                keys = self._postings.get(trigram)
+                if not keys:
+                    return set()
+                postings.append(keys)
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for keys in postings[1:]:
+                candidates &= keys
+                if not candidates:
+                    return candidates
+            return {key for key in candidates if query in self._texts[key]}
+
+    def _remove(self, key):
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        for trigram in trigrams(text):
+            keys = self._postings.get(trigram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[trigram]
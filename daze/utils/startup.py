@@ -0,0 +1,120 @@
+'''
+Startup profiling and warm-up
+
+The window is shown before the heavy modules are imported: they are loaded
+on first use, or warmed up on a background thread once the window has been
+painted. With --profile-startup, the time taken by every step of the startup
+is recorded and printed as a breakdown
+'''
+import importlib
+import threading
+import time
+
+
+# time daze started, as close as it gets: bin/daze imports this module first
+STARTED = time.perf_counter()
+
+_lock = threading.Lock()
+# (label, start, end) of the steps recorded, None when not profiling
+_steps = None
+_last_mark = STARTED
+
+
+def enable(args):
+    '''
+    Record the startup steps if --profile-startup is given
+
+    @param args: command line arguments
+    @return: whether profiling is enabled
+    '''
+    global _steps
+    if '--profile-startup' in args and _steps is None:
+        _steps = []
+    return _steps is not None
+
+
+def enabled():
+    return _steps is not None
+
+
+def mark(label):
+    '''
+    Record a step of the main thread, from the previous mark until now
+    '''
+    global _last_mark
+    now = time.perf_counter()
+    with _lock:
+        if _steps is not None:
+            _steps.append((label, _last_mark, now))
+        _last_mark = now
+
+
+def record(label, start, end=None):
+    '''
+    Record a step running alongside the main thread
+
+    @param start: time.perf_counter() time the step started
+    @param end: time it ended, now if None
+    '''
+    if end is None:
+        end = time.perf_counter()
+    with _lock:
+        if _steps is not None:
+            _steps.append((label, start, end))
+
+
+def steps():
+    '''
+    Return the recorded steps as (label, start, end) tuples in order of
+    start, times relative to STARTED in seconds
+    '''
+    with _lock:
+        recorded = sorted(_steps or [], key=lambda step: step[1])
+    return [(label, start - STARTED, end - STARTED)
+            for label, start, end in recorded]
+
+
+def breakdown():
+    '''
+    Return the recorded steps as lines of text, in order of start, with
+    their offset from startup and duration in milliseconds
+    '''
+    recorded = steps()
+    width = max([len(label) for label, _, _ in recorded] + [0])
+    return ['{:>8.1f} ms  {:<{}}  {:>8.1f} ms'.format(start * 1000,
+                                                     label, width,
+                                                     (end - start) * 1000)
+            for label, start, end in recorded]
+
+
+def print_breakdown():
+    if enabled():
+        print('Startup breakdown (offset, step, duration):')
+        for line in breakdown():
+            print(line)
+
+
+def warm_up(modules, done=None):
+    '''
+    Import modules on a background thread, so their first use doesn't wait
+    on them
+
+    @param modules: names of the modules, imported in order
+    @param done: called from the background thread once they are imported
+    @return: the started thread
+    '''
+    def run():
+        for name in modules:
+            start = time.perf_counter()
+            try:
+                importlib.import_module(name)
+            except ImportError as e:
+                print('Unable to warm up {}'.format(name))
+                print(e)
+            record('warm up {}'.format(name), start)
+        if done is not None:
+            done()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
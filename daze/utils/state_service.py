@@ -0,0 +1,217 @@
+'''
+Shared in-memory daze state
+
+The state is loaded once and handed to every widget. Mutations only touch
+memory and mark the changed keys dirty, a background writer then coalesces
+everything changed within a short debounce window into a single write
+'''
+import threading
+import time
+
+from . import daze_state
+
+
+DEBOUNCE_SECONDS = 0.5
+
+
+class StateService(object):
+    def __init__(self, debounce=DEBOUNCE_SECONDS):
+        '''
+        @param debounce: seconds to wait after the first change before
+                         writing, changes made meanwhile share the write
+        '''
+        self.debounce = debounce
+        self.data = {'Playlist': {}, 'Preferences': {}}
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        # dirty keys since the last write, the playlist keeps insertion order
+        self._saved = {}
+        self._removed = set()
+        # new name -> name stored in the database
+        self._renamed = {}
+        self._preferences = set()
+        self._sections = set()
+        # (extractor, video id) -> name of the playlist items in memory
+        self._sources = {}
+        self._paged_in = False
+
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    @property
+    def playlist(self):
+        return self.data['Playlist']
+
+    @property
+    def preferences(self):
+        return self.data['Preferences']
+
+    def load(self):
+        '''
+        Load the preferences and other top level data. The playlist is paged
+        in separately through iter_playlist
+
+        @raise DazeStateException: there is no daze data to load
+        '''
+        self.data.update(daze_state.load_state(playlist=False))
+        self.data['Playlist'] = {}
+
+    def iter_playlist(self):
+        '''
+        Page the stored playlist into memory
+
+        @return: generator of lists of (name, metadata) pairs that were not
+                 already in memory
+        '''
+        for page in daze_state.iter_playlist():
+            with self._lock:
+                page = [(name, metadata) for name, metadata in page
+                        if name not in self.playlist]
+                self.playlist.update(page)
+                for name, metadata in page:
+                    self._index_source(name, metadata)
+            yield page
+        self._paged_in = True
+
+    def find_source(self, extractor, video_id):
+        '''
+        Return the name of the playlist item downloaded from a video
+
+        @param extractor: youtube-dl extractor of the video
+        @param video_id: id of the video
+        @return: name of the playlist item, None if there is none
+        '''
+        with self._lock:
+            name = self._sources.get((extractor, video_id))
+        if name is not None or self._paged_in:
+            return name
+        # not paged in yet, look it up in the database
+        self.flush()
+        return daze_state.find_source(extractor, video_id)
+
+    def set_defaults(self, preferences):
+        '''
+        Fill in missing preferences
+
+        @param preferences: dictionary of default preferences
+        '''
+        for key, value in preferences.items():
+            if key not in self.preferences:
+                self.set_preference(key, value)
+
+    def set_playlist_item(self, name, metadata):
+        '''
+        Add or update a playlist item
+        '''
+        with self._lock:
+            self._unindex_source(self.playlist.get(name))
+            self.playlist[name] = metadata
+            self._index_source(name, metadata)
+            self._removed.discard(name)
+            self._saved[name] = None
+        self._schedule()
+
+    def remove_playlist_item(self, name):
+        '''
+        Remove a playlist item
+        '''
+        with self._lock:
+            self._unindex_source(self.playlist.pop(name, None))
+            self._saved.pop(name, None)
+            self._removed.add(self._renamed.pop(name, name))
+        self._schedule()
+
+    def rename_playlist_item(self, before_name, after_name, metadata):
+        '''
+        Rename a playlist item, keeping its position in the playlist
+        '''
+        with self._lock:
+            self._unindex_source(self.playlist.pop(before_name, None))
+            self.playlist[after_name] = metadata
+            self._index_source(after_name, metadata)
+            self._saved.pop(before_name, None)
+            stored_name = self._renamed.pop(before_name, before_name)
+            if stored_name != after_name:
+                self._renamed[after_name] = stored_name
+            self._saved[after_name] = None
+        self._schedule()
+
+    def set_preference(self, key, value):
+        with self._lock:
+            self.preferences[key] = value
+            self._preferences.add(key)
+        self._schedule()
+
+    def set_section(self, key, value):
+        '''
+        Set top level daze data other than the playlist and preferences
+        '''
+        with self._lock:
+            self.data[key] = value
+            self._sections.add(key)
+        self._schedule()
+
+    def flush(self):
+        '''
+        Write all dirty keys now, from the calling thread
+        '''
+        with self._write_lock:
+            with self._lock:
+                removed = list(self._removed)
+                renamed = [(stored_name, name, self.playlist[name])
+                           for name, stored_name in self._renamed.items()
+                           if name in self.playlist]
+                saved = [(name, self.playlist[name]) for name in self._saved
+                         if name in self.playlist]
+                preferences = [(key, self.preferences[key])
+                               for key in self._preferences]
+                sections = [(key, self.data[key]) for key in self._sections]
+                self._removed.clear()
+                self._renamed.clear()
+                self._saved.clear()
+                self._preferences.clear()
+                self._sections.clear()
+
+            if removed or renamed or saved or preferences or sections:
+                daze_state.apply_changes(removed,
+                                         renamed,
+                                         saved,
+                                         preferences,
+                                         sections)
+
+    def close(self):
+        '''
+        Flush and stop the background writer, call when quitting
+        '''
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
+    def _index_source(self, name, metadata):
+        if metadata.get('extractor') and metadata.get('video_id'):
+            self._sources[metadata['extractor'], metadata['video_id']] = name
+
+    def _unindex_source(self, metadata):
+        if metadata is not None:
+            self._sources.pop((metadata.get('extractor'),
+                               metadata.get('video_id')), None)
+
+    def _schedule(self):
+        self._wake.set()
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait()
+            if self._closed:
+                return
+            # let the burst of changes that woke us up pile up
+            time.sleep(self.debounce)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print('Unable to save daze data')
+                print(e)
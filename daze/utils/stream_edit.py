@@ -0,0 +1,127 @@
+'''
+Bounded memory trimming
+
+Decodes only the selected range of an audio file and pipes the PCM to the
+encoder in fixed size chunks, so memory use does not depend on the length of
+the file. The result is written to a temporary file that atomically replaces
+the original, a crash never leaves a truncated track behind
+'''
+import os
+import shutil
+import subprocess
+import tempfile
+
+from . import tracing
+from .transcode import FFMPEG
+from ..errors import DazeTrimException
+
+
+CHUNK_SIZE = 1 << 16
+PCM_FORMAT = 's16le'
+DEFAULT_SAMPLE_RATE = 44100
+DEFAULT_CHANNELS = 2
+# output extension -> (ffmpeg encoder, ffmpeg muxer)
+ENCODERS = {
+    '.mp3': ('libmp3lame', 'mp3'),
+    '.m4a': ('aac', 'ipod'),
+    '.opus': ('libopus', 'opus'),
+    '.ogg': ('libvorbis', 'ogg'),
+}
+
+
+@tracing.traced('stream_edit.trim')
+def trim(path, start, end, dest=None, bitrate=None,
+         sample_rate=DEFAULT_SAMPLE_RATE, channels=DEFAULT_CHANNELS):
+    '''
+    Keep the audio of a file between two points in time, re-encoding it
+
+    @param path: path of the audio file
+    @param start: start of the kept audio in seconds
+    @param end: end of the kept audio in seconds
+    @param dest: path of the trimmed file, defaults to replacing path
+    @param bitrate: bit rate of the trimmed file in bit/s, the encoder's
+                    default if None
+    @param sample_rate: sample rate of the audio file
+    @param channels: number of channels of the audio file
+    @raise DazeTrimException: ffmpeg is not installed, or decoding or
+                              encoding failed
+    '''
+    if shutil.which(FFMPEG) is None:
+        # pydub, which fell back on other decoders, is no longer used
+        raise DazeTrimException('{} is not installed, re-encoding trims '
+                                'need it'.format(FFMPEG))
+    dest = dest or path
+    extension = os.path.splitext(dest)[1].lower()
+    if extension not in ENCODERS:
+        raise DazeTrimException('Unsupported audio format: {}'.format(dest))
+    encoder_name, muxer = ENCODERS[extension]
+
+    pcm = ['-f', PCM_FORMAT, '-ar', str(sample_rate), '-ac', str(channels)]
+    decode_command = ([FFMPEG, '-v', 'error',
+                       '-ss', str(start), '-t', str(end - start),
+                       '-i', path, '-vn'] + pcm + ['-'])
+    encode_command = ([FFMPEG, '-v', 'error', '-y'] + pcm +
+                      ['-i', '-',
+                       # copy the tags of the original file
+                       '-i', path, '-map', '0:a', '-map_metadata', '1',
+                       '-codec:a', encoder_name])
+    if bitrate:
+        encode_command += ['-b:a', '{}k'.format(bitrate // 1000)]
+
+    directory = os.path.dirname(os.path.abspath(dest))
+    # hidden, so the library scanner doesn't pick it up
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix=extension, dir=directory)
+    os.close(fd)
+    encode_command += ['-f', muxer, temp_path]
+
+    try:
+        with tempfile.TemporaryFile() as decode_errors, \
+                tempfile.TemporaryFile() as encode_errors:
+            _pipe(decode_command, encode_command, decode_errors, encode_errors)
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, dest)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _pipe(decode_command, encode_command, decode_errors, encode_errors):
+    '''
+    Run the decoder and encoder, copying chunks of PCM from one to the other
+    '''
+    try:
+        decoder = subprocess.Popen(decode_command,
+                                   stdout=subprocess.PIPE,
+                                   stderr=decode_errors)
+    except OSError as e:
+        raise DazeTrimException('Unable to run {}: {}'.format(FFMPEG, e))
+    try:
+        encoder = subprocess.Popen(encode_command,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=encode_errors)
+    except OSError as e:
+        decoder.kill()
+        decoder.wait()
+        raise DazeTrimException('Unable to run {}: {}'.format(FFMPEG, e))
+
+    try:
+        while True:
+            chunk = decoder.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            encoder.stdin.write(chunk)
+    except BrokenPipeError:
+        decoder.kill()
+    finally:
+        decoder.stdout.close()
+        encoder.stdin.close()
+        decoder.wait()
+        encoder.wait()
+
+    for process, errors in ((decoder, decode_errors), (encoder, encode_errors)):
+        if process.returncode != 0:
+            errors.seek(0)
+            raise DazeTrimException(errors.read().decode(errors='replace').strip() or
+                                    'ffmpeg exited with {}'.format(process.returncode))
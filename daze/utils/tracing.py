@@ -0,0 +1,217 @@
+'''
+Tracing of the hot operations of daze
+
+Operations are wrapped in spans (span, traced) recording their start,
+duration and thread. While tracing is disabled a span costs a global lookup
+and a call. Enabled, with DAZE_TRACE=<path> or the Settings menu, spans are
+kept in memory and written to a Chrome trace format JSON file when tracing
+stops, which chrome://tracing and Perfetto open
+'''
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+
+ENV_VAR = 'DAZE_TRACE'
+DEFAULT_TRACE_PATH = '~/daze_trace.json'
+# events kept in memory, the oldest are dropped beyond
+MAX_EVENTS = 1000000
+
+# TraceRecorder while tracing, None otherwise
+_recorder = None
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args = dict(self.args, error=repr(exc_value))
+        self.recorder.complete(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class TraceRecorder(object):
+    def __init__(self, path, max_events=MAX_EVENTS):
+        '''
+        @param path: path of the trace file
+        @param max_events: events kept in memory, the oldest are dropped
+                           beyond
+        '''
+        self.path = path
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self._events = collections.deque(maxlen=max_events)
+        # thread id -> thread name
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def span(self, name, args):
+        return _Span(self, name, args)
+
+    def complete(self, name, start, end, args=None):
+        '''
+        Record an operation of the calling thread
+
+        @param name: name of the operation
+        @param start: time.perf_counter() time it started
+        @param end: time.perf_counter() time it ended
+        @param args: dictionary of details shown with the span
+        '''
+        thread = threading.current_thread()
+        event = {'name': name,
+                 'ph': 'X',
+                 'ts': (start - self.origin) * 1e6,
+                 'dur': (end - start) * 1e6,
+                 'pid': self.pid,
+                 'tid': thread.ident}
+        if args:
+            event['args'] = {key: str(value) for key, value in args.items()}
+        with self._lock:
+            self._events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+
+    def write(self):
+        '''
+        Write the recorded events to the trace file
+
+        @raise OSError: the file can't be written
+        '''
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [{'name': 'thread_name',
+                     'ph': 'M',
+                     'pid': self.pid,
+                     'tid': tid,
+                     'args': {'name': name}}
+                    for tid, name in threads.items()]
+        metadata.append({'name': 'process_name',
+                         'ph': 'M',
+                         'pid': self.pid,
+                         'args': {'name': 'daze'}})
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'w') as handle:
+            json.dump({'traceEvents': metadata + events,
+                       'displayTimeUnit': 'ms'}, handle)
+        os.replace(temp_path, self.path)
+
+
+def enable(path=None):
+    '''
+    Start tracing, unless already tracing
+
+    @param path: path of the trace file, DEFAULT_TRACE_PATH if None
+    '''
+    global _recorder
+    if _recorder is None:
+        _recorder = TraceRecorder(os.path.expanduser(path or DEFAULT_TRACE_PATH))
+
+
+def enable_from_environment():
+    '''
+    Start tracing if DAZE_TRACE is set, to the path it holds ('1' for the
+    default path)
+    '''
+    path = os.environ.get(ENV_VAR)
+    if path:
+        enable(None if path == '1' else path)
+
+
+def disable():
+    '''
+    Stop tracing and write the trace file
+
+    @return: path of the trace file, None if not tracing
+    '''
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is None:
+        return None
+    try:
+        recorder.write()
+    except OSError as e:
+        print('Unable to write the trace to {}'.format(recorder.path))
+        print(e)
+        return None
+    return recorder.path
+
+
+def enabled():
+    return _recorder is not None
+
+
+def now():
+    '''
+    Return the current time for record
+    '''
+    return time.perf_counter()
+
+
+def span(name, **args):
+    '''
+    Return a context manager timing the operation it wraps
+
+    @param name: name of the operation
+    @param args: details shown with the span
+    '''
+    recorder = _recorder
+    if recorder is None:
+        return _NULL_SPAN
+    return recorder.span(name, args)
+
+
+def record(name, start, **args):
+    '''
+    Record an operation that started earlier, possibly on another thread,
+    and ended now
+
+    @param name: name of the operation
+    @param start: now() time it started
+    @param args: details shown with the span
+    '''
+    recorder = _recorder
+    if recorder is not None:
+        recorder.complete(name, start, time.perf_counter(), args)
+
+
+def traced(name=None):
+    '''
+    Decorate a function so that its calls are traced
+
+    @param name: name of the spans, the qualified name of the function if
+                 None
+    '''
+    def decorate(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            recorder = _recorder
+            if recorder is None:
+                return function(*args, **kwargs)
+            with recorder.span(span_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,208 @@
+'''
+Audio transcoding through ffmpeg. Kept free of Qt imports so that it can run
+inside a process pool
+
+Downloaded audio is converted according to a FormatPolicy: audio already in
+one of the accepted codecs is only remuxed (stream copied) into the matching
+container, anything else is encoded to the policy's codec, never at a higher
+bitrate than the source's
+'''
+import collections
+import json
+import os
+import subprocess
+
+from ..errors import DazeTranscodeException
+
+
+FFMPEG = 'ffmpeg'
+FFPROBE = 'ffprobe'
+PREFERRED_CODEC = 'mp3'
+PREFERRED_QUALITY = '192'
+
+# codec -> (ffmpeg encoder, extension of its container)
+ENCODERS = collections.OrderedDict([
+    ('mp3', ('libmp3lame', '.mp3')),
+    ('aac', ('aac', '.m4a')),
+    ('opus', ('libopus', '.opus')),
+    ('vorbis', ('libvorbis', '.ogg')),
+])
+# extensions of the audio files daze plays, edits and keeps in its library
+AUDIO_EXTENSIONS = tuple(extension for _, extension in ENCODERS.values())
+# the same source always converts to the same bytes, the content index
+# hashes the container rather than the audio packets: no random ogg stream
+# serial numbers, no encoder version or creation time
+BITEXACT = ['-fflags', '+bitexact', '-flags:a', '+bitexact',
+            '-metadata', 'creation_time=', '-metadata', 'encoder=']
+# bitrates in kbit/s an mp3 frame can have
+MP3_BITRATES = (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+
+# accepted_codecs: codecs kept as they are, only remuxed
+# codec: codec the other audio is encoded to
+# quality: highest bitrate in kbit/s audio is encoded at
+FormatPolicy = collections.namedtuple('FormatPolicy', ['accepted_codecs',
+                                                       'codec',
+                                                       'quality'])
+DEFAULT_POLICY = FormatPolicy(accepted_codecs=tuple(ENCODERS),
+                              codec=PREFERRED_CODEC,
+                              quality=int(PREFERRED_QUALITY))
+
+
+def format_policy(preferences):
+    '''
+    Return the format policy of the 'format_policy' preference, a dictionary
+    of some of the FormatPolicy fields, the defaults filling in the others
+
+    @param preferences: daze preferences
+    '''
+    settings = preferences.get('format_policy') or {}
+    policy = DEFAULT_POLICY._replace(**{key: value for key, value in settings.items()
+                                        if key in FormatPolicy._fields})
+    policy = policy._replace(accepted_codecs=tuple(policy.accepted_codecs),
+                             quality=int(policy.quality))
+    if policy.codec not in ENCODERS:
+        print('Unsupported codec {}, using {}'.format(policy.codec, PREFERRED_CODEC))
+        policy = policy._replace(codec=PREFERRED_CODEC)
+    return policy
+
+
+def probe_audio(path):
+    '''
+    Return the codec and bitrate of the first audio stream of a file
+
+    @param path: path of the audio file
+    @return: (codec name, bitrate in kbit/s), the bitrate is None if unknown
+    @raise DazeTranscodeException: ffprobe failed or found no audio
+    '''
+    command = [FFPROBE, '-v', 'error',
+               '-select_streams', 'a:0',
+               '-show_entries', 'stream=codec_name,bit_rate:format=bit_rate',
+               '-of', 'json',
+               path]
+    try:
+        output = subprocess.run(command,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                check=True).stdout
+        info = json.loads(output.decode(errors='replace'))
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        stderr = getattr(e, 'stderr', None) or b''
+        raise DazeTranscodeException('Unable to probe {}: {}'.format(
+            path, stderr.decode(errors='replace').strip() or e))
+
+    streams = info.get('streams') or []
+    if not streams:
+        raise DazeTranscodeException('No audio in {}'.format(path))
+    # streams in webm and ogg containers usually don't carry their bitrate,
+    # the container's is close enough
+    bitrate = streams[0].get('bit_rate') or info.get('format', {}).get('bit_rate')
+    try:
+        bitrate = int(bitrate) // 1000 if bitrate else None
+    except ValueError:
+        bitrate = None
+    return streams[0].get('codec_name'), bitrate
+
+
+def target_quality(quality, source_bitrate, codec=PREFERRED_CODEC):
+    '''
+    Return the bitrate to encode audio at, no higher than the source's since
+    a higher bitrate only makes the file bigger
+
+    @param quality: highest bitrate in kbit/s
+    @param source_bitrate: bitrate in kbit/s of the source, None if unknown
+    @param codec: codec encoded to, mp3 bitrates are rounded down to those of
+                  an mp3 frame
+    @return: bitrate in kbit/s
+    '''
+    quality = int(quality)
+    if source_bitrate:
+        quality = min(quality, source_bitrate)
+    if codec == 'mp3':
+        quality = max([bitrate for bitrate in MP3_BITRATES if bitrate <= quality] or
+                      [MP3_BITRATES[0]])
+    return quality
+
+
+def _run(command, source, dest):
+    try:
+        subprocess.run(command,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE,
+                       check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        if os.path.exists(dest):
+            os.remove(dest)
+        stderr = getattr(e, 'stderr', None) or b''
+        raise DazeTranscodeException('Unable to convert {}: {}'.format(
+            source, stderr.decode(errors='replace').strip() or e))
+
+
+def encode(source, dest, quality=PREFERRED_QUALITY):
+    '''
+    Encode the audio of a file, to the codec of the extension of dest (mp3
+    if it isn't one of ENCODERS)
+
+    @param source: path of the audio file
+    @param dest: path of the encoded file, replaced if it exists
+    @param quality: bitrate in kbit/s
+    @raise DazeTranscodeException: ffmpeg failed
+    '''
+    extension = os.path.splitext(dest)[1].lower()
+    encoder = next((encoder for encoder, codec_extension in ENCODERS.values()
+                    if codec_extension == extension),
+                   ENCODERS[PREFERRED_CODEC][0])
+    _run([FFMPEG, '-y', '-loglevel', 'error',
+          '-i', source,
+          '-vn',
+          '-codec:a', encoder,
+          '-b:a', '{}k'.format(quality)] + BITEXACT + [dest], source, dest)
+
+
+def remux(source, dest):
+    '''
+    Copy the audio stream of a file, as it is, into the container of dest
+
+    @param source: path of the audio file
+    @param dest: path of the remuxed file, replaced if it exists
+    @raise DazeTranscodeException: ffmpeg failed
+    '''
+    _run([FFMPEG, '-y', '-loglevel', 'error',
+          '-i', source,
+          '-map', '0:a:0',
+          '-codec:a', 'copy'] + BITEXACT + [dest], source, dest)
+
+
+def convert(source, policy=DEFAULT_POLICY):
+    '''
+    Convert a downloaded audio file according to a format policy and remove
+    the original. Audio in an accepted codec is only remuxed, if its
+    container isn't already the codec's
+
+    @param source: path of the downloaded audio file
+    @param policy: FormatPolicy
+    @return: path of the converted file
+    @raise DazeTranscodeException: ffprobe or ffmpeg failed
+    '''
+    codec, bitrate = probe_audio(source)
+    base = os.path.splitext(source)[0]
+    accepted = codec in ENCODERS and (codec in policy.accepted_codecs or
+                                      codec == policy.codec)
+    if accepted:
+        dest = base + ENCODERS[codec][1]
+        if dest == source:
+            return dest
+    else:
+        dest = base + ENCODERS[policy.codec][1]
+
+    # hidden until complete, so the library scanner doesn't pick it up, and
+    # so a source with the destination's extension isn't overwritten while
+    # it is read
+    temp_path = os.path.join(os.path.dirname(dest), '.' + os.path.basename(dest))
+    if accepted:
+        remux(source, temp_path)
+    else:
+        encode(source, temp_path, target_quality(policy.quality, bitrate, policy.codec))
+    os.replace(temp_path, dest)
+    if source != dest:
+        os.remove(source)
+    return dest
@@ -0,0 +1,146 @@
+'''
+Event loop stall watchdog
+
+The GUI thread beats a heartbeat from a timer of its event loop. A watchdog
+thread checks that the beats keep coming: when the loop hasn't beaten for
+longer than the threshold, the Python stack of the GUI thread is captured
+with sys._current_frames() and logged, and the length of the stall once the
+loop is back. Stalls are summed up per session in a histogram of their
+lengths, and by the code they were stuck in
+'''
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+
+from . import tracing
+
+
+# seconds between two beats of the event loop
+HEARTBEAT_INTERVAL = 0.1
+# seconds an event loop may be late before it is considered stalled
+DEFAULT_THRESHOLD = 0.5
+# upper bounds in seconds of the histogram buckets, the last one is open
+HISTOGRAM_EDGES = (0.5, 1, 2, 5, 10, 30)
+# locations listed in the summary
+TOP_OFFENDERS = 5
+
+DAZE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stall_location(frames):
+    '''
+    Return where a stack was stuck: the innermost daze frame, or the
+    innermost frame if none is from daze
+
+    @param frames: traceback.StackSummary, outermost frame first
+    @return: 'file:line in function'
+    '''
+    if not frames:
+        return 'unknown'
+    frame, filename = frames[-1], frames[-1].filename
+    for candidate in reversed(frames):
+        path = os.path.abspath(candidate.filename)
+        if path.startswith(DAZE_DIR + os.sep):
+            frame, filename = candidate, os.path.relpath(path, os.path.dirname(DAZE_DIR))
+            break
+    return '{}:{} in {}'.format(filename, frame.lineno, frame.name)
+
+
+class StallStats(object):
+    def __init__(self, edges=HISTOGRAM_EDGES):
+        '''
+        @param edges: upper bounds in seconds of the histogram buckets
+        '''
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        # location -> [count, total seconds]
+        self.locations = collections.defaultdict(lambda: [0, 0.0])
+
+    def add(self, seconds, location):
+        self.counts[bisect.bisect_left(self.edges, seconds)] += 1
+        self.locations[location][0] += 1
+        self.locations[location][1] += seconds
+
+    def summary(self):
+        '''
+        Return the histogram of the stall lengths and the locations stalled
+        the longest in total, as lines of text
+        '''
+        total = sum(self.counts)
+        if not total:
+            return ['No event loop stalls']
+        lines = ['Event loop stalls: {}'.format(total)]
+        lower = 0
+        for edge, count in zip(list(self.edges) + [None], self.counts):
+            label = ('{:g}-{:g} s'.format(lower, edge) if edge is not None
+                     else '> {:g} s'.format(lower))
+            lines.append('  {:>10}  {:>5}  {}'.format(label, count, '#' * count))
+            lower = edge
+        lines.append('Longest stalled in:')
+        offenders = sorted(self.locations.items(), key=lambda item: -item[1][1])
+        for location, (count, seconds) in offenders[:TOP_OFFENDERS]:
+            lines.append('  {:>8.2f} s  {:>4}x  {}'.format(seconds, count, location))
+        return lines
+
+
+class StallWatchdog(object):
+    def __init__(self, thread_id, threshold=DEFAULT_THRESHOLD,
+                 interval=HEARTBEAT_INTERVAL):
+        '''
+        @param thread_id: ident of the thread running the event loop
+        @param threshold: seconds the loop may be late before it is
+                          considered stalled
+        @param interval: seconds between two beats of the loop
+        '''
+        self.thread_id = thread_id
+        self.threshold = threshold
+        self.interval = interval
+        self.stats = StallStats()
+        self._lock = threading.Lock()
+        self._last_beat = time.monotonic()
+        # stack captured during the current stall, None if none
+        self._stack = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stall watchdog',
+                                        daemon=True)
+
+    def start(self):
+        self._last_beat = time.monotonic()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def beat(self):
+        '''
+        Called from the event loop every interval seconds
+        '''
+        now = time.monotonic()
+        with self._lock:
+            late = now - self._last_beat - self.interval
+            stack, self._stack = self._stack, None
+            self._last_beat = now
+        if late < self.threshold:
+            return
+
+        location = stall_location(stack)
+        self.stats.add(late, location)
+        tracing.record('event loop stall', tracing.now() - late, location=location)
+        print('Event loop stalled for {:.2f} s in {}'.format(late, location))
+
+    def _run(self):
+        # checked often enough to catch the loop well within a stall
+        while not self._stopped.wait(min(self.threshold, self.interval) / 2.0):
+            with self._lock:
+                late = time.monotonic() - self._last_beat - self.interval
+                if late < self.threshold or self._stack is not None:
+                    continue
+                frame = sys._current_frames().get(self.thread_id)
+                self._stack = traceback.extract_stack(frame) if frame is not None else []
+                stack = self._stack
+            print('Event loop stalled for more than {:.2f} s, at:'.format(late))
+            print(''.join(traceback.format_list(stack)).rstrip())
@@ -0,0 +1,215 @@
+'''
+Waveform peak cache
+
+Audio is decoded once, in chunks, into min/max peaks of fixed size bins. The
+peaks are reduced into a pyramid of coarser levels, each half the length of
+the previous one, and stored in a memory mapped file of the daze cache
+directory, so drawing a waveform at any width only reads the matching level
+'''
+import hashlib
+import os
+import struct
+import subprocess
+import tempfile
+
+import numpy as np
+
+from . import tracing
+from .transcode import FFMPEG
+
+
+CACHE_DIRECTORY = '~/.daze_cache/peaks'
+PEAK_SAMPLE_RATE = 8000
+BIN_SIZE = 256
+CHUNK_BINS = 4096
+
+# magic, version, size and mtime of the audio file, base level length,
+# bin size, sample rate
+HEADER = struct.Struct('<8sIqdQII')
+MAGIC = b'DAZEPEAK'
+VERSION = 1
+
+
+def level_lengths(base_length):
+    '''
+    Return the length of every level of the pyramid, finest first
+    '''
+    lengths = [base_length]
+    while lengths[-1] > 1:
+        lengths.append((lengths[-1] + 1) // 2)
+    return lengths
+
+
+class Peaks(object):
+    def __init__(self, data, base_length, bin_size, sample_rate):
+        '''
+        Pyramid of waveform peaks
+
+        @param data: (rows, 2) int16 array of every level's (min, max) rows
+        @param base_length: number of bins of the finest level
+        @param bin_size: number of samples per bin of the finest level
+        @param sample_rate: sample rate the peaks were computed at
+        '''
+        self.levels = []
+        start = 0
+        for length in level_lengths(base_length):
+            self.levels.append(data[start:start + length])
+            start += length
+        self.bin_size = bin_size
+        self.sample_rate = sample_rate
+        self._columns = {}
+
+    @property
+    def duration(self):
+        return len(self.levels[0]) * self.bin_size / self.sample_rate
+
+    def level_for(self, width):
+        '''
+        Return the coarsest level with at least one bin per pixel
+        '''
+        for level in reversed(self.levels):
+            if len(level) >= width:
+                return level
+        return self.levels[0]
+
+    def columns(self, width):
+        '''
+        Return the peaks of each pixel column, scaled to -1..1
+
+        @param width: number of pixel columns
+        @return: (minimums, maximums) float arrays of width values, the bins
+                 of a level shorter than width are repeated over several
+                 columns
+        '''
+        if width not in self._columns:
+            level = self.level_for(width)
+            if len(level) == 0 or width <= 0:
+                return np.zeros(0), np.zeros(0)
+            # reduceat takes the single bin at an edge repeated by the next
+            edges = np.linspace(0, len(level), width, endpoint=False).astype(np.intp)
+            minimums = np.minimum.reduceat(level[:, 0], edges) / 32768.0
+            maximums = np.maximum.reduceat(level[:, 1], edges) / 32768.0
+            self._columns[width] = (minimums, maximums)
+        return self._columns[width]
+
+
+def peaks_path(path):
+    '''
+    Return the path of the peak file of an audio file
+    '''
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(os.path.expanduser(CACHE_DIRECTORY),
+                        '{}.peaks'.format(digest))
+
+
+def load(path):
+    '''
+    Load the cached peaks of an audio file
+
+    @return: Peaks, or None if they are not cached or the file changed
+    '''
+    try:
+        stat = os.stat(path)
+        with open(peaks_path(path), 'rb') as handle:
+            header = HEADER.unpack(handle.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+
+    magic, version, size, mtime, base_length, bin_size, sample_rate = header
+    if (magic, version, size, mtime) != (MAGIC, VERSION, stat.st_size, stat.st_mtime):
+        return None
+
+    if base_length == 0:
+        return Peaks(np.zeros((0, 2), dtype='<i2'), 0, bin_size, sample_rate)
+    rows = sum(level_lengths(base_length))
+    data = np.memmap(peaks_path(path),
+                     dtype='<i2',
+                     mode='r',
+                     offset=HEADER.size,
+                     shape=(rows, 2))
+    return Peaks(data, base_length, bin_size, sample_rate)
+
+
+def compute_base_level(path):
+    '''
+    Decode an audio file to mono PCM, in chunks, and compute the min/max of
+    every bin
+
+    @return: (bins, 2) int16 array
+    '''
+    command = [FFMPEG, '-v', 'error', '-i', path, '-vn',
+               '-f', 's16le', '-ac', '1', '-ar', str(PEAK_SAMPLE_RATE), '-']
+    decoder = subprocess.Popen(command,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    chunks = []
+    remainder = np.zeros(0, dtype='<i2')
+    try:
+        while True:
+            data = decoder.stdout.read(CHUNK_BINS * BIN_SIZE * 2)
+            if not data:
+                break
+            samples = np.concatenate((remainder,
+                                      np.frombuffer(data[:len(data) // 2 * 2],
+                                                    dtype='<i2')))
+            whole = len(samples) // BIN_SIZE * BIN_SIZE
+            bins = samples[:whole].reshape(-1, BIN_SIZE)
+            chunks.append(np.stack((bins.min(axis=1), bins.max(axis=1)), axis=1))
+            remainder = samples[whole:]
+    finally:
+        decoder.stdout.close()
+        decoder.wait()
+
+    if decoder.returncode != 0:
+        raise OSError('Unable to decode {}'.format(path))
+    if len(remainder):
+        chunks.append(np.array([[remainder.min(), remainder.max()]], dtype='<i2'))
+    if not chunks:
+        return np.zeros((0, 2), dtype='<i2')
+    return np.concatenate(chunks).astype('<i2')
+
+
+def build_pyramid(base):
+    '''
+    Reduce the base level into coarser levels, each level's bins covering
+    two bins of the previous one
+
+    @return: list of (length, 2) int16 arrays, finest first
+    '''
+    levels = [base]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = np.concatenate((level, level[-1:]))
+        pairs = level.reshape(-1, 2, 2)
+        levels.append(np.stack((pairs[:, :, 0].min(axis=1),
+                                pairs[:, :, 1].max(axis=1)), axis=1))
+    return levels
+
+
+@tracing.traced('waveform.generate')
+def generate(path):
+    '''
+    Compute and cache the peaks of an audio file
+
+    @return: Peaks
+    '''
+    stat = os.stat(path)
+    base = compute_base_level(path)
+    levels = build_pyramid(base)
+
+    destination = peaks_path(path)
+    directory = os.path.dirname(destination)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.peaks', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(HEADER.pack(MAGIC, VERSION, stat.st_size, stat.st_mtime,
+                                     len(base), BIN_SIZE, PEAK_SAMPLE_RATE))
+            for level in levels:
+                handle.write(level.astype('<i2').tobytes())
+        os.replace(temp_path, destination)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return load(path)
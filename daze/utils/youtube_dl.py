@@ -1,53 +1,164 @@
 from __future__ import unicode_literals
+import functools
 import os
-import youtube_dl
+import re
+
+# youtube_dl itself is imported on first use, importing it imports every
+# extractor, which is most of the startup time of daze
 
 
 class YoutubeDLLogger(object):
+    def __init__(self, log=None):
+        '''
+        @param log: called with every log line, lines are printed if None
+        '''
+        self.log = log or print
+
     def debug(self, msg):
-        print(msg)
+        self.log(msg)
 
     def warning(self, msg):
-        print(msg)
+        self.log(msg)
 
     def error(self, msg):
-        print(msg)
+        self.log(msg)
 
 
 YOUTUBEDL_OPTS = {
     'format': 'bestaudio/best',
-    'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'mp3',
-        'preferredquality': '192',
-    }],
-    'logger': YoutubeDLLogger()
+    # resume .part files left by an interrupted download with HTTP ranges
+    'continuedl': True,
 }
+# info types of links holding several videos
+PLAYLIST_TYPES = ('playlist', 'multi_video')
+
+
+@functools.lru_cache(maxsize=None)
+def _extractor_classes():
+    from youtube_dl.extractor import gen_extractor_classes
+    return [extractor for extractor in gen_extractor_classes()
+            if extractor.ie_key() != 'Generic']
+
+
+def source_id(link):
+    '''
+    Return the extractor and id of the video a link points to, matching it
+    against the youtube-dl extractors without any network round trip. The
+    first call compiles every extractor's URL pattern
+
+    @param link: link provided by user
+    @return: (extractor, video id), None if no extractor knows the link
+    '''
+    for extractor in _extractor_classes():
+        if extractor.suitable(link):
+            try:
+                return extractor.ie_key(), extractor._match_id(link)
+            except (IndexError, AssertionError, re.error):
+                # the extractor's pattern has no id
+                return None
+    return None
+
+
+def playlist_entries(info):
+    '''
+    Return the entries of unprocessed playlist info, without resolving them
+
+    @param info: info of a playlist extracted with process=False
+    @return: list of dictionaries with the url, ie_key, video_id and title of
+             every entry
+    '''
+    entries = info.get('entries') or []
+    if hasattr(entries, 'getslice'):
+        # paged list
+        entries = entries.getslice()
+
+    found = []
+    for entry in entries:
+        if not entry:
+            continue
+        url = entry.get('url') or entry.get('webpage_url') or entry.get('id')
+        if not url:
+            continue
+        found.append({'url': url,
+                      'ie_key': entry.get('ie_key') or entry.get('extractor_key'),
+                      'video_id': entry.get('id'),
+                      'title': entry.get('title') or url})
+    return found
 
 
 class YoutubeDLUtility(object):
-    def __init__(self, link, dest_dir):
+    def __init__(self, link, dest_dir, ie_key=None, progress_callback=None,
+                 log=None):
         '''
         Audio download/conversion
 
         @param link: link provided by user
         @param dest_dir: destination directory where downloaded audio files
                          will end up
+        @param ie_key: key of the extractor handling the link, found from
+                       the link if None
+        @param progress_callback: called with this YoutubeDLUtility whenever
+                                  more of the audio file was downloaded, and
+                                  once it is
+        @param log: called with every youtube-dl log line, lines are printed
+                    if None
         '''
         self.link = link
         self.dest_dir = dest_dir
-        self._filename = ''
+        self.ie_key = ie_key
+        self.progress_callback = progress_callback
+        # partial file being downloaded and how much of it is
+        self.partial_filename = ''
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.speed = None
+        self.eta = None
+        self.finished = False
+        # entries of the playlist the link turned out to be, see download
+        self.title = ''
+        self.entries = None
+        # path of the audio file, the downloaded file until it is converted
+        self.filename = ''
+        self.download_filename = ''
+        # page URL, extractor and id of the downloaded video, once known
+        self.url = link
+        self.extractor = None
+        self.video_id = None
         self.dest_file = '{}/%(title)s.%(ext)s'.format(self.dest_dir)
         self.options = {'progress_hooks': [self.progress_hook],
                         'outtmpl': self.dest_file}
         self.options.update(YOUTUBEDL_OPTS)
+        self.options['logger'] = YoutubeDLLogger(log)
 
-    def download_and_convert(self):
+    def download(self):
         '''
-        Download and convert audio from the given link
+        Download the audio from the given link without converting it, leaving
+        the conversion to a separate stage (see utils.transcode).
+
+        A link to a playlist is not downloaded, its entries are only listed
+        in self.entries so they can be downloaded separately
         '''
+        import youtube_dl
         with youtube_dl.YoutubeDL(self.options) as ydl:
-            ydl.download([self.link])
+            info = ydl.extract_info(self.link,
+                                    download=False,
+                                    ie_key=self.ie_key,
+                                    process=False)
+            if info and info.get('_type') in PLAYLIST_TYPES:
+                self.title = info.get('title') or self.link
+                self.entries = playlist_entries(info)
+                return
+            self._record_source(ydl.process_ie_result(info, download=True))
+
+    def _record_source(self, info):
+        '''
+        Keep where the audio of a single video came from
+        '''
+        if not info or info.get('_type', 'video') != 'video':
+            return
+        self.url = info.get('webpage_url') or self.link
+        self.extractor = info.get('extractor_key')
+        self.video_id = info.get('id')
 
     def progress_hook(self, audio_metadata):
         '''
@@ -57,20 +168,26 @@ class YoutubeDLUtility(object):
         @param audio_metadata: dictionary containing metadata about the audio
                                file
         '''
-        if audio_metadata.get('eta') is not None:
-            print('Estimated time of completiton: ', audio_metadata['eta'])
+        self.eta = audio_metadata.get('eta')
+        self.speed = audio_metadata.get('speed')
+        self.total_bytes = (audio_metadata.get('total_bytes') or
+                            audio_metadata.get('total_bytes_estimate'))
+
+        if audio_metadata['status'] == 'downloading':
+            self.partial_filename = (audio_metadata.get('tmpfilename') or
+                                     self.partial_filename)
+            self.downloaded_bytes = audio_metadata.get('downloaded_bytes') or 0
 
         if audio_metadata['status'] == 'finished':
-            print('Done downloading, now converting ...')
+            self.finished = True
+            self.downloaded_bytes = (audio_metadata.get('downloaded_bytes') or
+                                     audio_metadata.get('total_bytes') or
+                                     self.downloaded_bytes)
+            self.download_filename = audio_metadata['filename']
             self.filename = audio_metadata['filename']
 
-    @property
-    def filename(self):
-        return self._filename
-
-    @filename.setter
-    def filename(self, value):
-        self._filename = '{}{}'.format(os.path.splitext(value)[0], '.mp3')
+        if self.progress_callback is not None:
+            self.progress_callback(self)
 
     @property
     def name(self):
@@ -84,5 +201,9 @@ class YoutubeDLUtility(object):
         '''
         Return metadata about the audio file
         '''
-        return {'filename': self.filename}
+        metadata = {'filename': self.filename, 'url': self.url}
+        if self.extractor and self.video_id:
+            metadata.update({'extractor': self.extractor,
+                             'video_id': self.video_id})
+        return metadata
 
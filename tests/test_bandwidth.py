@@ -0,0 +1,35 @@
+from daze.utils import bandwidth
+from daze.utils.bandwidth import BandwidthLimiter
+
+
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(bandwidth.time, 'sleep', slept.append)
+    return slept
+
+
+def test_resumed_download_is_not_charged_for_its_partial_file(monkeypatch):
+    slept = sleeps(monkeypatch)
+    limiter = BandwidthLimiter(1000000)
+    limiter.register(1)
+    limiter.throttle(1, 50001024)
+    limiter.throttle(1, 50001024 + 1000)
+    assert sum(slept) < 0.01
+
+
+def test_download_ahead_of_its_share_waits(monkeypatch):
+    slept = sleeps(monkeypatch)
+    limiter = BandwidthLimiter(1000000)
+    limiter.register(1)
+    limiter.throttle(1, 0)
+    limiter.throttle(1, 3000000)
+    assert 1.5 < sum(slept) <= 3.0
+
+
+def test_unlimited_never_waits(monkeypatch):
+    slept = sleeps(monkeypatch)
+    limiter = BandwidthLimiter()
+    limiter.register(1)
+    limiter.throttle(1, 0)
+    limiter.throttle(1, 10 ** 9)
+    assert slept == []
@@ -0,0 +1,46 @@
+import shutil
+import subprocess
+
+import pytest
+
+from daze.utils import transcode
+
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which(transcode.FFMPEG) is None,
+                                  reason='ffmpeg is not installed')
+
+
+def source(path, codec):
+    subprocess.run([transcode.FFMPEG, '-v', 'error', '-y',
+                    '-f', 'lavfi', '-i', 'sine=frequency=440:duration=2',
+                    '-codec:a', codec, str(path)], check=True)
+    return str(path)
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize('codec, name, remuxed', [('libopus', 'a.webm', 'a.opus'),
+                                                  ('libvorbis', 'b.webm', 'b.ogg'),
+                                                  ('aac', 'c.mp4', 'c.m4a')])
+def test_remuxing_twice_gives_the_same_bytes(tmp_path, codec, name, remuxed):
+    path = source(tmp_path / name, codec)
+    first, second = tmp_path / ('1' + remuxed), tmp_path / ('2' + remuxed)
+    transcode.remux(path, str(first))
+    transcode.remux(path, str(second))
+    assert first.read_bytes() == second.read_bytes()
+
+
+@needs_ffmpeg
+def test_encoding_twice_gives_the_same_bytes(tmp_path):
+    path = source(tmp_path / 'a.webm', 'libopus')
+    first, second = tmp_path / '1.mp3', tmp_path / '2.mp3'
+    transcode.encode(path, str(first), 128)
+    transcode.encode(path, str(second), 128)
+    assert first.read_bytes() == second.read_bytes()
+
+
+def test_encoding_never_goes_above_the_source_bitrate():
+    assert transcode.target_quality(192, 128) == 128
+    assert transcode.target_quality(192, 130) == 128
+    assert transcode.target_quality(192, 900) == 192
+    assert transcode.target_quality(192, None) == 192
+    assert transcode.target_quality(192, 130, 'opus') == 130
@@ -0,0 +1,38 @@
+import numpy as np
+
+from daze.utils.waveform import Peaks, level_lengths
+
+
+def peaks(bins):
+    base = np.stack([-np.arange(bins), np.arange(bins)], axis=1).astype('<i2')
+    levels = [base]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = np.concatenate([level, level[-1:]])
+        levels.append(np.stack([level[0::2, 0].clip(max=level[1::2, 0]),
+                                level[0::2, 1].clip(min=level[1::2, 1])], axis=1))
+    data = np.concatenate(levels)
+    assert len(data) == sum(level_lengths(bins))
+    return Peaks(data, bins, 256, 8000)
+
+
+def test_track_shorter_than_the_widget_fills_its_width():
+    minimums, maximums = peaks(10).columns(300)
+    assert len(minimums) == len(maximums) == 300
+    # the last bin is drawn at the right edge, not a tenth of the way in
+    assert maximums[-1] == 9 / 32768.0
+    assert maximums[0] == 0
+    assert list(maximums) == sorted(maximums)
+
+
+def test_track_longer_than_the_widget_gets_a_column_per_pixel():
+    minimums, maximums = peaks(1000).columns(300)
+    assert len(minimums) == len(maximums) == 300
+    assert maximums.max() == 999 / 32768.0
+
+
+def test_empty_track_has_no_columns():
+    data = np.zeros((0, 2), dtype='<i2')
+    minimums, maximums = Peaks(data, 0, 256, 8000).columns(300)
+    assert len(minimums) == len(maximums) == 0